@@ -1,11 +1,18 @@
 """ configure the test suite to share a database """
 
+import collections
+import csv
 import datetime
+import decimal
 import functools
 import glob
+import io
+import json
 import os
 import re
+import uuid
 
+import pandas as pd
 import pytest
 import sqlalchemy as sa
 import sqlalchemy.event as sa_event
@@ -16,23 +23,147 @@ import testing.postgresql
 
 REPO_BASE_DIR = os.path.dirname(__file__)
 
+# database on the test server with the extensions installed, which session databases are copied from
+TEMPLATE_DATABASE = 'bayesian_test_template'
+
+# advisory lock serializing the creation of the template database by concurrent sessions (e.g. pytest-xdist workers)
+TEMPLATE_LOCK_KEY = 0x7e3d1a7f
+
+
+def _with_database(server_url, name):
+    url = sa.engine.url.make_url(server_url)
+    url.database = name
+    return str(url)
+
+
+def _install_extensions(url):
+    engine = sa.create_engine(url)
+    engine.execute(sa.text('create extension if not exists "uuid-ossp"'))
+    engine.execute(sa.text('create extension if not exists btree_gist'))
+    engine.dispose()
+
+
+def _ensure_template_database(server_engine, server_url):
+    """Create the template database unless it exists. Concurrent sessions wait for the first one."""
+    with server_engine.connect() as conn:
+        conn.execute('SELECT pg_advisory_lock(%d)' % TEMPLATE_LOCK_KEY)
+        try:
+            exists = conn.execute(
+                sa.text('SELECT 1 FROM pg_database WHERE datname = :name'), name=TEMPLATE_DATABASE).scalar()
+            if not exists:
+                conn.execute('CREATE DATABASE %s' % TEMPLATE_DATABASE)
+                _install_extensions(_with_database(server_url, TEMPLATE_DATABASE))
+        finally:
+            conn.execute('SELECT pg_advisory_unlock(%d)' % TEMPLATE_LOCK_KEY)
+
+
+def _create_session_database(server_url):
+    """
+    Create an isolated database on an already running server (e.g. the warm server of etl_nested)
+    and return its URL. The database is named after the process, so concurrent sessions (including
+    pytest-xdist workers) do not collide. It is copied from a template database with the extensions installed.
+    """
+    name = 'test_%d_%s' % (os.getpid(), uuid.uuid4().hex[:8])
+    server_engine = sa.create_engine(server_url, isolation_level='AUTOCOMMIT')
+    _ensure_template_database(server_engine, server_url)
+    server_engine.execute('CREATE DATABASE %s TEMPLATE %s' % (name, TEMPLATE_DATABASE))
+
+    def drop_database():
+        server_engine.execute(sa.text(
+            'SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = :name'), name=name)
+        server_engine.execute('DROP DATABASE IF EXISTS %s' % name)
+        server_engine.dispose()
+
+    return _with_database(server_url, name), drop_database
+
+
+# catalog snapshots of the session databases right after their setup, by URL (see the database_snapshot fixture)
+_DATABASE_SNAPSHOTS = {}
+
 
 @pytest.fixture(scope='session')
 def database(request):
-    """Session-wide test database."""
+    """
+    Session-wide test database.
+
+    If POSTGRES_TESTSERVER is set, the database is created on that server and dropped at the end of the session,
+    which saves starting a server. Otherwise a temporary server is started.
+    """
     url = os.getenv('POSTGRES_TESTSERVER')
 
-    if not url:
+    if url:
+        url, drop_database = _create_session_database(url)
+        request.addfinalizer(drop_database)
+    else:
         db = testing.postgresql.Postgresql()
         url = db.url()
         request.addfinalizer(db.stop)
+        _install_extensions(url)
 
+    _DATABASE_SNAPSHOTS[url] = _engine_catalog_snapshot(url)
+    return url
+
+
+CatalogSnapshot = collections.namedtuple('CatalogSnapshot', ['schemas', 'relations', 'extensions'])
+CatalogSnapshot.__doc__ = """
+Names of the schemas, relations (schema, name, kind) and extensions of a database.
+Temporary and TOAST schemas are not included, since Postgres creates them on demand.
+"""
+
+# relation kinds that tests create: tables, views, materialized views, sequences, foreign and partitioned tables
+SNAPSHOT_RELKINDS = ('r', 'v', 'm', 'S', 'f', 'p')
+
+# DROP statement per relation kind
+DROP_RELATION_STATEMENTS = {
+    'r': 'DROP TABLE IF EXISTS %s.%s CASCADE',
+    'p': 'DROP TABLE IF EXISTS %s.%s CASCADE',
+    'v': 'DROP VIEW IF EXISTS %s.%s CASCADE',
+    'm': 'DROP MATERIALIZED VIEW IF EXISTS %s.%s CASCADE',
+    'S': 'DROP SEQUENCE IF EXISTS %s.%s CASCADE',
+    'f': 'DROP FOREIGN TABLE IF EXISTS %s.%s CASCADE',
+}
+
+
+def take_catalog_snapshot(conn):
+    """Take a CatalogSnapshot of the database (a few catalog queries, so it is cheap)."""
+    schemas = frozenset(
+        row[0] for row in conn.execute(
+            "SELECT nspname FROM pg_namespace WHERE nspname !~ '^pg_(temp|toast_temp)_'"))
+    relations = frozenset(
+        (row[0], row[1], row[2]) for row in conn.execute(
+            """SELECT n.nspname, c.relname, c.relkind
+               FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+               WHERE n.nspname <> 'information_schema' AND n.nspname !~ '^pg_'
+               AND c.relkind IN (%s)""" % ', '.join("'%s'" % k for k in SNAPSHOT_RELKINDS)))
+    extensions = frozenset(row[0] for row in conn.execute('SELECT extname FROM pg_extension'))
+    return CatalogSnapshot(schemas, relations, extensions)
+
+
+def _engine_catalog_snapshot(url):
     engine = sa.create_engine(url)
-    engine.execute(sa.text('create extension if not exists "uuid-ossp"'))
-    engine.execute(sa.text('create extension if not exists btree_gist'))
-    engine.dispose()
+    try:
+        with engine.connect() as conn:
+            return take_catalog_snapshot(conn)
+    finally:
+        engine.dispose()
 
-    return url
+
+@pytest.fixture(scope='session')
+def database_snapshot(database: str):
+    """
+    Catalog snapshot of the freshly set up session database, which the postgres fixture resets to.
+    It is taken by the database fixture, before any test (e.g. of a shared_postgresql class) changed the database.
+    """
+    return _DATABASE_SNAPSHOTS[database]
+
+
+@pytest.fixture
+def catalog_snapshot():
+    """Function taking a CatalogSnapshot of the database of an engine."""
+    def snapshot(engine):
+        with engine.connect() as conn:
+            return take_catalog_snapshot(conn)
+    return snapshot
 
 
 @pytest.fixture(scope='class')
@@ -44,6 +175,35 @@ def shared_postgresql(database: str, request):
     request.addfinalizer(engine.dispose)
 
 
+def _encode_copy_value(value):
+    """Encode a value as a CSV field for COPY. NULL is an unquoted empty field, so all values are quoted."""
+    if value is None or (not isinstance(value, (str, list, dict)) and pd.isnull(value)):
+        return ''
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    elif isinstance(value, (datetime.date, datetime.time)):
+        value = value.isoformat()
+    elif isinstance(value, decimal.Decimal):
+        value = str(value)
+    return '"%s"' % str(value).replace('"', '""')
+
+
+def _encode_copy_rows(table, rows, columns=None):
+    """Encode a DataFrame or a list of dicts as COPY CSV text. Returns (columns, text)."""
+    if isinstance(rows, pd.DataFrame):
+        columns = list(columns or rows.columns)
+        records = rows[columns].itertuples(index=False, name=None)
+    else:
+        if columns is None:
+            present = set().union(*(row.keys() for row in rows)) if rows else set()
+            columns = [c.name for c in table.columns if c.name in present]
+        records = ([row.get(c) for c in columns] for row in rows)
+
+    lines = [','.join(_encode_copy_value(v) for v in record) for record in records]
+    lines.append('')
+    return columns, '\n'.join(lines)
+
+
 def with_connection(test_function):
     """Decorator to wrap functions in PostgresTestCase to facilitate optional connection."""
 
@@ -75,6 +235,8 @@ class PostgresTestUtil:
             created via connection.begin().
         sessionmaker (Optional[sa.orm.session.sessionmaker]):
         session (Optional[sa.orm.session.Session]): Open Sqlalchemy session.
+        baseline (Optional[CatalogSnapshot]): Catalog snapshot that reset_db() restores.
+            Without it, reset_db() drops all non-initial schemas.
 
     """
     INITIAL_SCHEMAS = {
@@ -93,7 +255,7 @@ class PostgresTestUtil:
 
     def __init__(
             self, request, engine, url, connection=None, transaction=None,
-            sessionmaker=None, session=None):
+            sessionmaker=None, session=None, baseline=None):
         self.request = request  # pytest request object
         self.engine = engine  # type: sa.engine.base.Engine
         self.postgresql_url = url  # type: str
@@ -101,38 +263,70 @@ class PostgresTestUtil:
         self.transaction = transaction
         self.sessionmaker = sessionmaker
         self.session = session
-
-    def reset_db(self):
-        """Reset the database by dropping all non-initial schemas."""
+        self.baseline = baseline
+
+    def _baseline_snapshot(self, current):
+        if self.baseline is not None:
+            return self.baseline
+        # without a baseline, keep the initial schemas along with everything in them
+        return CatalogSnapshot(
+            frozenset(self.INITIAL_SCHEMAS),
+            frozenset(r for r in current.relations if r[0] in self.INITIAL_SCHEMAS),
+            frozenset(self.EXTENSIONS))
+
+    def _drop_schemas(self, schemas):
+        quote = self.engine.dialect.identifier_preparer.quote
         try:
             with self.engine.begin() as connection:
-                rows = connection.execute('SELECT schema_name FROM information_schema.schemata')
-                schemas = {row['schema_name'] for row in rows} - self.INITIAL_SCHEMAS
-                query = ';'.join('DROP SCHEMA %s CASCADE' % s for s in schemas)
-                connection.execute(query)
+                connection.execute(';'.join('DROP SCHEMA IF EXISTS %s CASCADE' % quote(s) for s in schemas))
         except sa_exc.OperationalError:
             # Handle psycopg2 OOM errors caused by large transactions
-            # by removing tables in non-initial schemas one-by-one,
+            # by removing tables in the schemas one-by-one,
             # then removing their empty schemas.
             with self.engine.connect() as connection:
-                rows = connection.execute('SELECT schema_name FROM information_schema.schemata')
-                schemas = {row['schema_name'] for row in rows} - self.INITIAL_SCHEMAS
                 for schema in schemas:
-                    info_query = ("""SELECT table_name FROM information_schema.tables
-                                  WHERE table_schema = '%s'
-                                  AND table_type = 'BASE TABLE';""" % schema)
-                    rows = connection.execute(info_query)
+                    info_query = sa.text("""SELECT table_name FROM information_schema.tables
+                                         WHERE table_schema = :schema
+                                         AND table_type = 'BASE TABLE';""")
+                    rows = connection.execute(info_query, schema=schema)
                     tables = [row['table_name'] for row in rows]
                     for table in tables:
-                        query = 'DROP TABLE IF EXISTS %s.%s CASCADE;' % (schema, table)
+                        query = 'DROP TABLE IF EXISTS %s.%s CASCADE;' % (quote(schema), quote(table))
                         connection.execute(query)
-                    query = 'DROP SCHEMA %s CASCADE;' % schema
+                    query = 'DROP SCHEMA IF EXISTS %s CASCADE;' % quote(schema)
                     connection.execute(query)
 
+    def reset_db(self):
+        """
+        Reset the database to its baseline catalog snapshot (see the database_snapshot fixture).
+
+        Only what changed is restored: schemas and relations created since the snapshot are dropped,
+        and dropped schemas and extensions are recreated. If the catalog is unchanged, nothing is done.
+        NOTE: rows inserted into relations that already existed in the baseline are not removed.
+        """
+        with self.engine.connect() as connection:
+            current = take_catalog_snapshot(connection)
+        baseline = self._baseline_snapshot(current)
+
+        new_schemas = current.schemas - baseline.schemas
+        # relations in new schemas are dropped along with their schema
+        new_relations = sorted(r for r in current.relations - baseline.relations if r[0] not in new_schemas)
+        missing_schemas = baseline.schemas - current.schemas
+        missing_extensions = baseline.extensions - current.extensions
+        if not (new_schemas or new_relations or missing_schemas or missing_extensions):
+            return
+
+        if new_schemas:
+            self._drop_schemas(new_schemas)
+
+        quote = self.engine.dialect.identifier_preparer.quote
         with self.engine.begin() as connection:
-            connection.execute(sa.text('CREATE SCHEMA IF NOT EXISTS public'))
-            query = ';'.join('CREATE EXTENSION IF NOT EXISTS "%s"' % e for e in self.EXTENSIONS)
-            connection.execute(query)
+            for schema, name, kind in new_relations:
+                connection.execute(DROP_RELATION_STATEMENTS[kind] % (quote(schema), quote(name)))
+            for schema in sorted(missing_schemas):
+                connection.execute('CREATE SCHEMA IF NOT EXISTS %s' % quote(schema))
+            for extension in sorted(missing_extensions):
+                connection.execute('CREATE EXTENSION IF NOT EXISTS "%s"' % extension)
 
     @with_connection
     def _has_schema(self, schema, *, conn=None):
@@ -222,9 +416,48 @@ class PostgresTestUtil:
     def insert(self, table, values):
         self.connection.execute(sa.insert(table, values=values))
 
+    @with_connection
+    def copy_rows(self, table, rows, *, columns=None, conn=None):
+        """
+        Bulk load rows into a table with COPY (much faster than inserts for large fixtures).
+
+        Arguments:
+            table (sa.Table): Target table.
+            rows: A pandas DataFrame, a list of dicts or the filename of a CSV file with a header line.
+                CSV files are streamed to Postgres as they are. Missing values (None, NaN, NaT) become NULL.
+            columns (Optional[List[str]]): Columns to load (default: the DataFrame columns, the columns
+                of the table that occur in the dicts, or the CSV header). COPY maps the fields of a CSV file
+                by position, so for CSV files they must be the columns of its header (in any order).
+
+        Returns:
+            int: Number of rows loaded.
+        """
+        if isinstance(rows, str):
+            with open(rows, newline='') as csv_file:
+                header = next(csv.reader(csv_file))
+                if columns is not None and sorted(columns) != sorted(header):
+                    raise ValueError('Columns %s do not match the header of %s: %s' % (columns, rows, header))
+                csv_file.seek(0)
+                return self._copy(conn, table, header, csv_file, header=True)
+
+        columns, payload = _encode_copy_rows(table, rows, columns)
+        return self._copy(conn, table, columns, io.StringIO(payload))
+
+    def _copy(self, conn, table, columns, data, header=False):  # pylint: disable=no-self-use
+        quote = conn.dialect.identifier_preparer.quote
+        statement = 'COPY %s.%s (%s) FROM STDIN WITH CSV%s' % (
+            quote(table.schema or 'public'), quote(table.name), ', '.join(quote(c) for c in columns),
+            ' HEADER' if header else '')
+        cursor = conn.connection.cursor()
+        try:
+            cursor.copy_expert(statement, data)
+            return cursor.rowcount
+        finally:
+            cursor.close()
+
 
 @pytest.fixture
-def postgres(database: str, request):
+def postgres(database: str, database_snapshot: CatalogSnapshot, request):
     """
     Creates a PostgresTestUtil instance and triggers cleanup of the DB
     when the test is done.
@@ -237,7 +470,7 @@ def postgres(database: str, request):
     engine = sa.create_engine(database)
     request.addfinalizer(engine.dispose)
 
-    pgutil = PostgresTestUtil(request, engine, database)
+    pgutil = PostgresTestUtil(request, engine, database, baseline=database_snapshot)
     request.addfinalizer(pgutil.reset_db)
 
     return pgutil
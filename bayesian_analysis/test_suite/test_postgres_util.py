@@ -0,0 +1,136 @@
+"""
+Tests for the PostgresTestUtil test database helpers
+"""
+import datetime as dt
+import decimal as de
+
+import pandas as pd
+import pytest
+import sqlalchemy as sa
+
+METADATA = sa.MetaData()
+
+SCRATCH_TABLE = sa.Table(
+    'scratch',
+    METADATA,
+    sa.Column('id', sa.Integer, primary_key=True),
+    schema='public')
+
+OTHER_TABLE = sa.Table(
+    'other',
+    METADATA,
+    sa.Column('id', sa.Integer),
+    schema='test_reset')
+
+
+def test_database_snapshot_taken_at_setup(database, request):
+    # e.g. a table left behind by a shared_postgresql test class
+    engine = sa.create_engine(database)
+    engine.execute('CREATE TABLE public.leftover (id integer)')
+    try:
+        assert ('public', 'leftover', 'r') not in request.getfixturevalue('database_snapshot').relations
+    finally:
+        engine.execute('DROP TABLE public.leftover')
+        engine.dispose()
+
+
+def test_reset_db_restores_baseline(postgres, database_snapshot, catalog_snapshot):
+    postgres.create_tables([SCRATCH_TABLE, OTHER_TABLE])
+    with postgres.engine.begin() as conn:
+        conn.execute('CREATE VIEW public.scratch_view AS SELECT id FROM public.scratch')
+        conn.execute('DROP EXTENSION btree_gist')
+    assert catalog_snapshot(postgres.engine) != database_snapshot
+
+    postgres.reset_db()
+
+    assert catalog_snapshot(postgres.engine) == database_snapshot
+
+
+def test_reset_db_recreates_public_schema(postgres, database_snapshot, catalog_snapshot):
+    with postgres.engine.begin() as conn:
+        conn.execute('DROP SCHEMA public CASCADE')
+
+    postgres.reset_db()
+
+    assert catalog_snapshot(postgres.engine) == database_snapshot
+
+
+def test_reset_db_unchanged(postgres, database_snapshot):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    sa.event.listen(postgres.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        postgres.reset_db()
+    finally:
+        sa.event.remove(postgres.engine, 'before_cursor_execute', before_cursor_execute)
+
+    # only the catalog is queried
+    assert all(s.lstrip().upper().startswith('SELECT') for s in statements)
+
+
+LOAD_TABLE = sa.Table(
+    'load_target',
+    METADATA,
+    sa.Column('id', sa.Integer),
+    sa.Column('name', sa.Text),
+    sa.Column('score', sa.Numeric),
+    sa.Column('seen_on', sa.Date),
+    schema='test_load')
+
+LOAD_ROWS = [
+    {'id': 1, 'name': 'plain', 'score': de.Decimal('1.5'), 'seen_on': dt.date(2016, 1, 1)},
+    {'id': 2, 'name': 'quote " comma , newline \n', 'score': None, 'seen_on': None},
+    {'id': 3, 'name': '', 'seen_on': dt.date(2016, 12, 31)},
+]
+
+
+def _load_target_rows(pgutil):
+    return [tuple(row) for row in pgutil.connection.execute(LOAD_TABLE.select().order_by(LOAD_TABLE.c.id))]
+
+
+EXPECTED_LOADED_ROWS = [
+    (1, 'plain', de.Decimal('1.5'), dt.date(2016, 1, 1)),
+    (2, 'quote " comma , newline \n', None, None),
+    (3, '', None, dt.date(2016, 12, 31)),
+]
+
+
+def test_copy_rows_dicts(tpostgres):
+    tpostgres.create_tables([LOAD_TABLE])
+
+    assert tpostgres.copy_rows(LOAD_TABLE, LOAD_ROWS) == 3
+
+    assert _load_target_rows(tpostgres) == EXPECTED_LOADED_ROWS
+
+
+def test_copy_rows_dataframe(tpostgres):
+    tpostgres.create_tables([LOAD_TABLE])
+    frame = pd.DataFrame(LOAD_ROWS, columns=['id', 'name', 'score', 'seen_on'])
+
+    assert tpostgres.copy_rows(LOAD_TABLE, frame) == 3
+    assert tpostgres.copy_rows(LOAD_TABLE, pd.DataFrame(columns=['id'])) == 0
+
+    assert _load_target_rows(tpostgres) == EXPECTED_LOADED_ROWS
+
+
+def test_copy_rows_csv(tpostgres, tmpdir):
+    tpostgres.create_tables([LOAD_TABLE])
+    csv_path = tmpdir.join('rows.csv')
+    csv_path.write('id,name,seen_on\n1,plain,2016-01-01\n2,"a, b",\n')
+
+    assert tpostgres.copy_rows(LOAD_TABLE, str(csv_path)) == 2
+    # the fields are mapped by the header, whatever the order of the given columns
+    assert tpostgres.copy_rows(LOAD_TABLE, str(csv_path), columns=['seen_on', 'name', 'id']) == 2
+
+    assert _load_target_rows(tpostgres) == [
+        (1, 'plain', None, dt.date(2016, 1, 1)),
+        (1, 'plain', None, dt.date(2016, 1, 1)),
+        (2, 'a, b', None, None),
+        (2, 'a, b', None, None),
+    ]
+
+    with pytest.raises(ValueError):
+        tpostgres.copy_rows(LOAD_TABLE, str(csv_path), columns=['id', 'name'])
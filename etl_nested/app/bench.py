@@ -0,0 +1,279 @@
+import collections
+import csv
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import statistics
+import time
+
+from app import constants, db as perf_db, factories, metrics as run_metrics, pg_server, pgstats
+from app.logs import setup_logging
+from app.util.json import load_json_file
+from app.util.sqlstats import SQLStatementStats
+
+
+LOGGER = logging.getLogger(__name__)
+
+# columns of the CSV results file (also the keys of each run in the JSON results file)
+RESULT_FIELDS = [
+    'scenario',
+    'config',
+    'pg_profile',
+    'repetition',
+    'wall_seconds',
+    'cpu_seconds',
+    'max_rss_bytes',
+    'statements',
+    'submissions',
+    'events',
+    'submissions_per_second',
+    'events_per_second',
+    'clone_seconds',
+    'wal_bytes',
+    'blks_hit',
+    'blks_read',
+    'temp_bytes',
+    'tup_inserted',
+    'checkpoints',
+]
+
+# exact permutation tests are used up to this number of permutations, otherwise permutations are sampled
+MAX_PERMUTATIONS = 10000
+
+
+BenchmarkKey = collections.namedtuple('BenchmarkKey', ['scenario', 'config', 'pg_profile'])
+
+Comparison = collections.namedtuple(
+    'Comparison',
+    ['key', 'baseline_mean', 'mean', 'relative_change', 'p_value', 'regression']
+)
+
+
+def _run_once(root_dir:str, scenario_name:str, config_name:str, pg_profile:str, use_server:bool,
+              conf_dir:str) -> dict:
+    """
+    Processes a fresh copy of a scenario (executed in a child process)
+    """
+    setup_logging()
+
+    processor_config = load_json_file(os.path.join(conf_dir, constants.PROCESSOR_CONFIG_FILE))[config_name]
+    metrics = run_metrics.RunMetrics()
+    sql_stats = SQLStatementStats()
+
+    db_kwargs = {
+        'root_dir': root_dir,
+        'scenario_name': scenario_name,
+        'copy_from_template': True,
+        'pg_profile': pg_profile,
+    }
+    if use_server:
+        server = pg_server.WarmServer(os.path.join(root_dir, pg_server.SERVER_SUBDIR))
+        test_db = perf_db.ServerTestDatabase(server, **db_kwargs)
+    else:
+        test_db = perf_db.PerfTestDatabase(db_type=perf_db.DatabaseType.test_run, **db_kwargs)
+
+    with test_db as postgresql:
+        with perf_db.make_perf_session(postgresql, sql_stats=sql_stats) as session:
+            processor = factories.make_processor(session, processor_config, metrics=metrics)
+            server_before = pgstats.take_snapshot(session)
+            with metrics.measure(session.get_bind()):
+                processor()
+                with metrics.stage(run_metrics.COMMIT_STAGE):
+                    session.commit()
+            server_diff = pgstats.diff(server_before, pgstats.take_snapshot(session))
+        clone_seconds = postgresql.clone_seconds
+
+    report = metrics.report()
+    return {
+        'wall_seconds': report['wall_seconds'],
+        'cpu_seconds': report['cpu_seconds'],
+        'max_rss_bytes': report['memory']['max_rss_bytes'],
+        'statements': sql_stats.total_calls,
+        'submissions': report['counts'].get('submissions', 0),
+        'events': report['counts'].get('events', 0),
+        'submissions_per_second': report['throughput']['submissions_per_second'],
+        'events_per_second': report['throughput']['events_per_second'],
+        'clone_seconds': clone_seconds,
+        'wal_bytes': server_diff['wal_bytes'],
+        'blks_hit': server_diff['database'].get('blks_hit'),
+        'blks_read': server_diff['database'].get('blks_read'),
+        'temp_bytes': server_diff['database'].get('temp_bytes'),
+        'tup_inserted': server_diff['database'].get('tup_inserted'),
+        'checkpoints': sum(server_diff['checkpoints'].get(k, 0)
+                           for k in ('checkpoints_timed', 'checkpoints_requested')),
+    }
+
+
+def run_matrix(root_dir:str, scenario_names:list, config_names:list, repetitions:int=5, warmup:int=1,
+               use_server:bool=False, pg_profile:str=None, conf_dir:str=constants.DEFAULT_CONFIG_DIR) -> list:
+    """
+    Runs every combination of scenario and processor configuration
+
+    Every repetition runs in a fresh child process against a fresh copy of the scenario template so that runs
+    share neither caches nor memory high-water marks.
+
+    :param root_dir: root directory for all perf test databases
+    :param scenario_names: scenarios (their templates must already be generated)
+    :param config_names: processor configuration names
+    :param repetitions: number of measured runs per combination
+    :param warmup: number of unmeasured runs per combination
+    :param use_server: if set, runs use databases on the warm server (see app.pg_server)
+    :param pg_profile: Postgres settings profile for all scenarios (default: each scenario's profile)
+    :param conf_dir: configuration directory
+    :return: list of result dictionaries (see RESULT_FIELDS)
+    """
+    # a 'spawn' context guarantees that each run starts from a clean interpreter
+    mp_context = multiprocessing.get_context('spawn')
+
+    results = []
+    for scenario_name, config_name in itertools.product(scenario_names, config_names):
+        scenario_profile = pg_profile or perf_db.scenario_pg_profile(scenario_name, conf_dir)
+        for repetition in range(-warmup, repetitions):
+            LOGGER.info('Running %s / %s / %s (%s)', scenario_name, config_name, scenario_profile,
+                        'warmup' if repetition < 0 else 'repetition {}'.format(repetition + 1))
+
+            with mp_context.Pool(1) as pool:
+                result = pool.apply(_run_once, (root_dir, scenario_name, config_name, scenario_profile, use_server,
+                                                conf_dir))
+
+            if repetition >= 0:
+                results.append({'scenario': scenario_name, 'config': config_name, 'pg_profile': scenario_profile,
+                                'repetition': repetition, **result})
+    return results
+
+
+def write_results(results:list, pathname:str):
+    """
+    Writes results as a JSON file along with a CSV file with the same base name
+
+    :param results: list of result dictionaries
+    :param pathname: JSON filename
+    """
+    with open(pathname, 'w') as f:
+        json.dump({'runs': results}, f, indent=2, sort_keys=True)
+
+    csv_pathname = os.path.splitext(pathname)[0] + '.csv'
+    with open(csv_pathname, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(results)
+
+    LOGGER.info('Wrote benchmark results to %s and %s', pathname, csv_pathname)
+
+
+def load_results(pathname:str) -> list:
+    return load_json_file(pathname)['runs']
+
+
+def _group_samples(results:list, field:str) -> dict:
+    samples = collections.defaultdict(list)
+    for r in results:
+        # results written before profiles existed were measured with the default profile
+        key = BenchmarkKey(r['scenario'], r['config'], r.get('pg_profile', constants.DEFAULT_PG_PROFILE))
+        samples[key].append(r[field])
+    return samples
+
+
+def permutation_test(baseline:list, candidate:list, seed:int=0) -> float:
+    """
+    One-sided permutation test of the difference of means
+
+    This makes no assumption about the distribution of the timings, which are usually skewed.  Note that with
+    few samples the smallest achievable p-value is limited, e.g. 0.05 for 3 vs. 3 samples and 0.004 for 5 vs. 5.
+
+    :param baseline: baseline samples
+    :param candidate: candidate samples
+    :param seed: random seed used when permutations are sampled
+    :return: p-value of the candidate mean being greater than the baseline mean by chance
+    """
+    pooled = list(baseline) + list(candidate)
+    n = len(candidate)
+    total = sum(pooled)
+    observed = statistics.mean(candidate) - statistics.mean(baseline)
+
+    def _difference(indexes):
+        candidate_sum = sum(pooled[i] for i in indexes)
+        return candidate_sum / n - (total - candidate_sum) / (len(pooled) - n)
+
+    num_combinations = math.factorial(len(pooled)) // (math.factorial(n) * math.factorial(len(pooled) - n))
+    if num_combinations <= MAX_PERMUTATIONS:
+        permutations = itertools.combinations(range(len(pooled)), n)
+    else:
+        rng = random.Random(seed)
+        permutations = (rng.sample(range(len(pooled)), n) for _ in range(MAX_PERMUTATIONS))
+
+    num_permutations = 0
+    num_extreme = 0
+    for indexes in permutations:
+        num_permutations += 1
+        # allow for floating point error when comparing against the observed difference
+        if _difference(indexes) >= observed - 1e-12:
+            num_extreme += 1
+    return num_extreme / num_permutations
+
+
+def compare(baseline_results:list, results:list, field:str='wall_seconds',
+            alpha:float=0.05, min_change:float=0.05) -> list:
+    """
+    Compares results against a baseline
+
+    A combination is flagged as a regression when its mean is both significantly (p <= alpha) and
+    materially (by more than min_change) larger than the baseline mean.
+
+    :param baseline_results: baseline result dictionaries
+    :param results: new result dictionaries
+    :param field: field to compare (larger is worse)
+    :param alpha: significance level
+    :param min_change: minimum relative change considered a regression
+    :return: list of Comparison instances (only for combinations present in both)
+    """
+    baseline_samples = _group_samples(baseline_results, field)
+    comparisons = []
+    for key, samples in sorted(_group_samples(results, field).items()):
+        base = baseline_samples.get(key)
+        if not base:
+            continue
+
+        base_mean = statistics.mean(base)
+        mean = statistics.mean(samples)
+        relative_change = (mean - base_mean) / base_mean if base_mean else 0.0
+        p_value = permutation_test(base, samples)
+        regression = p_value <= alpha and relative_change > min_change
+        comparisons.append(Comparison(key, base_mean, mean, relative_change, p_value, regression))
+    return comparisons
+
+
+def log_summary(results:list, comparisons:list=None):
+    """
+    Logs a table of median results and baseline comparisons
+    """
+    wall_samples = _group_samples(results, 'wall_seconds')
+    statements = _group_samples(results, 'statements')
+    events_per_second = _group_samples(results, 'events_per_second')
+    wal_bytes = _group_samples(results, 'wal_bytes')
+    comparisons = {c.key: c for c in comparisons or []}
+
+    lines = ['{:<20} {:<28} {:<16} {:>10} {:>10} {:>12} {:>9} {:>9} {:>8}'.format(
+        'scenario', 'config', 'pg_profile', 'wall(s)', 'stmts', 'events/s', 'wal(MB)', 'change', 'p')]
+    for key in sorted(wall_samples):
+        c = comparisons.get(key)
+        lines.append('{:<20} {:<28} {:<16} {:>10.3f} {:>10} {:>12.0f} {:>9.1f} {:>9} {:>8}{}'.format(
+            key.scenario, key.config, key.pg_profile,
+            statistics.median(wall_samples[key]),
+            int(statistics.median(statements[key])),
+            statistics.median(e or 0 for e in events_per_second[key]),
+            statistics.median(wal_bytes[key]) / 2 ** 20,
+            '{:+.1%}'.format(c.relative_change) if c else '',
+            '{:.3f}'.format(c.p_value) if c else '',
+            '  REGRESSION' if c and c.regression else ''))
+    LOGGER.info('Benchmark results (medians)\n%s', '\n'.join(lines))
+
+
+def make_results_path(root_dir:str) -> str:
+    reports_dir = os.path.join(root_dir, perf_db.REPORTS_SUBDIR)
+    os.makedirs(reports_dir, exist_ok=True)
+    return os.path.join(reports_dir, 'bench__{}.json'.format(time.strftime('%Y%m%dT%H%M%S')))
@@ -3,6 +3,11 @@ import enum
 
 DEFAULT_CONFIG_DIR = 'conf'
 PROCESSOR_CONFIG_FILE = 'processors.conf.json'
+PERFDATA_CONFIG_FILE = 'perfdata.conf.json'
+PG_PROFILE_CONFIG_FILE = 'pgprofiles.conf.json'
+
+# Postgres settings profile of scenarios that do not select one
+DEFAULT_PG_PROFILE = 'default'
 
 
 class AnswerType(enum.Enum):
@@ -0,0 +1,131 @@
+import collections
+import logging
+import os
+import signal
+
+from app import metrics as run_metrics
+
+
+LOGGER = logging.getLogger(__name__)
+
+# default time between samples (in seconds of CPU time)
+DEFAULT_INTERVAL = 0.005
+
+# stage name of samples taken outside of any stage
+NO_STAGE = 'other'
+
+# paths in stack frames are shown relative to the project root
+_ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _short_path(filename:str) -> str:
+    if filename.startswith(_ROOT_DIR + os.sep):
+        return os.path.relpath(filename, _ROOT_DIR)
+    # e.g. 'sqlalchemy/orm/loading.py' rather than the full site-packages path
+    return os.path.join(*filename.split(os.sep)[-2:]) if os.sep in filename else filename
+
+
+class StackSampler:
+    """
+    Sampling CPU profiler: a timer signal interrupts the process at a regular interval of its CPU time and the
+    current Python stack is recorded, charged to the current stage of the run
+
+    Unlike cProfile, the profiled code runs unmodified, so the overhead is a fraction of a percent at the default
+    interval and does not depend on how many function calls the code makes.  Since the timer counts CPU time of this
+    process, time spent waiting on the database is not sampled (see the run metrics for that).
+
+    The stacks are written in the collapsed format of flamegraph.pl and speedscope (one line per distinct stack:
+    'outermost;...;innermost count').
+
+    NOTE: uses setitimer(ITIMER_PROF), which is only available on Unix, from the main thread
+    """
+    def __init__(self, metrics:run_metrics.RunMetrics=None, interval:float=DEFAULT_INTERVAL):
+        """
+        :param metrics: optional RunMetrics instance which tracks the current stage
+        :param interval: seconds of CPU time between samples
+        """
+        if not hasattr(signal, 'setitimer'):
+            raise RuntimeError('Sampling CPU profiles require setitimer() (Unix only)')
+
+        self.metrics = metrics
+        self.interval = interval
+        self.samples = collections.defaultdict(collections.Counter)
+
+        self._labels = {}
+        self._previous_handler = None
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = '{} ({}:{})'.format(code.co_name, _short_path(code.co_filename), code.co_firstlineno)
+            self._labels[code] = label
+        return label
+
+    def _sample(self, signum, frame):
+        labels = []
+        while frame is not None:
+            labels.append(self._label(frame.f_code))
+            frame = frame.f_back
+        labels.reverse()
+
+        stage = self.metrics.current_stage if self.metrics else None
+        self.samples[stage or NO_STAGE][';'.join(labels)] += 1
+
+    def start(self):
+        """
+        Starts sampling
+        """
+        self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        """
+        Stops sampling
+        """
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+        self._previous_handler = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def sample_counts(self) -> dict:
+        """
+        :return: number of samples per stage
+        """
+        return {stage: sum(stacks.values()) for stage, stacks in sorted(self.samples.items())}
+
+    def write_collapsed(self, prefix:str) -> dict:
+        """
+        Writes one collapsed stack file per stage, named '<prefix>.<stage>.collapsed'
+
+        :param prefix: path prefix of the files
+        :return: dictionary of stage names to filenames
+        """
+        filenames = {}
+        for stage, stacks in sorted(self.samples.items()):
+            filename = '{}.{}.collapsed'.format(prefix, stage)
+            with open(filename, 'w') as f:
+                for stack, count in sorted(stacks.items()):
+                    f.write('{} {}\n'.format(stack, count))
+            filenames[stage] = filename
+
+        LOGGER.info('Wrote collapsed CPU stacks (%s samples) to %s',
+                    ', '.join('{} {}'.format(n, stage) for stage, n in self.sample_counts().items()),
+                    ', '.join(filenames.values()))
+        return filenames
+
+    def report(self, filenames:dict=None) -> dict:
+        """
+        :param filenames: optional stage filenames (see write_collapsed)
+        :return: JSON serializable summary for the run metrics report
+        """
+        return {
+            'interval_seconds': self.interval,
+            'samples': self.sample_counts(),
+            'files': filenames or {},
+        }
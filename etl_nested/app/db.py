@@ -1,22 +1,110 @@
+import contextlib
 import enum
+import functools
+import hashlib
+import json
 import logging
 import os
+import re
 import shutil
+import subprocess
+import sys
+import time
+import uuid
 
+import sqlalchemy as sa
+import sqlalchemy.orm as sa_orm
 import testing.postgresql
 
+from app import constants, factories, fast_data, models, pg_server
+from app.util.json import load_json_file
+from app.util.sqlstats import SQLStatementStats
+
 
 LOGGER = logging.getLogger(__name__)
 
+# subdirectory of the perf data directory for run metrics and benchmark results
+REPORTS_SUBDIR = 'reports'
+
+
+# server options of all perf databases besides the settings of their profile (testing.postgresql defaults without -F,
+# since fsync is part of the profiles)
+BASE_POSTGRES_ARGS = '-h 127.0.0.1 -c logging_collector=off'
+
+# settings that only exist as of a Postgres version (settings of a profile that the server does not know are skipped)
+SETTING_MIN_SERVER_VERSIONS = {
+    'max_parallel_workers_per_gather': 90600,
+    'max_parallel_workers': 100000,
+    'max_parallel_maintenance_workers': 110000,
+}
+
 
 class DatabaseType(enum.Enum):
     template = 0
     test_run = 1
 
 
+class CloneMethod(enum.Enum):
+    auto = 0
+    reflink = 1
+    copy = 2
+
+
+# copy-on-write copy commands per platform (reflinks on btrfs/XFS/bcachefs, clonefile() on APFS)
+REFLINK_COMMANDS = {
+    'linux': ['cp', '-a', '--reflink=always'],
+    'darwin': ['cp', '-c', '-R', '-p'],
+}
+
+# devices whose file system was found to not support reflinks (avoids retrying for every test run)
+_reflink_unsupported_devices = set()
+
+
+def _clone_reflink(source:str, dest:str):
+    command = REFLINK_COMMANDS.get(sys.platform)
+    if command is None:
+        raise OSError('Reflinks not supported on platform {}'.format(sys.platform))
+    try:
+        subprocess.run(command + [source, dest], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as exc:
+        shutil.rmtree(dest, ignore_errors=True)
+        raise OSError('Reflink copy failed: {}'.format(exc.stderr.decode(errors='replace').strip())) from exc
+
+
+def clone_data_directory(source:str, dest:str, method:CloneMethod=CloneMethod.auto) -> CloneMethod:
+    """
+    Clones a Postgres data directory
+
+    With CloneMethod.auto, a reflink (copy-on-write) copy is tried first, which takes about the same time regardless
+    of the data size, and a plain copy is made if the file system does not support reflinks.
+
+    NOTE: hard links are not an option since Postgres modifies its data files in place, which would corrupt the template
+
+    :param source: data directory to clone
+    :param dest: new data directory (must not exist)
+    :param method: clone method
+    :return: clone method that was used
+    """
+    if method in (CloneMethod.auto, CloneMethod.reflink):
+        source_device = os.stat(source).st_dev
+        if method == CloneMethod.reflink or source_device not in _reflink_unsupported_devices:
+            try:
+                _clone_reflink(source, dest)
+                return CloneMethod.reflink
+            except OSError as exc:
+                if method == CloneMethod.reflink:
+                    raise
+                LOGGER.debug('%s, falling back to a plain copy', exc)
+                _reflink_unsupported_devices.add(source_device)
+
+    shutil.copytree(source, dest)
+    return CloneMethod.copy
+
+
 class PerfTestDatabase(testing.postgresql.Postgresql):
     TEMPLATES_SUBDIR = 'templates'
     TESTRUN_SUBDIR = 'test_runs'
+    TEMPLATE_KEY_FILE = 'template.key'
 
     # limit the length of the data directory root due to length limitations of UNIX socket names
     MAX_DATA_DIR_PATH_LEN = 70
@@ -26,6 +114,8 @@ class PerfTestDatabase(testing.postgresql.Postgresql):
                  scenario_name:str=None,
                  db_type:DatabaseType=None,
                  copy_from_template:bool=False,
+                 clone_method:CloneMethod=CloneMethod.auto,
+                 pg_profile:str=constants.DEFAULT_PG_PROFILE,
                  **kwargs):
         assert root_dir is not None
         assert scenario_name is not None
@@ -42,7 +132,15 @@ class PerfTestDatabase(testing.postgresql.Postgresql):
         # determine the template database root directory
         self._source_db_path = os.path.join(root_dir, self.TEMPLATES_SUBDIR, scenario_name)
 
+        # the template data directory is cloned by setup() instead of testing.postgresql's copytree
+        self._clone_from = None
+        self._clone_method = clone_method
+        self.clone_seconds = None
+
         kwargs = kwargs.copy()
+        self.pg_profile = pg_profile
+        kwargs.setdefault('postgres_args', make_postgres_args(load_pg_profile(pg_profile)))
+
         if db_type == DatabaseType.template:
             kwargs['base_dir'] = self._source_db_path
             self._erase_source_db = True
@@ -54,7 +152,7 @@ class PerfTestDatabase(testing.postgresql.Postgresql):
             if not os.path.exists(self._source_db_path):
                 LOGGER.error("You need to generate scenario '%s' first", scenario_name)
                 raise RuntimeError('Template directory missing')
-            kwargs['copy_data_from'] = os.path.join(self._source_db_path, 'data')
+            self._clone_from = os.path.join(self._source_db_path, 'data')
 
         super().__init__(**kwargs)
 
@@ -66,8 +164,246 @@ class PerfTestDatabase(testing.postgresql.Postgresql):
             os.makedirs(self._source_db_path)
 
         # if copying data from the template, clear out the directory first
-        elif self.settings.get('copy_data_from'):
+        elif self._clone_from:
             LOGGER.info("Copying scenario from template dir: %s", self._source_db_path)
             shutil.rmtree(self.base_dir, ignore_errors=True)
 
+            start = time.perf_counter()
+            os.makedirs(self.base_dir)
+            data_dir = os.path.join(self.base_dir, 'data')
+            clone_method = clone_data_directory(self._clone_from, data_dir, self._clone_method)
+            os.chmod(data_dir, 0o700)
+            self.clone_seconds = time.perf_counter() - start
+            LOGGER.info('Cloned template data directory (%s) in %.03f seconds', clone_method.name, self.clone_seconds)
+
         super().setup()
+
+
+class ServerTestDatabase:
+    """
+    Test run database on the warm server (see app.pg_server.WarmServer)
+
+    Unlike PerfTestDatabase, no server is started for the run: the scenario template is loaded into a template database
+    on the warm server once (with pg_dump), and every run gets a copy made with CREATE DATABASE ... TEMPLATE.
+    Template databases are named after the scenario's template key, so outdated ones are never used.
+
+    Since the server is shared, only the settings of the Postgres settings profile that can be changed per session
+    (e.g. work_mem, synchronous_commit) are applied to the test run database.
+
+    Test run databases get a unique name and are dropped at the end of the run, so that concurrent runs of a scenario
+    do not share (or drop) each other's database.
+    """
+    TEMPLATE_DB_PREFIX = 'template'
+    TESTRUN_DB_PREFIX = 'run'
+
+    def __init__(self, server:pg_server.WarmServer, *,
+                 root_dir:str=None,
+                 scenario_name:str=None,
+                 copy_from_template:bool=False,
+                 pg_profile:str=constants.DEFAULT_PG_PROFILE):
+        assert root_dir is not None
+        assert scenario_name is not None
+
+        self._server = server
+        self._root_dir = root_dir
+        self._scenario_name = scenario_name
+        self._copy_from_template = copy_from_template
+        self._db_name = pg_server.make_database_name(self.TESTRUN_DB_PREFIX, scenario_name, os.getpid(),
+                                                     uuid.uuid4().hex[:8])
+        self.pg_profile = pg_profile
+        self.clone_seconds = None
+
+    def _load_template(self) -> str:
+        template_key = read_template_key(self._root_dir, self._scenario_name)
+        if template_key is None:
+            LOGGER.error("You need to generate scenario '%s' first", self._scenario_name)
+            raise RuntimeError('Template directory missing')
+
+        prefix = pg_server.make_database_name(self.TEMPLATE_DB_PREFIX, self._scenario_name)
+        template_name = pg_server.make_database_name(prefix, template_key[:16])
+        # concurrent runs wait for the first one to load the template
+        self._server.ensure_template(template_name, self._restore_template, replaces_prefix=prefix + '_')
+        return template_name
+
+    def _restore_template(self, url:str):
+        LOGGER.info("Loading scenario '%s' into template database", self._scenario_name)
+        db_kwargs = {
+            'root_dir': self._root_dir,
+            'scenario_name': self._scenario_name,
+            'db_type': DatabaseType.test_run,
+            'copy_from_template': True,
+        }
+        with PerfTestDatabase(**db_kwargs) as postgresql:
+            dump = subprocess.Popen([testing.postgresql.find_program('pg_dump', ['bin']), '--no-owner',
+                                     '--no-privileges', postgresql.url()], stdout=subprocess.PIPE)
+            restore = subprocess.run([testing.postgresql.find_program('psql', ['bin']), '-q',
+                                      '-v', 'ON_ERROR_STOP=1', url],
+                                     stdin=dump.stdout, stdout=subprocess.DEVNULL)
+            dump.stdout.close()
+            if dump.wait() != 0 or restore.returncode != 0:
+                raise RuntimeError('Loading the template database failed')
+
+    def __enter__(self):
+        self._server.start()
+        if self._copy_from_template:
+            template_name = self._load_template()
+            LOGGER.info("Copying scenario from template database: %s", template_name)
+            start = time.perf_counter()
+            self._server.create_database(self._db_name, template=template_name)
+            self.clone_seconds = time.perf_counter() - start
+            LOGGER.info('Created test run database in %.03f seconds', self.clone_seconds)
+
+            skipped = self._server.configure_database(self._db_name, load_pg_profile(self.pg_profile))
+            if skipped:
+                LOGGER.warning("Settings of profile '%s' not applied on the warm server: %s",
+                               self.pg_profile, ', '.join(skipped))
+        return self
+
+    def __exit__(self, *args):
+        if self._copy_from_template:
+            self._server.drop_database(self._db_name)
+        self._server.touch()
+
+    def url(self) -> str:
+        return self._server.url(self._db_name)
+
+
+@functools.lru_cache()
+def postgres_server_version() -> int:
+    """
+    :return: version of the installed Postgres server in the format of the server_version_num setting
+    """
+    output = subprocess.run([testing.postgresql.find_program('postgres', ['bin']), '--version'],
+                            check=True, stdout=subprocess.PIPE).stdout.decode()
+    numbers = [int(n) for n in re.search(r'(\d+)(?:\.(\d+))?(?:\.(\d+))?', output).groups(default='0')]
+    if numbers[0] >= 10:
+        return numbers[0] * 10000 + numbers[1]
+    return numbers[0] * 10000 + numbers[1] * 100 + numbers[2]
+
+
+def load_pg_profile(profile_name:str, conf_dir:str=constants.DEFAULT_CONFIG_DIR) -> dict:
+    """
+    Loads a named profile of Postgres settings
+
+    :param profile_name: profile name (see conf/pgprofiles.conf.json)
+    :param conf_dir: configuration directory
+    :return: dictionary of settings supported by the installed server
+    """
+    settings = load_json_file(os.path.join(conf_dir, constants.PG_PROFILE_CONFIG_FILE))[profile_name]
+
+    server_version = postgres_server_version()
+    supported_settings = {}
+    for name, value in settings.items():
+        if server_version < SETTING_MIN_SERVER_VERSIONS.get(name, 0):
+            LOGGER.warning("Skipping setting '%s' of profile '%s' (not supported by Postgres %d)",
+                           name, profile_name, server_version)
+        else:
+            supported_settings[name] = str(value)
+    return supported_settings
+
+
+def scenario_pg_profile(scenario_name:str, conf_dir:str=constants.DEFAULT_CONFIG_DIR) -> str:
+    """
+    :return: name of the Postgres settings profile of a scenario
+    """
+    scenario = load_json_file(os.path.join(conf_dir, constants.PERFDATA_CONFIG_FILE))[scenario_name]
+    return scenario.get('pg_profile', constants.DEFAULT_PG_PROFILE)
+
+
+def make_postgres_args(settings:dict) -> str:
+    """
+    :param settings: dictionary of Postgres settings
+    :return: postgres server options (testing.postgresql's 'postgres_args')
+    """
+    # NOTE: testing.postgresql splits the options on whitespace, so values cannot contain spaces
+    return ' '.join([BASE_POSTGRES_ARGS] + ['-c {}={}'.format(k, v) for k, v in sorted(settings.items())])
+
+
+def make_template_key(scenario_name:str, conf_dir:str=constants.DEFAULT_CONFIG_DIR) -> str:
+    """
+    Content hash of everything that determines the data of a scenario template: the scenario configuration,
+    the contents of its schema files, the version of its data generator, its random seed and the DDL of the models
+
+    NOTE: Only the fast generator is seeded.  The default generator draws from the unseeded global random state, so its
+    data differs on every run whatever the seed, and the seed is left out of the key (changing it would only force a
+    pointless regeneration).
+
+    :param scenario_name: scenario name
+    :param conf_dir: configuration directory
+    :return: hex digest
+    """
+    scenario = load_json_file(os.path.join(conf_dir, constants.PERFDATA_CONFIG_FILE))[scenario_name]
+
+    # the server settings do not change the data
+    scenario = {k: v for k, v in scenario.items() if k != 'pg_profile'}
+
+    seed = scenario.pop('seed', 0)
+    if scenario.get('generator') == 'fast':
+        generator_version = 'fast:{}'.format(fast_data.GENERATOR_VERSION)
+    else:
+        generator_version = 'default:{}'.format(factories.GENERATOR_VERSION)
+        seed = None
+
+    content = {
+        'scenario': scenario,
+        'schemas': {
+            schema_name: load_json_file(os.path.join(conf_dir, 'schemas', schema_name + '.json'))
+            for schema_name in scenario['schemas']
+        },
+        'generator_version': generator_version,
+        'models': models.ddl_key(),
+        'seed': seed,
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _template_key_path(root_dir:str, scenario_name:str) -> str:
+    return os.path.join(root_dir, PerfTestDatabase.TEMPLATES_SUBDIR, scenario_name, PerfTestDatabase.TEMPLATE_KEY_FILE)
+
+
+def read_template_key(root_dir:str, scenario_name:str) -> str:
+    """
+    :return: key of an existing scenario template or None if the template was never completed
+    """
+    try:
+        with open(_template_key_path(root_dir, scenario_name)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def write_template_key(root_dir:str, scenario_name:str, template_key:str):
+    """
+    Marks a scenario template as complete
+
+    NOTE: this must only be called after the template was generated successfully
+    """
+    with open(_template_key_path(root_dir, scenario_name), 'w') as f:
+        f.write(template_key + '\n')
+
+
+def is_template_current(root_dir:str, scenario_name:str, template_key:str) -> bool:
+    return read_template_key(root_dir, scenario_name) == template_key
+
+
+@contextlib.contextmanager
+def make_perf_session(test_db, sql_stats:SQLStatementStats=None)-> sa_orm.Session:
+    db = None
+    session = None
+    try:
+        db_url = test_db.url()
+        db = sa.create_engine(db_url)
+        if sql_stats:
+            sql_stats.install(db)
+        sessionmaker = sa_orm.sessionmaker(db)
+        session = sessionmaker()
+
+        yield session
+
+    finally:
+        if session:
+            session.close()
+        if sql_stats:
+            sql_stats.uninstall()
+        if db:
+            db.dispose()
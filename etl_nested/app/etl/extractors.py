@@ -1,19 +1,162 @@
+import collections
 import enum
+import functools
+import logging
+import multiprocessing
+from collections import namedtuple
 
+import more_itertools
+import sqlalchemy as sa
 import sqlalchemy.orm as sa_orm
 
 from app import models
+from app.util import json as json_util
+
+
+LOGGER = logging.getLogger(__name__)
+
+# maximum number of cached rows per dimension table (see DimensionCache)
+DEFAULT_DIMENSION_CACHE_SIZE = 100000
+
+# same as User.full_name
+USER_FULL_NAME = models.User.given_name + ' ' + models.User.family_name
+
+SubmissionRecord = namedtuple(
+    'SubmissionRecord',
+    ['id', 'form_id', 'form_name', 'user_id', 'user_full_name', 'date_created', 'responses']
+)
+SubmissionRecord.__doc__ = """
+Plain submission row with the related form and user columns needed by the transformer
+
+The ids and date_created are kept in their Postgres text form (see passthrough_extractor)
+"""
 
 
 class RelatedLoadType(enum.Enum):
     default = 'default'
     joined_load = 'joined_load'
     explicit_join = 'explicit_join'
+    # load the users with submissions and all forms into the session first, so that the lazy loads are resolved
+    # without queries
+    prefetch = 'prefetch'
+    # pick joined_load, explicit_join or prefetch from the table statistics (see choose_related_load_type)
+    auto = 'auto'
+
+
+# 'auto' prefetches the users up to this number (estimated, and then checked while loading them)
+PREFETCH_MAX_USERS = 100000
+
+CardinalityEstimates = namedtuple('CardinalityEstimates', ['submissions', 'users'])
+CardinalityEstimates.__doc__ = """
+Estimated number of submissions and of distinct users with submissions (None if unknown)
+"""
+
+# session.info key holding references to the prefetched users and forms (the identity map only holds weak ones)
+PREFETCHED_KEY = 'extractors.prefetched'
+
+
+def _estimate_rows(session: sa_orm.Session, table:sa.Table):
+    # reltuples is -1 (Postgres 14+) or 0 for tables which were never analyzed
+    reltuples = session.execute(
+        sa.text('SELECT reltuples FROM pg_class WHERE oid = CAST(:table AS regclass)'),
+        {'table': table.fullname}
+    ).scalar()
+    return int(reltuples) if reltuples and reltuples > 0 else None
+
+
+def estimate_cardinalities(session: sa_orm.Session) -> CardinalityEstimates:
+    """
+    Estimates the number of submissions and of distinct users with submissions from the planner statistics
+
+    The number of users falls back to counting the users table (a small dimension table) without statistics.
+
+    :param session: SQLAlchemy session
+    :return: CardinalityEstimates
+    """
+    submissions_table = models.Submission.__table__
+    num_submissions = _estimate_rows(session, submissions_table)
+
+    # negative values of n_distinct are a fraction of the number of rows
+    n_distinct = session.execute(
+        sa.text('SELECT n_distinct FROM pg_stats '
+                'WHERE schemaname = :schema AND tablename = :table AND attname = :column'),
+        {'schema': submissions_table.schema, 'table': submissions_table.name, 'column': 'user_id'}
+    ).scalar()
+    num_users = None
+    if n_distinct is not None and n_distinct > 0:
+        num_users = int(n_distinct)
+    elif n_distinct is not None and num_submissions:
+        num_users = int(round(-n_distinct * num_submissions))
+
+    if num_users is None:
+        num_users = _estimate_rows(session, models.User.__table__)
+    if num_users is None:
+        num_users = session.query(sa.func.count(models.User.id)).scalar()
+
+    return CardinalityEstimates(num_submissions, num_users)
+
+
+def choose_related_load_type(estimates:CardinalityEstimates) -> RelatedLoadType:
+    """
+    Picks the related load type for the estimated cardinalities
+
+    Users which submit repeatedly are prefetched once rather than joined (or lazy loaded) once per submission, as
+    long as they fit in memory.  Otherwise, or if most users have a single submission, the users are joined.
+
+    NOTE: the dimension_cache_extractor is not one of the choices, it is a different extractor (with plain records
+    rather than models) which is configured explicitly
+
+    :param estimates: CardinalityEstimates
+    :return: RelatedLoadType other than auto
+    """
+    if estimates.users > PREFETCH_MAX_USERS:
+        return RelatedLoadType.explicit_join
+    if estimates.submissions is not None and estimates.users * 2 > estimates.submissions:
+        return RelatedLoadType.explicit_join
+    return RelatedLoadType.prefetch
+
+
+def _prefetch_related(session: sa_orm.Session, max_users:int=None) -> bool:
+    """
+    Loads the users with submissions and all forms into the session (users without submissions are never needed)
+
+    :param session: SQLAlchemy session
+    :param max_users: if set, nothing is prefetched when there are more users with submissions
+    :return: whether the users and forms were prefetched
+    """
+    submitters = session.query(models.Submission.user_id).distinct()
+    query = session.query(models.User).filter(models.User.id.in_(submitters.subquery()))
+    if max_users is not None:
+        query = query.limit(max_users + 1)
+    users = query.all()
+    if max_users is not None and len(users) > max_users:
+        LOGGER.info('Not prefetching users, there are more than %d with submissions', max_users)
+        return False
+
+    forms = session.query(models.Form).options(sa_orm.load_only('name')).all()
+    session.info[PREFETCHED_KEY] = (users, forms)
+    LOGGER.info('Prefetched %d users and %d forms', len(users), len(forms))
+    return True
 
 
 def _submission_query(session: sa_orm.Session, related:RelatedLoadType=None):
     assert related is not None
     related = RelatedLoadType(related)
+    max_users = None
+
+    if related == RelatedLoadType.auto:
+        estimates = estimate_cardinalities(session)
+        related = choose_related_load_type(estimates)
+        LOGGER.info('Chose related load type %s for an estimated %s submissions and %s distinct users',
+                    related.value, estimates.submissions, estimates.users)
+        # the estimates may be off (e.g. outdated statistics), so the prefetch gives up beyond the limit
+        if related == RelatedLoadType.prefetch:
+            max_users = PREFETCH_MAX_USERS
+
+    # Submission.user and Submission.form are many-to-one relationships on primary keys, so their lazy loads find
+    # the prefetched objects in the identity map instead of querying
+    if related == RelatedLoadType.prefetch and not _prefetch_related(session, max_users=max_users):
+        related = RelatedLoadType.explicit_join
 
     # this is the default query
     query = session.query(models.Submission)
@@ -46,7 +189,223 @@ def naive_load_all_extractor(session: sa_orm.Session, related:RelatedLoadType=No
     return _submission_query(session, related).all()
 
 
-def chunked_extractor(session: sa_orm.Session, related:RelatedLoadType=None, chunk_size:int=None):
+# decoder of the current decoding worker process (see _init_decode_worker)
+_worker_decode = None
+
+
+def _init_decode_worker(decoder_name:str):
+    global _worker_decode
+    _worker_decode = json_util.get_decoder(decoder_name)
+
+
+def _decode_texts(texts:list) -> list:
+    return [_worker_decode(text) for text in texts]
+
+
+def _decode_json_column(rows, decoder_name:str, workers:int, chunk_size:int):
+    """
+    Decodes the raw JSON text in the last column of each row
+
+    With workers, the chunks of texts are decoded in worker processes while the main process keeps fetching rows.
+    Up to one chunk per worker is in flight, so memory stays bounded however many rows there are.
+
+    :param rows: iterable of row tuples with the JSON text in the last column
+    :param decoder_name: JSON decoder (see json_util.get_decoder)
+    :param workers: number of decoding worker processes (0 decodes in the main process)
+    :param chunk_size: number of rows decoded at a time
+    :return: generator of (row, decoded document)
+    """
+    chunks = more_itertools.chunked(rows, chunk_size)
+
+    if not workers:
+        decode = json_util.get_decoder(decoder_name)
+        for chunk in chunks:
+            for row in chunk:
+                yield row, decode(row[-1])
+        return
+
+    # fail in the main process if the decoder is not available
+    json_util.get_decoder(decoder_name)
+
+    with multiprocessing.Pool(workers, initializer=_init_decode_worker, initargs=(decoder_name,)) as pool:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append((chunk, pool.apply_async(_decode_texts, ([row[-1] for row in chunk],))))
+            if len(pending) > workers:
+                chunk, result = pending.popleft()
+                yield from zip(chunk, result.get())
+        while pending:
+            chunk, result = pending.popleft()
+            yield from zip(chunk, result.get())
+
+
+def _set_responses(decoded_rows):
+    for (submission, _), responses in decoded_rows:
+        # set as loaded from the database, so the submission is not marked as modified
+        sa_orm.attributes.set_committed_value(submission, 'responses', responses)
+        yield submission
+
+
+def chunked_extractor(session: sa_orm.Session, related:RelatedLoadType=None, chunk_size:int=None,
+                      json_decoder:str=None, decode_workers:int=0):
+    """
+    :param session: SQLAlchemy session
+    :param related: how the related user and form are loaded
+    :param chunk_size: number of rows fetched at a time
+    :param json_decoder: optional JSON decoder (see json_util.get_decoder) for Submission.responses, which is then
+        fetched as raw text instead of being decoded by psycopg2 with the standard library
+    :param decode_workers: number of worker processes decoding the responses (only with json_decoder)
+    :return: iterable of Submission
+    """
+    assert chunk_size
+
+    query = _submission_query(session, related)
+    if not json_decoder:
+        return query.yield_per(chunk_size)
+
+    query = query \
+        .options(sa_orm.defer(models.Submission.responses)) \
+        .add_columns(sa.cast(models.Submission.responses, sa.Text))
+    return _set_responses(_decode_json_column(query.yield_per(chunk_size), json_decoder, decode_workers, chunk_size))
+
+
+def _responses_column(json_decoder:str, raw_responses:bool):
+    if json_decoder or raw_responses:
+        return sa.cast(models.Submission.responses, sa.Text)
+    return models.Submission.responses
+
+
+def _decode_responses(rows, json_decoder:str, decode_workers:int, chunk_size:int):
+    if not json_decoder:
+        return rows
+    return (
+        row[:-1] + (responses,)
+        for row, responses in _decode_json_column(rows, json_decoder, decode_workers, chunk_size)
+    )
+
+
+def passthrough_extractor(session: sa_orm.Session, chunk_size:int=None, json_decoder:str=None,
+                          decode_workers:int=0, raw_responses:bool=False):
+    """
+    Extracts submissions as SubmissionRecords without converting the ids and timestamps to Python objects
+
+    Postgres casts them to text, which the passthrough transformer and loader use as is.
+
+    :param session: SQLAlchemy session
+    :param chunk_size: number of rows fetched at a time
+    :param json_decoder: optional JSON decoder for the responses (see chunked_extractor)
+    :param decode_workers: number of worker processes decoding the responses (only with json_decoder)
+    :param raw_responses: keep the responses as raw JSON text (for the streaming transformer)
+    :return: generator of SubmissionRecord
+    """
+    assert chunk_size
+    assert not (json_decoder and raw_responses)
+
+    query = session.query(
+        sa.cast(models.Submission.id, sa.Text),
+        sa.cast(models.Submission.form_id, sa.Text),
+        models.Form.name,
+        sa.cast(models.Submission.user_id, sa.Text),
+        USER_FULL_NAME,
+        sa.cast(models.Submission.date_created, sa.Text),
+        _responses_column(json_decoder, raw_responses),
+    ) \
+        .join(models.User, models.Submission.user_id == models.User.id) \
+        .join(models.Form, models.Submission.form_id == models.Form.id)
+
+    rows = _decode_responses(query.yield_per(chunk_size), json_decoder, decode_workers, chunk_size)
+    return map(SubmissionRecord._make, rows)
+
+
+class DimensionCache:
+    """
+    Bounded LRU cache of the values of a dimension table (e.g. user names) by id
+
+    Missing ids are loaded in bulk, one query per batch of ids.  The least recently used values are evicted once a
+    batch has been resolved, so a batch is always resolved completely even if it has more ids than the cache holds.
+    """
+    def __init__(self, load, max_size:int=DEFAULT_DIMENSION_CACHE_SIZE):
+        """
+        :param load: function returning the (id, value) pairs of a list of ids
+        :param max_size: maximum number of cached values
+        """
+        self.load = load
+        self.max_size = max_size
+        self.num_loads = 0
+        self.num_misses = 0
+
+        self._values = collections.OrderedDict()
+
+    def resolve(self, ids:list) -> list:
+        """
+        :param ids: ids (may repeat)
+        :return: values of the ids (KeyError if the dimension has no row for an id)
+        """
+        values = self._values
+        missing = {i for i in ids if i not in values}
+        if missing:
+            values.update(self.load(sorted(missing)))
+            self.num_loads += 1
+            self.num_misses += len(missing)
+
+        resolved = []
+        for i in ids:
+            values.move_to_end(i)
+            resolved.append(values[i])
+
+        while len(values) > self.max_size:
+            values.popitem(last=False)
+        return resolved
+
+
+def _load_user_full_names(session: sa_orm.Session, user_ids:list):
+    return session.query(sa.cast(models.User.id, sa.Text), USER_FULL_NAME).filter(models.User.id.in_(user_ids))
+
+
+def _load_form_names(session: sa_orm.Session, form_ids:list):
+    return session.query(sa.cast(models.Form.id, sa.Text), models.Form.name).filter(models.Form.id.in_(form_ids))
+
+
+def dimension_cache_extractor(session: sa_orm.Session, chunk_size:int=None,
+                              cache_size:int=DEFAULT_DIMENSION_CACHE_SIZE, json_decoder:str=None,
+                              decode_workers:int=0, raw_responses:bool=False):
+    """
+    Extracts submissions as SubmissionRecords (see passthrough_extractor) without joining the users and forms
+
+    Only the submission columns are streamed.  The user full names and form names are resolved from bounded
+    in-memory caches (see DimensionCache), which load the missing ids of each chunk with one query per table.
+    Compared to the joins, this sends every name once rather than with every submission.
+
+    :param session: SQLAlchemy session
+    :param chunk_size: number of rows fetched and resolved at a time
+    :param cache_size: maximum number of cached users and of cached forms
+    :param json_decoder: optional JSON decoder for the responses (see chunked_extractor)
+    :param decode_workers: number of worker processes decoding the responses (only with json_decoder)
+    :param raw_responses: keep the responses as raw JSON text (for the streaming transformer)
+    :return: generator of SubmissionRecord
+    """
     assert chunk_size
+    assert not (json_decoder and raw_responses)
+
+    query = session.query(
+        sa.cast(models.Submission.id, sa.Text),
+        sa.cast(models.Submission.form_id, sa.Text),
+        sa.cast(models.Submission.user_id, sa.Text),
+        sa.cast(models.Submission.date_created, sa.Text),
+        _responses_column(json_decoder, raw_responses),
+    )
+    rows = _decode_responses(query.yield_per(chunk_size), json_decoder, decode_workers, chunk_size)
+
+    form_names = DimensionCache(functools.partial(_load_form_names, session), cache_size)
+    user_full_names = DimensionCache(functools.partial(_load_user_full_names, session), cache_size)
+
+    for chunk in more_itertools.chunked(rows, chunk_size):
+        chunk_form_names = form_names.resolve([row[1] for row in chunk])
+        chunk_user_full_names = user_full_names.resolve([row[2] for row in chunk])
+        for (submission_id, form_id, user_id, date_created, responses), form_name, user_full_name in \
+                zip(chunk, chunk_form_names, chunk_user_full_names):
+            yield SubmissionRecord(submission_id, form_id, form_name, user_id, user_full_name, date_created,
+                                   responses)
 
-    return _submission_query(session, related).yield_per(chunk_size)
+    LOGGER.info('Resolved users with %d queries (%d misses) and forms with %d queries (%d misses)',
+                user_full_names.num_loads, user_full_names.num_misses, form_names.num_loads, form_names.num_misses)
@@ -0,0 +1,100 @@
+import contextlib
+import logging
+import time
+
+import sqlalchemy as sa
+import sqlalchemy.orm as sa_orm
+import sqlalchemy.schema as sa_schema
+
+LOGGER = logging.getLogger(__name__)
+
+# parallel workers per index build (capped by the server's max_worker_processes)
+DEFAULT_PARALLEL_WORKERS = 4
+
+# parallel index builds were added in Postgres 11
+PARALLEL_BUILD_MIN_SERVER_VERSION = (11,)
+
+
+def table_indexes(table:sa.Table) -> list:
+    """
+    :param table: SQLAlchemy table
+    :return: secondary indexes declared on the table (in a stable order)
+    """
+    return sorted(table.indexes, key=lambda index: index.name)
+
+
+def drop_indexes(session:sa_orm.Session, indexes:list):
+    """
+    Drops indexes (in the current transaction, a rollback restores them)
+
+    :param session: SQLAlchemy session
+    :param indexes: SQLAlchemy indexes
+    """
+    connection = session.connection()
+    for index in indexes:
+        connection.execute(sa_schema.DropIndex(index))
+
+
+def analyze(session:sa_orm.Session, table:sa.Table):
+    """
+    Updates the planner statistics of a table
+
+    :param session: SQLAlchemy session
+    :param table: SQLAlchemy table
+    """
+    session.connection().execute('ANALYZE {}'.format(table.fullname))
+
+
+def create_indexes(session:sa_orm.Session, indexes:list, parallel_workers:int=DEFAULT_PARALLEL_WORKERS):
+    """
+    Builds indexes using parallel workers where the server supports it
+
+    :param session: SQLAlchemy session
+    :param indexes: SQLAlchemy indexes
+    :param parallel_workers: maximum parallel workers per index build (0 builds serially)
+    """
+    connection = session.connection()
+    if connection.dialect.server_version_info >= PARALLEL_BUILD_MIN_SERVER_VERSION:
+        # SET LOCAL only lasts until the end of the transaction
+        connection.execute('SET LOCAL max_parallel_maintenance_workers = {:d}'.format(parallel_workers))
+
+    for index in indexes:
+        connection.execute(sa_schema.CreateIndex(index))
+
+
+@contextlib.contextmanager
+def deferred_indexes(session:sa_orm.Session, table:sa.Table, parallel_workers:int=DEFAULT_PARALLEL_WORKERS):
+    """
+    Drops the secondary indexes of a table for the duration of a bulk load, then rebuilds them and updates
+    the planner statistics
+
+    Building an index once over all rows is much cheaper than maintaining it row by row.  The indexes are dropped
+    in the current transaction, so a failed load is rolled back together with the drop.
+
+    NOTE: DROP INDEX takes an ACCESS EXCLUSIVE lock on the table, which is held until the transaction ends, so every
+    other connection reading the table (e.g. analyst queries) blocks for the whole load.  Only use this for bulk loads
+    with exclusive use of the table.
+
+    :param session: SQLAlchemy session
+    :param table: SQLAlchemy table
+    :param parallel_workers: maximum parallel workers per index build
+    """
+    indexes = table_indexes(table)
+    drop_indexes(session, indexes)
+
+    try:
+        yield
+    except Exception:
+        # no rebuild: the load failed, and rolling back its transaction restores the dropped indexes
+        LOGGER.warning('Load failed, the %d indexes on %s are restored once the transaction is rolled back',
+                       len(indexes), table.fullname)
+        raise
+
+    # write any pending ORM changes before building the indexes
+    session.flush()
+
+    start_counter = time.perf_counter()
+    create_indexes(session, indexes, parallel_workers=parallel_workers)
+    analyze(session, table)
+    LOGGER.info('Rebuilt %d indexes on %s in %.03f seconds', len(indexes), table.fullname,
+                time.perf_counter() - start_counter)
@@ -1,12 +1,30 @@
 import logging
 
 import more_itertools
+import sqlalchemy as sa
+import sqlalchemy.dialects.postgresql as sa_pg
 import sqlalchemy.orm as sa_orm
 
 from app import models
+from app.etl import indexes, rollups, transformers, wide
+from app.util import pgcopy
 
 LOGGER = logging.getLogger(__name__)
 
+# COPY text format encoders by column type (checked in order, Enum is a String)
+COPY_ENCODERS = [
+    (sa.Boolean, lambda value: 't' if value else 'f'),
+    (sa.Enum, lambda value: value if isinstance(value, str) else value.name),
+    (sa.String, pgcopy.escape_text),
+    ((sa.Date, sa.DateTime), lambda value: value.isoformat()),
+]
+
+# the primary key is generated by the server
+RESPONSE_EVENT_COPY_COLUMNS = [c for c in models.ResponseEvent.__table__.columns if c.name != 'id']
+
+# names of the loaders which insert the response events with COPY
+COPY_LOADERS = ('chunked_copy_loader', 'chunked_passthrough_copy_loader')
+
 
 def log_metrics(loader_func):
     def _wrapper(*args, **kwargs):
@@ -77,3 +95,126 @@ def chunked_bulk_insert_mappings(session: sa_orm.Session, events, chunk_size=Non
         num_events += len(batch)
         session.bulk_insert_mappings(models.ResponseEvent, batch, return_defaults=return_defaults)
     return num_events
+
+
+def _make_copy_encoder(column: sa.Column):
+    encoder = next((e for column_type, e in COPY_ENCODERS if isinstance(column.type, column_type)), str)
+    return lambda value: pgcopy.NULL if value is None else encoder(value)
+
+
+def _encode_copy_lines(events, columns):
+    encoders = [(column.name, _make_copy_encoder(column)) for column in columns]
+    lines = []
+    for event in events:
+        get = transformers.event_getter(event)
+        lines.append('\t'.join([encode(get(name)) for name, encode in encoders]))
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def _make_passthrough_encoder(column: sa.Column):
+    # ids and timestamps are already in their Postgres text form (and never NULL)
+    if isinstance(column.type, (sa_pg.UUID, sa.DateTime)):
+        return str
+    return _make_copy_encoder(column)
+
+
+# encoders of the EventRecord fields (see transformers.transform_submissions)
+PASSTHROUGH_COPY_ENCODERS = [
+    _make_passthrough_encoder(models.ResponseEvent.__table__.columns[name])
+    for name in transformers.EventRecord._fields
+]
+
+
+def _encode_passthrough_lines(records):
+    encoders = PASSTHROUGH_COPY_ENCODERS
+    lines = ['\t'.join([encode(value) for encode, value in zip(encoders, record)]) for record in records]
+    lines.append('')
+    return '\n'.join(lines)
+
+
+@log_metrics
+def chunked_copy_loader(session: sa_orm.Session, events, chunk_size=None):
+    """
+    Loads ResponseEvents or dictionaries with one COPY statement per chunk
+
+    :param session: SQLAlchemy session
+    :param events: response events
+    :param chunk_size: number of events per COPY statement
+    :return: number of events loaded
+    """
+    assert chunk_size
+
+    table = models.ResponseEvent.__table__
+    column_names = [c.name for c in RESPONSE_EVENT_COPY_COLUMNS]
+
+    num_events = 0
+    for batch in more_itertools.chunked(events, chunk_size):
+        num_events += len(batch)
+        pgcopy.copy_from_text(session, table, column_names, _encode_copy_lines(batch, RESPONSE_EVENT_COPY_COLUMNS))
+    return num_events
+
+
+@log_metrics
+def chunked_passthrough_copy_loader(session: sa_orm.Session, events, chunk_size=None):
+    """
+    Loads EventRecords (see transformers.transform_submissions) with one COPY statement per chunk
+
+    :param session: SQLAlchemy session
+    :param events: EventRecords
+    :param chunk_size: number of events per COPY statement
+    :return: number of events loaded
+    """
+    assert chunk_size
+
+    table = models.ResponseEvent.__table__
+    column_names = list(transformers.EventRecord._fields)
+
+    num_events = 0
+    for batch in more_itertools.chunked(events, chunk_size):
+        num_events += len(batch)
+        pgcopy.copy_from_text(session, table, column_names, _encode_passthrough_lines(batch))
+    return num_events
+
+
+def deferred_indexes_loader(session: sa_orm.Session, loader, events, parallel_workers=indexes.DEFAULT_PARALLEL_WORKERS):
+    """
+    Runs a loader with the response event indexes dropped and rebuilds them afterwards (see indexes.deferred_indexes)
+
+    :param session: SQLAlchemy session
+    :param loader: partial loader function
+    :param events: response events
+    :param parallel_workers: maximum parallel workers per index build
+    :return: number of events loaded
+    """
+    with indexes.deferred_indexes(session, models.ResponseEvent.__table__, parallel_workers=parallel_workers):
+        return loader(events)
+
+
+def wide_tables_loader(session: sa_orm.Session, loader, events, chunk_size=wide.DEFAULT_CHUNK_SIZE):
+    """
+    Runs a loader while also maintaining the wide tables of the forms in the same pass (see wide.WideTableWriter)
+
+    :param session: SQLAlchemy session
+    :param loader: partial loader function
+    :param events: response events
+    :param chunk_size: number of wide table rows per INSERT statement
+    :return: number of events loaded
+    """
+    writer = wide.WideTableWriter(session, chunk_size=chunk_size)
+    return loader(writer.tap(events))
+
+
+def rollups_loader(session: sa_orm.Session, loader, events, chunk_size=rollups.DEFAULT_CHUNK_SIZE, metrics=None):
+    """
+    Runs a loader while also maintaining the rollup tables in the same pass (see rollups.RollupWriter)
+
+    :param session: SQLAlchemy session
+    :param loader: partial loader function
+    :param events: response events
+    :param chunk_size: number of response events per rollup update
+    :param metrics: optional RunMetrics instance
+    :return: number of events loaded
+    """
+    writer = rollups.RollupWriter(session, chunk_size=chunk_size, metrics=metrics)
+    return loader(writer.tap(events))
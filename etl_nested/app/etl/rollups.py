@@ -0,0 +1,146 @@
+import logging
+import time
+
+import sqlalchemy as sa
+import sqlalchemy.orm as sa_orm
+
+from app import metrics as run_metrics, models
+from app.etl import transformers
+
+
+LOGGER = logging.getLogger(__name__)
+
+# number of response events per rollup update
+DEFAULT_CHUNK_SIZE = 5000
+
+RESPONSE_EVENTS_TABLE = models.ResponseEvent.__table__
+DAILY_COUNTS_TABLE = models.AnswerDailyCount.__table__
+LATEST_ANSWERS_TABLE = models.LatestAnswer.__table__
+
+# response event columns needed by the rollups
+SOURCE_COLUMNS = ['form_id', 'user_id', 'submission_id', 'submission_created', 'schema_path', 'value']
+
+# a batch of response events is sent as one array per column and turned back into rows with unnest()
+BATCH_SOURCE = """
+    unnest(CAST(:form_id AS uuid[]), CAST(:user_id AS uuid[]), CAST(:submission_id AS uuid[]),
+           CAST(:submission_created AS timestamptz[]), CAST(:schema_path AS text[]), CAST(:value AS text[]))
+    AS batch ({})
+""".format(', '.join(SOURCE_COLUMNS))
+
+# the rollup statements are formatted with the source of the response events: either a batch or the whole table
+
+UPSERT_DAILY_COUNTS = """
+    INSERT INTO {table} (form_id, schema_path, value_hash, day, value, num_answers)
+    SELECT form_id, schema_path, CAST(md5(value) AS uuid), CAST(submission_created AT TIME ZONE 'UTC' AS date),
+           value, count(*)
+    FROM {{source}}
+    GROUP BY form_id, schema_path, value, 4
+    ON CONFLICT (form_id, schema_path, value_hash, day) DO UPDATE
+    SET num_answers = {table}.num_answers + excluded.num_answers
+""".format(table=DAILY_COUNTS_TABLE.fullname)
+
+# DISTINCT ON keeps one row per key, a single INSERT ... ON CONFLICT must not update a row twice
+UPSERT_LATEST_ANSWERS = """
+    INSERT INTO {table} (user_id, schema_path, form_id, submission_id, submission_created, value)
+    SELECT DISTINCT ON (user_id, schema_path) user_id, schema_path, form_id, submission_id, submission_created, value
+    FROM {{source}}
+    ORDER BY user_id, schema_path, submission_created DESC
+    ON CONFLICT (user_id, schema_path) DO UPDATE
+    SET form_id = excluded.form_id, submission_id = excluded.submission_id,
+        submission_created = excluded.submission_created, value = excluded.value
+    WHERE excluded.submission_created >= {table}.submission_created
+""".format(table=LATEST_ANSWERS_TABLE.fullname)
+
+ROLLUP_STATEMENTS = [UPSERT_DAILY_COUNTS, UPSERT_LATEST_ANSWERS]
+
+
+def rebuild(session:sa_orm.Session):
+    """
+    Recomputes the rollups from all response events (e.g. after events were loaded without maintaining them)
+
+    :param session: SQLAlchemy session
+    """
+    connection = session.connection()
+    connection.execute('TRUNCATE {}, {}'.format(DAILY_COUNTS_TABLE.fullname, LATEST_ANSWERS_TABLE.fullname))
+    for statement in ROLLUP_STATEMENTS:
+        connection.execute(statement.format(source=RESPONSE_EVENTS_TABLE.fullname))
+
+
+class RollupWriter:
+    """
+    Maintains the rollup tables from a stream of response events
+
+    The events are buffered per chunk, and each chunk updates every rollup with one set-based upsert.  The rollups
+    are updated in the same transaction as the response events, so they are as fresh as the loaded events.
+    """
+    def __init__(self, session:sa_orm.Session, chunk_size:int=DEFAULT_CHUNK_SIZE,
+                 metrics:run_metrics.RunMetrics=None):
+        """
+        :param session: SQLAlchemy session
+        :param chunk_size: number of response events per rollup update
+        :param metrics: optional RunMetrics instance, the updates are charged to the rollups stage
+        """
+        self.session = session
+        self.chunk_size = chunk_size
+        self.metrics = metrics
+        self.num_events = 0
+        self.seconds = 0.0
+
+        self._statements = [sa.text(s.format(source=BATCH_SOURCE)) for s in ROLLUP_STATEMENTS]
+        self._batch = {c: [] for c in SOURCE_COLUMNS}
+        self._batch_columns = [(c, self._batch[c].append) for c in SOURCE_COLUMNS]
+
+    def _write(self):
+        parameters = self._batch
+        num_events = len(parameters['value'])
+        if not num_events:
+            return
+
+        # UUIDs are sent as text (CAST to uuid[] in the statements)
+        for c in ('form_id', 'user_id', 'submission_id'):
+            parameters[c][:] = [str(v) for v in parameters[c]]
+
+        start_counter = time.perf_counter()
+        connection = self.session.connection()
+        for statement in self._statements:
+            connection.execute(statement, parameters)
+        self.seconds += time.perf_counter() - start_counter
+        self.num_events += num_events
+
+        for values in parameters.values():
+            values.clear()
+
+    def flush(self):
+        """
+        Applies the buffered response events to the rollups
+        """
+        if self.metrics is None:
+            self._write()
+        else:
+            with self.metrics.stage(run_metrics.ROLLUPS_STAGE):
+                self._write()
+
+    def add(self, event):
+        """
+        Buffers a response event
+
+        :param event: ResponseEvent or dictionary
+        """
+        get = transformers.event_getter(event)
+        for column, append in self._batch_columns:
+            append(get(column))
+        if len(self._batch['value']) >= self.chunk_size:
+            self.flush()
+
+    def tap(self, events):
+        """
+        Passes response events through while maintaining the rollups
+
+        :param events: response events
+        :return: generator of the same response events
+        """
+        for event in events:
+            self.add(event)
+            yield event
+        self.flush()
+        LOGGER.info('Updated rollups with %d response events in %.03f seconds', self.num_events, self.seconds)
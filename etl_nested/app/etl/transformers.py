@@ -1,9 +1,11 @@
 import datetime
+import decimal
 import functools
 import logging
 from collections import namedtuple
 
 from app import constants, models
+from app.util import json as json_util
 from app.util.timestamps import utc_now
 
 
@@ -13,6 +15,20 @@ NODE_PATH_CACHE_SIZE = 16  # should be a power of 2
 
 NodeInfo = namedtuple('NodeInfo', ['answer_type', 'tag'])
 
+# parse the string values of response events (see _extract_answers) into native values
+VALUE_PARSERS = {
+    constants.AnswerType.number: decimal.Decimal,
+    constants.AnswerType.boolean: lambda value: value == 'true',
+    constants.AnswerType.date: lambda value: datetime.datetime.strptime(value, '%Y-%m-%d').date(),
+}
+
+# ResponseEvent column holding the native value of an answer type (text answers only have 'value')
+TYPED_VALUE_COLUMNS = {
+    constants.AnswerType.number: 'value_number',
+    constants.AnswerType.boolean: 'value_boolean',
+    constants.AnswerType.date: 'value_date',
+}
+
 
 def map_nested(node:dict, gen_items, gen_children):
     """
@@ -57,14 +73,13 @@ def _make_path_str(path: list) -> str:
     return '.'.join(path)
 
 
-def _load_node_path_map(session, form_id) -> dict:
+def make_node_path_map(form_schema:dict) -> dict:
     """
-    Loads and constructs a information map used for transforming nested object nodes
+    Constructs a information map used for transforming nested object nodes
 
     NOTE: This is the first application of our generic map_nested() routine
 
-    :param session: SQLAlchemy session
-    :param form_id: Form.id
+    :param form_schema: Form.schema
     :returns: dictionary of node path strings to NodeInfo instances
     """
 
@@ -96,13 +111,54 @@ def _load_node_path_map(session, form_id) -> dict:
                 if child_slug:
                     yield path + [child_slug], child
 
-    form_schema = session.query(models.Form.schema).filter_by(id=form_id).scalar()
     return {
         path: NodeInfo(answer_type, tag)
         for path, answer_type, tag in map_nested(form_schema, _node_info, _children)
     }
 
 
+# names of the answer types as stored by Postgres (Enum.name is a comparatively slow descriptor)
+ANSWER_TYPE_NAMES = {answer_type: answer_type.name for answer_type in constants.AnswerType}
+
+EventRecord = namedtuple(
+    'EventRecord',
+    ['form_id', 'form_name', 'user_id', 'user_full_name', 'submission_id', 'submission_created', 'processed_on',
+     'schema_path', 'value', 'value_number', 'value_boolean', 'value_date', 'answer_type', 'tag']
+)
+EventRecord.__doc__ = """
+Response event produced in passthrough mode: ids and timestamps are text, answer_type is the name of the answer type
+"""
+
+
+def parse_typed_value(answer_type:constants.AnswerType, value:str):
+    """
+    Parses the string value of an answer into the native value of its answer type
+
+    :param answer_type: answer type
+    :param value: string value (see _extract_answers)
+    :returns: native value, or None for text answers and values which do not match their answer type
+    """
+    parser = VALUE_PARSERS.get(answer_type)
+    if parser is None:
+        return None
+    try:
+        return parser(value)
+    except (ValueError, ArithmeticError):
+        return None
+
+
+def _load_node_path_map(session, form_id) -> dict:
+    """
+    Loads a form schema and constructs its node path map (see make_node_path_map)
+
+    :param session: SQLAlchemy session
+    :param form_id: Form.id
+    :returns: dictionary of node path strings to NodeInfo instances
+    """
+    form_schema = session.query(models.Form.schema).filter_by(id=form_id).scalar()
+    return make_node_path_map(form_schema)
+
+
 def get_node_path_map_cache(session):
     """
     Returns an LRU cached function which provides a node path map for a form
@@ -123,21 +179,41 @@ def get_node_path_map_cache(session):
     return cached_wrapper(_get_node_path_map)
 
 
-def transform_submissions(session, submissions, processed_on:datetime.datetime=None, to_dict=False):
+def transform_submissions(session, submissions, processed_on:datetime.datetime=None, to_dict=False,
+                          passthrough=False, streaming=False):
     """
     Transforms Submissions into ResponseEvents
 
     :param session: SQLAlchemy session
     :param submissions: submissions generator
     :param processed_on: optional timestamp to apply to 'processed_on' column of all ResponseEvents
+    :param to_dict: generate dictionaries instead of ResponseEvents
+    :param passthrough: transform SubmissionRecords (see extractors.passthrough_extractor) into EventRecords
+    :param streaming: in passthrough mode, scan the answers from the raw JSON text of the responses
+        (see extractors.passthrough_extractor with raw_responses) instead of walking decoded documents
     :return: generator of ResponseEvents
     """
+    assert passthrough or not streaming, 'streaming requires passthrough'
+
     processed_on = processed_on or utc_now()
     get_node_path_map = get_node_path_map_cache(session)
     num_submissions = 0
-    for submission in submissions:
-        yield from _transform_submission(get_node_path_map, submission, processed_on, to_dict)
-        num_submissions += 1
+    if passthrough:
+        get_container_paths = None
+        if streaming:
+            get_container_paths = functools.lru_cache(maxsize=NODE_PATH_CACHE_SIZE)(
+                lambda form_id: json_util.make_container_paths(get_node_path_map(form_id))
+            )
+
+        # text, like the ids and timestamps of the records
+        processed_on = processed_on.isoformat()
+        for submission in submissions:
+            yield from _transform_record(get_node_path_map, submission, processed_on, get_container_paths)
+            num_submissions += 1
+    else:
+        for submission in submissions:
+            yield from _transform_submission(get_node_path_map, submission, processed_on, to_dict)
+            num_submissions += 1
     LOGGER.info('Transformed %d JSON submissions', num_submissions)
 
 
@@ -196,16 +272,69 @@ def _transform_submission(f_get_node_path_map,
     else:
         output_mapper = models.ResponseEvent
 
+    number, boolean, date = constants.AnswerType.number, constants.AnswerType.boolean, constants.AnswerType.date
     for path, answer in map_nested(submission.responses, f_extract_answers, _dict_children):
+        answer_type = answer['answer_type']
+        typed_value = answer['typed_value']
+
+        # all typed value columns are always set so that loaders can batch the events into a single statement
         yield output_mapper(
             schema_path=path,
             value=answer['value'],
+            value_number=typed_value if answer_type == number else None,
+            value_boolean=typed_value if answer_type == boolean else None,
+            value_date=typed_value if answer_type == date else None,
             tag=answer['tag'],
-            answer_type=answer['answer_type'],
+            answer_type=answer_type,
             **common_kwargs
         )
 
 
+def event_getter(event):
+    """
+    :param event: ResponseEvent, dictionary or EventRecord (see transform_submissions)
+    :return: function returning the value of a column of the event (or None)
+    """
+    if isinstance(event, dict):
+        return event.get
+    if isinstance(event, EventRecord):
+        return functools.partial(getattr, event)
+    return event.__dict__.get
+
+
+def _transform_record(f_get_node_path_map, record, processed_on:str, f_get_container_paths=None):
+    """
+    Passthrough version of _transform_submission: the ids and timestamps of the SubmissionRecord are passed on as
+    they are, and answer types are mapped to their names with a lookup table
+
+    With f_get_container_paths, the responses are raw JSON text which is scanned instead (see _stream_answers)
+    """
+    common_values = (record.form_id, record.form_name, record.user_id, record.user_full_name, record.id,
+                     record.date_created, processed_on)
+
+    node_map = f_get_node_path_map(record.form_id)
+    if f_get_container_paths:
+        answers = _stream_answers(record.responses, node_map, f_get_container_paths(record.form_id))
+    else:
+        answers = map_nested(record.responses, functools.partial(_extract_answers, node_map=node_map),
+                             _dict_children)
+
+    number, boolean, date = constants.AnswerType.number, constants.AnswerType.boolean, constants.AnswerType.date
+    for path, answer in answers:
+        answer_type = answer['answer_type']
+        typed_value = answer['typed_value']
+        yield EventRecord(
+            *common_values,
+            path,
+            answer['value'],
+            typed_value if answer_type == number else None,
+            typed_value if answer_type == boolean else None,
+            typed_value if answer_type == date else None,
+            ANSWER_TYPE_NAMES[answer_type],
+            answer['tag']
+        )
+
+
 def _dict_children(node: dict, path: list):
     """ extracts child trees from a plain python dictionary """
     for k, v in node.items():
@@ -213,6 +342,19 @@ def _dict_children(node: dict, path: list):
             yield path + [k], v
 
 
+def _make_answer(node_info:NodeInfo, value) -> dict:
+    """ converts a scalar answer value to response event arguments """
+    # NOTE: for this workshop, we assume all date answer types are properly formatted
+    if node_info.answer_type == constants.AnswerType.boolean:
+        str_value = 'true' if value else 'false'
+        typed_value = bool(value)
+    else:
+        str_value = str(value)
+        typed_value = parse_typed_value(node_info.answer_type, str_value)
+
+    return {'answer_type': node_info.answer_type, 'value': str_value, 'typed_value': typed_value, 'tag': node_info.tag}
+
+
 def _extract_answers(node: dict, path: list, node_map=None):
     """ converts scalar dictionary items to response event arguments reflecting answers """
     assert node_map
@@ -223,10 +365,16 @@ def _extract_answers(node: dict, path: list, node_map=None):
             node_info = node_map.get(path_str)
 
             if node_info:
-                # NOTE: for this workshop, we assume all date answer types are properly formatted
-                if node_info.answer_type == constants.AnswerType.boolean:
-                    str_value = 'true' if v else 'false'
-                else:
-                    str_value = str(v)
+                yield path_str, _make_answer(node_info, v)
+
 
-                yield path_str, {'answer_type': node_info.answer_type, 'value': str_value, 'tag': node_info.tag}
+def _stream_answers(text:str, node_map:dict, container_paths:frozenset):
+    """
+    Version of map_nested() with _extract_answers for raw JSON text: the answers are extracted from the text of the
+    responses token by token (see iter_scalars), and keys which are not in the form schema are skipped without being
+    decoded
+
+    The answers are the same, but in document order rather than pre-order.
+    """
+    for path_str, value in json_util.iter_scalars(text, node_map, container_paths):
+        yield path_str, _make_answer(node_map[path_str], value)
@@ -0,0 +1,224 @@
+import collections
+import hashlib
+import logging
+import re
+import uuid
+from collections import namedtuple
+
+import sqlalchemy as sa
+import sqlalchemy.dialects.postgresql as sa_pg
+import sqlalchemy.orm as sa_orm
+
+from app import constants, models
+from app.etl import transformers
+
+
+LOGGER = logging.getLogger(__name__)
+
+# maximum length of Postgres identifiers (longer ones are truncated by the server)
+MAX_IDENTIFIER_LEN = 63
+
+WIDE_TABLE_PREFIX = 'form'
+
+# number of rows per INSERT statement
+DEFAULT_CHUNK_SIZE = 500
+
+ANSWER_COLUMN_TYPES = {
+    constants.AnswerType.number: sa.Numeric,
+    constants.AnswerType.text: sa.Text,
+    constants.AnswerType.boolean: sa.Boolean,
+    constants.AnswerType.date: sa.Date,
+}
+
+# columns of every wide table, copied from the response events of a submission
+SUBMISSION_COLUMNS = ['submission_id', 'submission_created', 'user_id', 'user_full_name', 'processed_on']
+
+_REGEX_INVALID_IDENTIFIER_CHARS = re.compile(r'[^a-z0-9_]')
+
+WideTable = namedtuple('WideTable', ['table', 'columns'])
+WideTable.__doc__ = """
+Wide table of a form: SQLAlchemy table and the mapping of schema paths to (column name, response event column)
+"""
+
+
+def make_identifier(name:str, reserved=()) -> str:
+    """
+    Converts a name into a valid Postgres identifier
+
+    Identifiers which are too long or reserved are made unique with a hash suffix.
+
+    :param name: name (e.g. a schema path)
+    :param reserved: identifiers which must not be returned
+    :return: lower case identifier
+    """
+    identifier = _REGEX_INVALID_IDENTIFIER_CHARS.sub('_', name.lower())
+    if len(identifier) > MAX_IDENTIFIER_LEN or identifier in reserved:
+        suffix = hashlib.sha1(name.encode('utf-8')).hexdigest()[:8]
+        identifier = '{}_{}'.format(identifier[:MAX_IDENTIFIER_LEN - len(suffix) - 1], suffix)
+    return identifier
+
+
+def make_table_name(form_id, form_name:str) -> str:
+    """
+    :param form_id: Form.id (UUID or its text, e.g. from passthrough response events)
+    :param form_name: Form.name
+    :return: name of the wide table of a form (the form id keeps it unique)
+    """
+    suffix = uuid.UUID(str(form_id)).hex[:8]
+    prefix = make_identifier('{}_{}'.format(WIDE_TABLE_PREFIX, form_name))
+    return '{}_{}'.format(prefix[:MAX_IDENTIFIER_LEN - len(suffix) - 1], suffix)
+
+
+def make_wide_table(metadata:sa.MetaData, form_id, form_name:str, node_map:dict) -> WideTable:
+    """
+    Defines the wide table of a form: one row per submission and one typed column per schema path
+
+    :param metadata: SQLAlchemy metadata
+    :param form_id: Form.id
+    :param form_name: Form.name
+    :param node_map: node path map of the form schema (see transformers.make_node_path_map)
+    :return: WideTable
+    """
+    columns = {}
+    reserved = set(SUBMISSION_COLUMNS)
+    for path in sorted(node_map):
+        column_name = make_identifier(path.replace('.', '__'), reserved)
+        reserved.add(column_name)
+        columns[path] = (column_name, transformers.TYPED_VALUE_COLUMNS.get(node_map[path].answer_type, 'value'))
+
+    table = sa.Table(
+        make_table_name(form_id, form_name),
+        metadata,
+        sa.Column('submission_id', sa_pg.UUID(as_uuid=True), primary_key=True),
+        sa.Column('submission_created', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('user_id', sa_pg.UUID(as_uuid=True), nullable=False),
+        sa.Column('user_full_name', sa.Text, nullable=False),
+        sa.Column('processed_on', sa.DateTime(timezone=True), nullable=False),
+        *(sa.Column(columns[path][0], ANSWER_COLUMN_TYPES[node_map[path].answer_type]) for path in sorted(node_map)),
+        schema=models.SCHEMAS['dwh']
+    )
+    return WideTable(table, columns)
+
+
+def ensure_wide_table(connection:sa.engine.Connection, table:sa.Table):
+    """
+    Creates a wide table or adds the columns of new schema paths to it
+
+    :param connection: SQLAlchemy connection
+    :param table: SQLAlchemy table
+    """
+    if not connection.dialect.has_table(connection, table.name, schema=table.schema):
+        table.create(bind=connection)
+        return
+
+    existing = {c['name'] for c in sa.inspect(connection).get_columns(table.name, schema=table.schema)}
+    preparer = connection.dialect.identifier_preparer
+    for column in table.columns:
+        if column.name not in existing:
+            connection.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                preparer.format_table(table), preparer.quote(column.name),
+                column.type.compile(dialect=connection.dialect)))
+
+
+class WideTableWriter:
+    """
+    Maintains the wide tables of forms from a stream of response events
+
+    Response events of a submission are consecutive (see transformers.transform_submissions), so each submission
+    becomes one row of the wide table of its form.  Rows are upserted in chunks, reprocessing a submission
+    replaces its row.
+    """
+    def __init__(self, session:sa_orm.Session, chunk_size:int=DEFAULT_CHUNK_SIZE):
+        """
+        :param session: SQLAlchemy session
+        :param chunk_size: number of rows per INSERT statement
+        """
+        self.session = session
+        self.chunk_size = chunk_size
+        self.num_rows = 0
+
+        self._metadata = sa.MetaData()
+        self._get_node_path_map = transformers.get_node_path_map_cache(session)
+        self._wide_tables = {}
+        self._pending = collections.defaultdict(list)
+        self._row = None
+        self._row_form_id = None
+
+    def _wide_table(self, form_id, form_name:str) -> WideTable:
+        wide_table = self._wide_tables.get(form_id)
+        if wide_table is None:
+            wide_table = make_wide_table(self._metadata, form_id, form_name, self._get_node_path_map(form_id))
+            ensure_wide_table(self.session.connection(), wide_table.table)
+            self._wide_tables[form_id] = wide_table
+        return wide_table
+
+    def _finish_row(self):
+        if self._row is None:
+            return
+
+        rows = self._pending[self._row_form_id]
+        rows.append(self._row)
+        self._row = None
+        if len(rows) >= self.chunk_size:
+            self._write(self._row_form_id)
+
+    def _write(self, form_id):
+        rows = self._pending.pop(form_id, None)
+        if not rows:
+            return
+
+        table = self._wide_tables[form_id].table
+
+        # every row has a value for every column so that they can be sent in one executemany()
+        for row in rows:
+            for column in table.columns:
+                row.setdefault(column.name, None)
+
+        statement = sa_pg.insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.submission_id],
+            set_={c.name: statement.excluded[c.name] for c in table.columns if c.name != 'submission_id'}
+        )
+        self.session.connection().execute(statement, rows)
+        self.num_rows += len(rows)
+
+    def add(self, event):
+        """
+        Adds a response event to the row of its submission
+
+        :param event: ResponseEvent or dictionary
+        """
+        get = transformers.event_getter(event)
+        submission_id = get('submission_id')
+        if self._row is None or self._row['submission_id'] != submission_id:
+            self._finish_row()
+            form_id = get('form_id')
+            self._wide_table(form_id, get('form_name'))
+            self._row_form_id = form_id
+            self._row = {c: get(c) for c in SUBMISSION_COLUMNS}
+
+        column = self._wide_tables[self._row_form_id].columns.get(get('schema_path'))
+        if column:
+            column_name, event_column = column
+            self._row[column_name] = get(event_column)
+
+    def flush(self):
+        """
+        Writes all pending rows
+        """
+        self._finish_row()
+        for form_id in list(self._pending):
+            self._write(form_id)
+
+    def tap(self, events):
+        """
+        Passes response events through while adding them to the wide tables
+
+        :param events: response events
+        :return: generator of the same response events
+        """
+        for event in events:
+            self.add(event)
+            yield event
+        self.flush()
+        LOGGER.info('Upserted %d rows into %d wide tables', self.num_rows, len(self._wide_tables))
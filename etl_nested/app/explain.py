@@ -0,0 +1,233 @@
+import json
+import logging
+import re
+import time
+from collections import namedtuple
+
+import sqlalchemy.event as sa_event
+import sqlalchemy.orm as sa_orm
+
+from app import metrics as run_metrics
+from app.etl import loaders
+
+
+LOGGER = logging.getLogger(__name__)
+
+# stages whose statements are captured
+CAPTURED_STAGES = (run_metrics.EXTRACTOR_STAGE, run_metrics.LOADER_STAGE)
+
+# statements which can be explained (e.g. not COPY, SET or ANALYZE)
+_REGEX_EXPLAINABLE = re.compile(r'\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b', re.IGNORECASE)
+
+CapturedStatement = namedtuple('CapturedStatement', ['stage', 'statement', 'parameters', 'seconds'])
+CapturedStatement.__doc__ = """
+Slowest statement of a stage as sent to the DBAPI cursor (the parameters of the first row of an executemany())
+"""
+
+ExplainedStatement = namedtuple('ExplainedStatement', ['captured', 'plan', 'summary'])
+ExplainedStatement.__doc__ = """
+Captured statement with its EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) output and the summary of the plan
+"""
+
+
+class PlanCapture:
+    """
+    Captures the slowest explainable statement executed in each of the extractor and loader stages of a run
+
+    For the extractor this is its main query, and for the loader a sample batch.  The statements are explained after
+    the run (see explain_captured), so that the run itself is timed as usual.
+
+    NOTE: COPY statements run on the DBAPI cursor and cannot be explained, so COPY loaders have no loader statement
+    to explain (see has_loader_plan)
+    """
+    def __init__(self, metrics:run_metrics.RunMetrics, stages=CAPTURED_STAGES):
+        """
+        :param metrics: RunMetrics instance of the run, which tracks the current stage
+        :param stages: names of the stages whose statements are captured
+        """
+        self.metrics = metrics
+        self.stages = stages
+        self.captured = {}
+
+        self._engines = []
+        self._statement_start = None
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self._statement_start = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - self._statement_start
+        stage = self.metrics.current_stage
+        if stage not in self.stages or not _REGEX_EXPLAINABLE.match(statement):
+            return
+
+        current = self.captured.get(stage)
+        if current is None or elapsed > current.seconds:
+            if executemany:
+                parameters = parameters[0] if parameters else None
+            self.captured[stage] = CapturedStatement(stage, statement, parameters, elapsed)
+
+    def install(self, engine):
+        """
+        Starts capturing the statements executed by an engine
+
+        :param engine: SQLAlchemy engine
+        """
+        sa_event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        sa_event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        self._engines.append(engine)
+
+    def uninstall(self):
+        """
+        Stops capturing on all engines
+        """
+        for engine in self._engines:
+            sa_event.remove(engine, 'before_cursor_execute', self._before_cursor_execute)
+            sa_event.remove(engine, 'after_cursor_execute', self._after_cursor_execute)
+        self._engines = []
+
+
+def has_loader_plan(processor_config:dict) -> bool:
+    """
+    :param processor_config: processor configuration dictionary
+    :return: whether the loader inserts the response events with statements which can be explained (i.e. not COPY)
+    """
+    return processor_config['loader']['name'] not in loaders.COPY_LOADERS
+
+
+def _walk_plan(node:dict):
+    yield node
+    for child in node.get('Plans', ()):
+        yield from _walk_plan(child)
+
+
+def summarize_plan(plan:list) -> dict:
+    """
+    Summarizes EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) output: timings, buffer hits and reads, and the estimated
+    and actual rows of every plan node
+
+    :param plan: EXPLAIN output
+    :return: JSON serializable dictionary
+    """
+    root = plan[0]
+    top_node = root['Plan']
+
+    nodes = []
+    max_misestimate = 1.0
+    for node in _walk_plan(top_node):
+        estimated_rows = node.get('Plan Rows', 0)
+        actual_rows = node.get('Actual Rows', 0) * node.get('Actual Loops', 1)
+        # how many times more or fewer rows there were than estimated (per loop, like 'Plan Rows')
+        misestimate = max(estimated_rows, 1) / max(node.get('Actual Rows', 0), 1)
+        max_misestimate = max(max_misestimate, misestimate, 1 / misestimate)
+        nodes.append({
+            'node_type': node['Node Type'],
+            'relation': node.get('Relation Name'),
+            'index': node.get('Index Name'),
+            'estimated_rows': estimated_rows,
+            'actual_rows': actual_rows,
+            'loops': node.get('Actual Loops', 1),
+            'shared_hit_blocks': node.get('Shared Hit Blocks', 0),
+            'shared_read_blocks': node.get('Shared Read Blocks', 0),
+        })
+
+    return {
+        'planning_ms': root.get('Planning Time'),
+        'execution_ms': root.get('Execution Time'),
+        # buffer counts of a node include those of its children
+        'shared_hit_blocks': top_node.get('Shared Hit Blocks', 0),
+        'shared_read_blocks': top_node.get('Shared Read Blocks', 0),
+        'max_row_misestimate': max_misestimate,
+        'nodes': nodes,
+    }
+
+
+def explain(session:sa_orm.Session, captured:CapturedStatement) -> ExplainedStatement:
+    """
+    Runs EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) for a captured statement
+
+    The statement is executed inside a savepoint which is rolled back, so explaining a loader batch does not insert
+    its rows again.
+
+    :param session: SQLAlchemy session
+    :param captured: CapturedStatement
+    :return: ExplainedStatement
+    """
+    savepoint = session.begin_nested()
+    try:
+        # the captured statement is in the DBAPI's parameter style, so it is executed on the DBAPI cursor
+        cursor = session.connection().connection.cursor()
+        try:
+            cursor.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + captured.statement, captured.parameters)
+            plan = cursor.fetchone()[0]
+        finally:
+            cursor.close()
+    finally:
+        savepoint.rollback()
+
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return ExplainedStatement(captured, plan, summarize_plan(plan))
+
+
+def explain_captured(session:sa_orm.Session, plan_capture:PlanCapture) -> list:
+    """
+    Explains the captured statements of all stages
+
+    :param session: SQLAlchemy session
+    :param plan_capture: PlanCapture used during the run
+    :return: list of ExplainedStatement
+    """
+    explained = []
+    for stage in plan_capture.stages:
+        captured = plan_capture.captured.get(stage)
+        if captured is None:
+            LOGGER.warning('No statement to explain for the %s stage', stage)
+            continue
+        explained.append(explain(session, captured))
+    return explained
+
+
+def report(explained:list) -> list:
+    """
+    :param explained: list of ExplainedStatement
+    :return: JSON serializable summaries for the run metrics report
+    """
+    return [
+        {'stage': e.captured.stage, 'statement': e.captured.statement, **e.summary}
+        for e in explained
+    ]
+
+
+def log_summaries(explained:list):
+    """
+    Logs a table of the plan summaries
+
+    :param explained: list of ExplainedStatement
+    """
+    lines = ['{:<10} {:>12} {:>12} {:>12} {:>14}'.format('stage', 'time (ms)', 'hit blocks', 'read blocks',
+                                                         'misestimate')]
+    for e in explained:
+        lines.append('{:<10} {:>12.3f} {:>12d} {:>12d} {:>13.1f}x'.format(
+            e.captured.stage, e.summary['execution_ms'] or 0.0, e.summary['shared_hit_blocks'],
+            e.summary['shared_read_blocks'], e.summary['max_row_misestimate']))
+    LOGGER.info('Query plans\n%s', '\n'.join(lines))
+
+
+def write_plans(explained:list, pathname:str):
+    """
+    Writes the full plans as a JSON file
+
+    :param explained: list of ExplainedStatement
+    :param pathname: output filename
+    """
+    with open(pathname, 'w') as f:
+        json.dump([
+            {
+                'stage': e.captured.stage,
+                'statement': e.captured.statement,
+                'parameters': e.captured.parameters,
+                'plan': e.plan,
+            } for e in explained
+        ], f, indent=2, sort_keys=True, default=str)
+    LOGGER.info('Wrote query plans to %s', pathname)
@@ -15,6 +15,9 @@ from faker import Faker
 
 FAKE = Faker()
 
+# bump whenever make_source_data() generates different data (invalidates existing scenario templates)
+GENERATOR_VERSION = 1
+
 
 class FormFactory(factory.Factory):
     class Meta:
@@ -90,6 +93,13 @@ class SubmissionFactory(factory.Factory):
         return self.user.id
 
 
+def _typed_value(answer_type:constants.AnswerType, value:str, column:str):
+    # the native value of the string value, but only in the typed value column of the answer type
+    if transformers.TYPED_VALUE_COLUMNS.get(answer_type) != column:
+        return None
+    return transformers.parse_typed_value(answer_type, value)
+
+
 class ResponseEventFactory(factory.Factory):
     class Meta:
         model = models.ResponseEvent
@@ -110,6 +120,18 @@ class ResponseEventFactory(factory.Factory):
     def value(self):
         return KEY_VALUE_FAKERS.make_fake_value(self.answer_type)
 
+    @factory.lazy_attribute
+    def value_number(self):
+        return _typed_value(self.answer_type, self.value, 'value_number')
+
+    @factory.lazy_attribute
+    def value_boolean(self):
+        return _typed_value(self.answer_type, self.value, 'value_boolean')
+
+    @factory.lazy_attribute
+    def value_date(self):
+        return _typed_value(self.answer_type, self.value, 'value_date')
+
 
 SourceDataMetrics = namedtuple(
     'SourceDataMetrics',
@@ -161,12 +183,14 @@ def make_source_data(session: sa_orm.Session, metrics: SourceDataMetrics, availa
     session.flush()
 
 
-def make_processor(session: sa_orm.Session, processor_config: dict, use_memory_profiler:bool=False):
+def make_processor(session: sa_orm.Session, processor_config: dict, use_memory_profiler:bool=False,
+                   metrics=None):
     """
     Factory method to create a processor using partial function
 
     :param session: SQLAlchemy session
     :param processor_config: processor configuration dictionary
+    :param metrics: optional RunMetrics instance passed to the processor
     :return: processor function
     """
     extractor_config = processor_config['extractor']
@@ -176,6 +200,12 @@ def make_processor(session: sa_orm.Session, processor_config: dict, use_memory_p
     loader_config = processor_config['loader']
     loader_func = getattr(loaders, loader_config['name'])
     loader = functools.partial(loader_func, session, **loader_config.get('kwargs', {}))
+    if loader_config.get('wide_tables'):
+        loader = functools.partial(loaders.wide_tables_loader, session, loader)
+    if loader_config.get('rollups'):
+        loader = functools.partial(loaders.rollups_loader, session, loader, metrics=metrics)
+    if loader_config.get('defer_indexes'):
+        loader = functools.partial(loaders.deferred_indexes_loader, session, loader)
 
     transformer_config = processor_config['transformer']
     transformer = functools.partial(transformers.transform_submissions, session, **transformer_config)
@@ -185,16 +215,17 @@ def make_processor(session: sa_orm.Session, processor_config: dict, use_memory_p
         from memory_profiler import profile
         processor_func = profile(processor_func)
 
-    return functools.partial(processor_func, extractor, transformer, loader)
+    return functools.partial(processor_func, extractor, transformer, loader, metrics=metrics)
 
 
-def make_response(get_node_path_map, form_id):
+def make_response(get_node_path_map, form_id, make_fake_value=JSON_FAKERS.make_fake_value):
     """
     Construct a fake dictionary response (to be stored as JSON) for a form.  This requires the get_node_path_map
     partial function to retrieve the node path map
 
     :param get_node_path_map: return the node path map (requires only the form_id as a parameter)
     :param form_id: form id
+    :param make_fake_value: returns a fake JSON value given an answer type
     :return: dict
     """
 
@@ -213,6 +244,6 @@ def make_response(get_node_path_map, form_id):
             d = d[c]
 
         # generate the fake leaf value and inject it
-        d[leaf_key] = JSON_FAKERS.make_fake_value(node_info.answer_type)
+        d[leaf_key] = make_fake_value(node_info.answer_type)
 
     return responses
@@ -0,0 +1,244 @@
+import datetime
+import itertools
+import json
+import logging
+import multiprocessing
+import random
+import uuid
+from collections import namedtuple
+
+import sqlalchemy.orm as sa_orm
+
+from app import models, factories
+from app.etl import transformers
+from app.util import pgcopy
+from app.util.timestamps import UTC_TZ
+
+
+LOGGER = logging.getLogger(__name__)
+
+# bump whenever make_source_data_fast() generates different data (invalidates existing scenario templates)
+GENERATOR_VERSION = 1
+
+# number of precomputed fake values per answer type
+DEFAULT_POOL_SIZE = 1000
+
+# number of submissions generated by a worker per task (and sent to Postgres per COPY)
+DEFAULT_CHUNK_SIZE = 10000
+
+# range of submission timestamps
+DATE_CREATED_START = datetime.datetime(2015, 1, 1, tzinfo=UTC_TZ)
+DATE_CREATED_DAYS = 2 * 365
+
+SUBMISSION_COPY_COLUMNS = ('id', 'form_id', 'user_id', 'responses', 'date_created')
+USER_COPY_COLUMNS = ('id', 'given_name', 'family_name')
+
+
+ResponseTemplate = namedtuple('ResponseTemplate', ['fragments', 'answer_types'])
+ResponseTemplate.__doc__ = """
+Precompiled JSON text of a form's responses: the answer values (one per answer type) are interleaved with the
+literal fragments, so that rendering a response never builds a dictionary or calls json.dumps()
+"""
+
+ValuePools = namedtuple('ValuePools', ['answers', 'dates_created'])
+
+
+def _copy_escape(text:str) -> str:
+    """ escapes text for the Postgres COPY text format (JSON text never contains raw tabs or newlines) """
+    return text.replace('\\', '\\\\')
+
+
+def compile_response_template(node_map:dict) -> ResponseTemplate:
+    """
+    Precompiles the JSON text of a form's responses from its node path map
+
+    :param node_map: node path map (see transformers.make_node_path_map)
+    :return: ResponseTemplate
+    """
+    # build the tree once, with answer types as leaves
+    tree = {}
+    for path, node_info in node_map.items():
+        components = path.split('.')
+        d = tree
+        for c in components[:-1]:
+            d = d.setdefault(c, {})
+        d[components[-1]] = node_info.answer_type
+
+    fragments = []
+    answer_types = []
+    buffer = []
+
+    def _emit(node:dict):
+        buffer.append('{')
+        for i, (key, value) in enumerate(node.items()):
+            if i:
+                buffer.append(', ')
+            buffer.append(_copy_escape(json.dumps(key)) + ': ')
+            if isinstance(value, dict):
+                _emit(value)
+            else:
+                fragments.append(''.join(buffer))
+                buffer.clear()
+                answer_types.append(value)
+        buffer.append('}')
+
+    _emit(tree)
+    fragments.append(''.join(buffer))
+    return ResponseTemplate(fragments, answer_types)
+
+
+def render_response(template:ResponseTemplate, pools:ValuePools, rng:random.Random) -> str:
+    """
+    Renders a response as COPY-escaped JSON text using values drawn from the value pools
+
+    :param template: precompiled response template
+    :param pools: precomputed values
+    :param rng: random number generator
+    :return: JSON text
+    """
+    values = [pools.answers[t][rng.randrange(len(pools.answers[t]))] for t in template.answer_types]
+    return ''.join(itertools.chain.from_iterable(zip(template.fragments, values))) + template.fragments[-1]
+
+
+def make_value_pools(pool_size:int=DEFAULT_POOL_SIZE) -> ValuePools:
+    """
+    Precomputes JSON encoded (and COPY escaped) fake values for each answer type and submission timestamps
+
+    :param pool_size: number of values per answer type
+    """
+    answers = {
+        answer_type: [
+            _copy_escape(json.dumps(factories.JSON_FAKERS.make_fake_value(answer_type)))
+            for _ in range(pool_size)
+        ]
+        for answer_type in factories.JSON_FAKERS.fakers
+    }
+    dates_created = [
+        (DATE_CREATED_START + datetime.timedelta(seconds=random.randrange(DATE_CREATED_DAYS * 86400))).isoformat()
+        for _ in range(pool_size)
+    ]
+    return ValuePools(answers, dates_created)
+
+
+def _make_uuid(rng:random.Random) -> str:
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+# state of worker processes (set once per worker by _init_worker)
+_worker_state = None
+
+
+def _init_worker(seed:int, forms:list, user_ids:list, pools:ValuePools):
+    global _worker_state
+    _worker_state = (seed, forms, user_ids, pools)
+
+
+def _generate_submissions_chunk(chunk:tuple) -> str:
+    """
+    Generates a chunk of submissions as COPY text (executed in worker processes)
+
+    :param chunk: (chunk index, first submission number, number of submissions)
+    """
+    seed, forms, user_ids, pools = _worker_state
+    chunk_index, first, count = chunk
+
+    # seeding per chunk keeps the output independent of the number of workers
+    rng = random.Random('{}:{}'.format(seed, chunk_index))
+
+    num_forms = len(forms)
+    num_users = len(user_ids)
+    lines = []
+    for i in range(first, first + count):
+        form_id, template = forms[i % num_forms]
+        lines.append('\t'.join((
+            _make_uuid(rng),
+            form_id,
+            user_ids[i % num_users],
+            render_response(template, pools, rng),
+            pools.dates_created[rng.randrange(len(pools.dates_created))],
+        )))
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def _make_users(session:sa_orm.Session, num_users:int, rng:random.Random, pool_size:int) -> list:
+    given_names = [factories.FAKE.first_name() for _ in range(pool_size)]
+    family_names = [factories.FAKE.last_name() for _ in range(pool_size)]
+
+    user_ids = []
+    lines = []
+    for _ in range(num_users):
+        user_id = _make_uuid(rng)
+        user_ids.append(user_id)
+        lines.append('\t'.join((user_id, rng.choice(given_names), rng.choice(family_names))))
+    lines.append('')
+
+    pgcopy.copy_from_text(session, models.User.__table__, USER_COPY_COLUMNS, '\n'.join(lines))
+    return user_ids
+
+
+def make_source_data_fast(session:sa_orm.Session, metrics:factories.SourceDataMetrics, available_schemas:list,
+                          seed:int=0, workers:int=None, chunk_size:int=DEFAULT_CHUNK_SIZE,
+                          pool_size:int=DEFAULT_POOL_SIZE):
+    """
+    Creates source data like factories.make_source_data(), but fast enough for millions of submissions
+
+    - Response JSON is rendered from a precompiled template per form using pools of precomputed fake values
+    - Submissions are generated in parallel by worker processes
+    - Users and submissions are written with COPY
+    - The output only depends on the seed (not on the number of workers)
+
+    :param session: SQLAlchemy session
+    :param metrics: determines how many instances of each model to create
+    :param available_schemas: list of dictionaries describing form schemas
+    :param seed: random seed
+    :param workers: number of worker processes (default: number of CPUs)
+    :param chunk_size: number of submissions per worker task and COPY statement
+    :param pool_size: number of precomputed values per answer type
+    """
+    if metrics.submissions and not (metrics.forms and metrics.users):
+        raise ValueError('Submissions need at least one form and one user, got {} forms and {} users'.format(
+            metrics.forms, metrics.users))
+
+    rng = random.Random(seed)
+    random.seed(seed)
+    factories.FAKE.seed(seed)
+
+    # there are few forms so they are created as usual
+    schema_iterator = itertools.cycle(available_schemas)
+    forms = [
+        factories.FormFactory.build(id=uuid.UUID(_make_uuid(rng)), schema=next(schema_iterator))
+        for _ in range(metrics.forms)
+    ]
+    session.add_all(forms)
+    session.flush()
+
+    user_ids = _make_users(session, metrics.users, rng, pool_size)
+    LOGGER.info('Created %d users', len(user_ids))
+
+    if not metrics.submissions:
+        return
+
+    form_templates = [
+        (str(form.id), compile_response_template(transformers.make_node_path_map(form.schema)))
+        for form in forms
+    ]
+    pools = make_value_pools(pool_size)
+
+    chunks = [
+        (chunk_index, first, min(chunk_size, metrics.submissions - first))
+        for chunk_index, first in enumerate(range(0, metrics.submissions, chunk_size))
+    ]
+
+    num_submissions = 0
+    with multiprocessing.Pool(workers, initializer=_init_worker,
+                              initargs=(seed, form_templates, user_ids, pools)) as pool:
+        # chunks are generated in parallel while the main process streams the finished ones to Postgres
+        for (_, _, count), text in zip(chunks, pool.imap(_generate_submissions_chunk, chunks)):
+            pgcopy.copy_from_text(session, models.Submission.__table__, SUBMISSION_COPY_COLUMNS, text)
+            num_submissions += count
+            LOGGER.info('Created %d of %d submissions', num_submissions, metrics.submissions)
+
+    # refresh planner statistics after the bulk load
+    for table in (models.User.__table__, models.Submission.__table__):
+        session.execute('ANALYZE {}.{}'.format(table.schema, table.name))
@@ -0,0 +1,254 @@
+import collections
+import contextlib
+import json
+import logging
+import resource
+import sys
+import time
+import tracemalloc
+
+import sqlalchemy.event as sa_event
+
+from app.util.timestamps import utc_now
+
+
+LOGGER = logging.getLogger(__name__)
+
+# stage names used by processor.process()
+EXTRACTOR_STAGE = 'extractor'
+TRANSFORMER_STAGE = 'transformer'
+LOADER_STAGE = 'loader'
+COMMIT_STAGE = 'commit'
+
+# nested in the loader stage by loaders which maintain rollup tables
+ROLLUPS_STAGE = 'rollups'
+
+# ru_maxrss is reported in kilobytes on Linux but in bytes on OS X
+_RSS_UNITS = 1 if sys.platform == 'darwin' else 1024
+
+
+class Histogram:
+    """
+    Latency histogram with power-of-two microsecond buckets
+
+    Adding a sample is a couple of integer operations so it is cheap enough to record every database round-trip
+    """
+    def __init__(self):
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds:float):
+        # bucket N holds samples up to (2 ** N) microseconds
+        self.buckets[int(seconds * 1e6).bit_length()] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def as_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'total_seconds': self.total,
+            'max_seconds': self.max,
+            'buckets': {
+                '<={}us'.format(2 ** bucket): self.buckets[bucket]
+                for bucket in sorted(self.buckets)
+            }
+        }
+
+
+def max_rss_bytes() -> int:
+    """
+    Returns the high-water mark of the resident set size of this process
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _RSS_UNITS
+
+
+class RunMetrics:
+    """
+    Collects timing, throughput and memory metrics for a single processor run
+
+    Stage timings are *exclusive*: the processor pipeline is a chain of generators so time spent pulling the
+    next submission from the extractor is charged to the extractor rather than to the transformer or loader
+    that asked for it.  Time spent executing statements on the database is also tracked per stage.
+
+    :param trace_malloc: also track the Python heap high-water mark with tracemalloc (this is *not* low overhead)
+    :param metadata: extra keys to include in the report (e.g. scenario and configuration names)
+    """
+    def __init__(self, trace_malloc:bool=False, **metadata):
+        self.trace_malloc = trace_malloc
+        self.metadata = metadata
+
+        self.stage_seconds = collections.defaultdict(float)
+        self.db_seconds = collections.defaultdict(float)
+        self.batch_latency = collections.defaultdict(Histogram)
+        self.counts = collections.Counter()
+        self.sections = {}
+
+        self._stack = []
+        self._last_switch = None
+        self._statement_start = None
+
+        self._started_at = None
+        self._start_counter = None
+        self._start_cpu = None
+        self._wall_seconds = None
+        self._cpu_seconds = None
+        self._tracemalloc_peak = None
+        self._started_tracemalloc = False
+
+    @property
+    def current_stage(self):
+        """ name of the stage that is currently executing (or None) """
+        return self._stack[-1] if self._stack else None
+
+    def _switch(self):
+        now = time.perf_counter()
+        if self._stack:
+            self.stage_seconds[self._stack[-1]] += now - self._last_switch
+        self._last_switch = now
+
+    def _enter(self, stage:str):
+        self._switch()
+        self._stack.append(stage)
+
+    def _leave(self):
+        self._switch()
+        self._stack.pop()
+
+    @contextlib.contextmanager
+    def stage(self, stage:str):
+        """
+        Charges all time spent in this context to a stage (minus any time spent in nested stages)
+
+        :param stage: stage name
+        """
+        self._enter(stage)
+        try:
+            yield
+        finally:
+            self._leave()
+
+    def timed_iter(self, stage:str, iterable, counter:str):
+        """
+        Wraps an iterable so that time spent producing each item is charged to a stage
+
+        :param stage: stage name
+        :param iterable: iterable to wrap (e.g. a generator or SQLAlchemy query)
+        :param counter: name of the counter incremented for each item produced
+        :return: generator of the same items
+        """
+        with self.stage(stage):
+            iterator = iter(iterable)
+
+        num_items = 0
+        try:
+            while True:
+                self._enter(stage)
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self._leave()
+                num_items += 1
+                yield item
+        finally:
+            self.counts[counter] += num_items
+
+    def _before_cursor_execute(self, *args):
+        self._statement_start = time.perf_counter()
+
+    def _after_cursor_execute(self, *args):
+        elapsed = time.perf_counter() - self._statement_start
+        stage = self.current_stage
+        self.db_seconds[stage] += elapsed
+        self.batch_latency[stage].add(elapsed)
+
+    @contextlib.contextmanager
+    def measure(self, engine):
+        """
+        Measures the enclosed run
+
+        :param engine: SQLAlchemy engine used by the processor (used to time database round-trips)
+        """
+        if self.trace_malloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+
+        sa_event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        sa_event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+        self._started_at = utc_now()
+        self._start_cpu = time.process_time()
+        self._start_counter = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self._wall_seconds = time.perf_counter() - self._start_counter
+            self._cpu_seconds = time.process_time() - self._start_cpu
+
+            sa_event.remove(engine, 'before_cursor_execute', self._before_cursor_execute)
+            sa_event.remove(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+            if tracemalloc.is_tracing():
+                self._tracemalloc_peak = tracemalloc.get_traced_memory()[1]
+                if self._started_tracemalloc:
+                    tracemalloc.stop()
+
+    def add_section(self, name:str, data:dict):
+        """
+        Adds additional JSON serializable data to the report (e.g. SQL statement statistics)
+
+        :param name: report key
+        :param data: section contents
+        """
+        self.sections[name] = data
+
+    def _per_second(self, counter:str):
+        if not self._wall_seconds:
+            return None
+        return self.counts[counter] / self._wall_seconds
+
+    def report(self) -> dict:
+        """
+        Machine-readable summary of the run
+
+        :return: JSON serializable dictionary
+        """
+        stages = set(self.stage_seconds) | {s for s in self.db_seconds if s is not None}
+        return {
+            **self.metadata,
+            'started_at': self._started_at.isoformat() if self._started_at else None,
+            'wall_seconds': self._wall_seconds,
+            'cpu_seconds': self._cpu_seconds,
+            'stages': {
+                stage: {
+                    'seconds': self.stage_seconds[stage],
+                    'db_seconds': self.db_seconds[stage],
+                    'batch_latency': self.batch_latency[stage].as_dict(),
+                } for stage in sorted(stages)
+            },
+            'counts': dict(self.counts),
+            'throughput': {
+                'submissions_per_second': self._per_second('submissions'),
+                'events_per_second': self._per_second('events'),
+            },
+            'memory': {
+                'max_rss_bytes': max_rss_bytes(),
+                'tracemalloc_peak_bytes': self._tracemalloc_peak,
+            },
+            **self.sections,
+        }
+
+    def write_report(self, pathname:str):
+        """
+        Writes the run report as a JSON file
+
+        :param pathname: output filename
+        """
+        with open(pathname, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+        LOGGER.info('Wrote run metrics to %s', pathname)
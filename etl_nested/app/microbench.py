@@ -0,0 +1,222 @@
+import cProfile
+import datetime
+import functools
+import itertools
+import logging
+import os
+import random
+import time
+import tracemalloc
+import uuid
+from collections import namedtuple
+
+from app import constants, models, factories
+from app.etl import transformers
+from app.util.json import load_json_file
+from app.util.timestamps import utc_now
+
+
+LOGGER = logging.getLogger(__name__)
+
+# answer types are assigned round-robin to the questions of synthetic schemas
+SYNTHETIC_ANSWER_TYPES = [t.name for t in constants.AnswerType]
+
+
+SyntheticShape = namedtuple('SyntheticShape', ['depth', 'breadth', 'leaves'])
+SyntheticShape.__doc__ = """
+Shape of a synthetic schema: 'depth' levels of nested panels, each panel having 'breadth' child panels and the
+innermost panels having 'leaves' questions each
+"""
+
+BenchmarkCase = namedtuple('BenchmarkCase', ['name', 'node_map', 'submissions'])
+
+# words of fake text answers
+FAKE_WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'eiusmod']
+
+BenchmarkResult = namedtuple(
+    'BenchmarkResult',
+    ['case', 'function', 'events', 'ns_per_event', 'allocated_bytes_per_event', 'retained_bytes_per_event']
+)
+BenchmarkResult.__doc__ = """
+Time per event, and per event the memory allocated during a pass (the tracemalloc peak: the results along with the
+temporaries alive at the same time) and the memory the results of a pass still reference once it is done
+"""
+
+
+def make_synthetic_schema(shape:SyntheticShape) -> dict:
+    """
+    Creates a form schema of an arbitrary shape
+
+    :param shape: synthetic schema shape
+    :return: form schema dictionary (same structure as the files in conf/schemas)
+    """
+    answer_types = itertools.cycle(SYNTHETIC_ANSWER_TYPES)
+
+    def _panel(slug:str, depth:int) -> dict:
+        if depth == shape.depth:
+            children = [
+                {'slug': 'q{}'.format(i), 'nodeType': 'question', 'answerType': next(answer_types)}
+                for i in range(shape.leaves)
+            ]
+        else:
+            children = [_panel('p{}'.format(i), depth + 1) for i in range(shape.breadth)]
+        return {'slug': slug, 'nodeType': 'form', 'children': children}
+
+    return _panel('synthetic', 0)
+
+
+def _make_fake_value(rng:random.Random, answer_type:constants.AnswerType):
+    if answer_type == constants.AnswerType.number:
+        return rng.randint(1, 1000)
+    if answer_type == constants.AnswerType.boolean:
+        return rng.random() < 0.5
+    if answer_type == constants.AnswerType.date:
+        return (datetime.date(2000, 1, 1) + datetime.timedelta(days=rng.randrange(7300))).isoformat()
+    return ' '.join(rng.choice(FAKE_WORDS) for _ in range(rng.randint(1, 4))).capitalize() + '.'
+
+
+def _make_submissions(schema:dict, num_submissions:int, rng:random.Random) -> tuple:
+    """
+    Creates transient (never persisted) submissions with fake responses for a schema
+    """
+    form = factories.FormFactory.build(id=uuid.UUID(int=rng.getrandbits(128)), schema=schema)
+    user = factories.UserFactory.build(id=uuid.UUID(int=rng.getrandbits(128)))
+    node_map = transformers.make_node_path_map(schema)
+    make_response = functools.partial(factories.make_response, lambda _: node_map,
+                                      make_fake_value=functools.partial(_make_fake_value, rng))
+
+    submissions = [
+        models.Submission(id=uuid.UUID(int=rng.getrandbits(128)), form=form, form_id=form.id, user=user, user_id=user.id,
+                          date_created=utc_now(), responses=make_response(form.id))
+        for _ in range(num_submissions)
+    ]
+    return node_map, submissions
+
+
+def make_cases(shape:SyntheticShape=None, schema_names:list=None, num_submissions:int=10,
+               conf_dir:str=constants.DEFAULT_CONFIG_DIR, seed:int=0) -> list:
+    """
+    Creates benchmark cases for a synthetic schema and/or real schemas
+
+    :param shape: optional shape of a synthetic schema
+    :param schema_names: optional names of schemas in the conf/schemas directory
+    :param num_submissions: number of submissions per case
+    :param conf_dir: configuration directory
+    :param seed: random seed for fake responses
+    :return: list of BenchmarkCase
+    """
+    # a generator of its own, so that the caller's random state is left alone
+    rng = random.Random(seed)
+
+    cases = []
+    if shape:
+        node_map, submissions = _make_submissions(make_synthetic_schema(shape), num_submissions, rng)
+        name = 'synthetic(depth={},breadth={},leaves={})'.format(*shape)
+        cases.append(BenchmarkCase(name, node_map, submissions))
+
+    for schema_name in schema_names or []:
+        schema = load_json_file(os.path.join(conf_dir, 'schemas', schema_name + '.json'))
+        node_map, submissions = _make_submissions(schema, num_submissions, rng)
+        cases.append(BenchmarkCase(schema_name, node_map, submissions))
+
+    return cases
+
+
+def _run_map_nested(case:BenchmarkCase, processed_on) -> list:
+    f_extract_answers = functools.partial(transformers._extract_answers, node_map=case.node_map)
+    return [
+        item
+        for submission in case.submissions
+        for item in transformers.map_nested(submission.responses, f_extract_answers, transformers._dict_children)
+    ]
+
+
+def _run_transform_to_dict(case:BenchmarkCase, processed_on) -> list:
+    get_node_path_map = lambda _: case.node_map
+    return [
+        event
+        for submission in case.submissions
+        for event in transformers._transform_submission(get_node_path_map, submission, processed_on, True)
+    ]
+
+
+def _run_transform_to_model(case:BenchmarkCase, processed_on) -> list:
+    get_node_path_map = lambda _: case.node_map
+    return [
+        event
+        for submission in case.submissions
+        for event in transformers._transform_submission(get_node_path_map, submission, processed_on, False)
+    ]
+
+
+BENCHMARK_FUNCTIONS = [
+    ('map_nested', _run_map_nested),
+    ('transform_to_dict', _run_transform_to_dict),
+    ('transform_to_model', _run_transform_to_model),
+]
+
+
+def _measure(case:BenchmarkCase, name:str, func, min_seconds:float) -> BenchmarkResult:
+    processed_on = utc_now()
+
+    # timing: repeat until enough time has passed to get a stable number (without tracemalloc overhead)
+    num_events = len(func(case, processed_on))
+    num_passes = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_seconds:
+        func(case, processed_on)
+        num_passes += 1
+        elapsed = time.perf_counter() - start
+
+    # memory: only the allocations of a single pass are traced, so the peak is what the pass allocated at most at
+    # a time (results and temporaries), and the current size what its results still reference
+    tracemalloc.start()
+    try:
+        results = func(case, processed_on)
+        retained_bytes, allocated_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del results
+
+    per_event = max(num_events, 1)
+    return BenchmarkResult(case.name, name, num_events,
+                           elapsed * 1e9 / (num_passes * per_event),
+                           allocated_bytes / per_event,
+                           retained_bytes / per_event)
+
+
+def run(cases:list, min_seconds:float=1.0, profile_filename:str=None) -> list:
+    """
+    Runs all benchmark functions on all cases
+
+    :param cases: list of BenchmarkCase
+    :param min_seconds: minimum time spent timing each function on each case
+    :param profile_filename: if set, the timing loops are run under cProfile and the stats are saved here
+        (for use with visualize_pstats.sh)
+    :return: list of BenchmarkResult
+    """
+    profiler = cProfile.Profile() if profile_filename else None
+    if profiler:
+        profiler.enable()
+    try:
+        results = [
+            _measure(case, name, func, min_seconds)
+            for case in cases
+            for name, func in BENCHMARK_FUNCTIONS
+        ]
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_filename)
+            LOGGER.info('Wrote profiler stats to %s', profile_filename)
+    return results
+
+
+def log_results(results:list):
+    lines = ['{:<45} {:<20} {:>8} {:>10} {:>14} {:>14}'.format(
+        'case', 'function', 'events', 'ns/event', 'alloc B/ev', 'retained B/ev')]
+    for r in results:
+        lines.append('{:<45} {:<20} {:>8} {:>10.0f} {:>14.0f} {:>14.0f}'.format(
+            r.case, r.function, r.events, r.ns_per_event, r.allocated_bytes_per_event, r.retained_bytes_per_event))
+    LOGGER.info('Transformer microbenchmarks\n%s', '\n'.join(lines))
@@ -1,5 +1,8 @@
+import hashlib
+
 import sqlalchemy as sa
 import sqlalchemy.dialects.postgresql as sa_pg
+import sqlalchemy.schema as sa_schema
 from sqlalchemy.ext import declarative
 import sqlalchemy.orm as sa_orm
 
@@ -42,6 +45,19 @@ def init_database(db: sa.engine.Connectable):
     METADATA.create_all(bind=db)
 
 
+def ddl_key() -> str:
+    """
+    :return: hash of the DDL of all models including their indexes (changes whenever the models change)
+    """
+    dialect = sa_pg.dialect()
+    ddl = []
+    for table in METADATA.sorted_tables:
+        ddl.append(str(sa_schema.CreateTable(table).compile(dialect=dialect)))
+        ddl.extend(str(sa_schema.CreateIndex(index).compile(dialect=dialect))
+                   for index in sorted(table.indexes, key=lambda i: i.name))
+    return hashlib.sha256('\n'.join(ddl).encode('utf-8')).hexdigest()
+
+
 class PrimaryKeyUUIDMixin:
     """
     Includes an 'id' primary key UUID column
@@ -120,6 +136,7 @@ class ResponseEvent(DataWarehouseModel):
     This is an OLAP table where the following is expected:
     - No foreign keys
     - Redundant data (for faster analytical queries)
+    - Indexes for analytical queries only (see WAREHOUSE_INDEXES), which bulk loads may defer
     """
     __tablename__ = 'response_events'
 
@@ -139,5 +156,75 @@ class ResponseEvent(DataWarehouseModel):
     processed_on = sa.Column(sa.DateTime(timezone=True), nullable=False)  # when this event was created
     schema_path = sa.Column(sa.Text, nullable=False)  # dot separated path to node in Submission.responses
     value = sa.Column(sa.Text, nullable=False)  # value of node in Submission.responses
+
+    # typed copies of value, only the one matching answer_type is set
+    #
+    # NOTE: evaluates_none() renders None as NULL instead of omitting the column from the INSERT, otherwise bulk
+    # inserts would split their batches by which of these columns are None
+    value_number = sa.Column(sa.Numeric().evaluates_none(), nullable=True)
+    value_boolean = sa.Column(sa.Boolean().evaluates_none(), nullable=True)
+    value_date = sa.Column(sa.Date().evaluates_none(), nullable=True)
+
     answer_type = sa.Column(sa.Enum(constants.AnswerType), nullable=False)  # answerType from node in Schema
     tag = sa.Column(sa.Text, nullable=True, default=None) # tag from node in Schema (if exists)
+
+
+class AnswerDailyCount(BaseModel):
+    """
+    Rollup of the response events: number of answers per form, question, value and day (UTC) of the submission
+
+    Maintained incrementally by the loaders (see app/etl/rollups.py)
+
+    NOTE: values are keyed by their MD5 hash, answers are unbounded text and a B-tree entry larger than about a third
+    of a page makes the INSERT fail
+    """
+    __tablename__ = 'answer_daily_counts'
+    __table_args__ = (
+        {'schema': SCHEMAS['dwh']},
+    )
+
+    form_id = sa.Column(sa_pg.UUID(as_uuid=True), primary_key=True)
+    schema_path = sa.Column(sa.Text, primary_key=True)
+    value_hash = sa.Column(sa_pg.UUID(as_uuid=True), primary_key=True)  # md5(value), stored as 16 bytes
+    day = sa.Column(sa.Date, primary_key=True)
+    value = sa.Column(sa.Text, nullable=False)
+    num_answers = sa.Column(sa.BigInteger, nullable=False)
+
+
+class LatestAnswer(BaseModel):
+    """
+    Rollup of the response events: the answer of a user's most recent submission to each question
+
+    Maintained incrementally by the loaders (see app/etl/rollups.py)
+    """
+    __tablename__ = 'latest_answers'
+    __table_args__ = (
+        {'schema': SCHEMAS['dwh']},
+    )
+
+    user_id = sa.Column(sa_pg.UUID(as_uuid=True), primary_key=True)
+    schema_path = sa.Column(sa.Text, primary_key=True)
+    form_id = sa.Column(sa_pg.UUID(as_uuid=True), nullable=False)
+    submission_id = sa.Column(sa_pg.UUID(as_uuid=True), nullable=False)
+    submission_created = sa.Column(sa.DateTime(timezone=True), nullable=False)
+    value = sa.Column(sa.Text, nullable=False)
+
+
+# Indexes for analytical queries on response events
+#
+# - B-tree on (form_id, schema_path): answers to a question of a form
+# - BRIN on the timestamps: time range filters (events are appended roughly in time order, so BRIN indexes are tiny)
+# - (user_id, schema_path, submission_created): the "latest answers of a user" dashboards, which read the newest
+#   entries of a user and question from the index (value is not indexed: answers are unbounded text, and an index
+#   entry larger than a third of a page makes the INSERT fail)
+# - partial B-tree on (schema_path, value_date): date range filters on the answers to a question
+WAREHOUSE_INDEXES = [
+    sa.Index('ix_response_events_form_id_schema_path', ResponseEvent.form_id, ResponseEvent.schema_path),
+    sa.Index('ix_response_events_processed_on_brin', ResponseEvent.processed_on, postgresql_using='brin'),
+    sa.Index('ix_response_events_submission_created_brin', ResponseEvent.submission_created,
+             postgresql_using='brin'),
+    sa.Index('ix_response_events_user_answers', ResponseEvent.user_id, ResponseEvent.schema_path,
+             ResponseEvent.submission_created),
+    sa.Index('ix_response_events_value_date', ResponseEvent.schema_path, ResponseEvent.value_date,
+             postgresql_where=ResponseEvent.value_date.isnot(None)),
+]
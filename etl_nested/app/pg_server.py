@@ -0,0 +1,327 @@
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+import uuid
+
+import sqlalchemy as sa
+import testing.common.database
+import testing.postgresql
+
+
+LOGGER = logging.getLogger(__name__)
+
+# subdirectory of the perf data directory for the warm server
+SERVER_SUBDIR = 'server'
+
+# the server is stopped once no client was connected for this number of seconds
+DEFAULT_IDLE_TIMEOUT = 30 * 60
+
+# maximum number of seconds between two idle checks of the watchdog
+WATCHDOG_INTERVAL = 10
+
+# advisory lock serializing the creation of template databases
+TEMPLATE_LOCK_KEY = 0x7e3d1a7e
+
+# same defaults as testing.postgresql
+INITDB_ARGS = ['-U', 'postgres', '-A', 'trust']
+DEFAULT_POSTGRES_ARGS = '-h 127.0.0.1 -F -c logging_collector=off'
+
+
+def _quote(name:str) -> str:
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def make_database_name(*components) -> str:
+    """
+    :return: database name made of the given components (anything but letters, digits and underscores is replaced)
+    """
+    return re.sub(r'[^a-z0-9_]', '_', '_'.join(str(c) for c in components).lower())[:63]
+
+
+class WarmServer:
+    """
+    Local Postgres server that keeps running between invocations and hands out isolated databases
+
+    The server avoids the fixed cost of initdb, startup and shutdown for every perf run or pytest session.  Its state
+    is kept in a directory (normally the 'server' subdirectory of the perf data directory):
+
+    - data: the database cluster
+    - server.json: port and idle timeout of the running server (its modification time is the time of last use)
+    - server.lock: serializes starting and stopping the server
+
+    A detached watchdog process stops the server once no client was connected for the idle timeout.
+    """
+    STATE_FILE = 'server.json'
+    LOCK_FILE = 'server.lock'
+    LOG_FILE = 'server.log'
+
+    def __init__(self, base_dir:str, idle_timeout:float=DEFAULT_IDLE_TIMEOUT,
+                 postgres_args:str=DEFAULT_POSTGRES_ARGS):
+        self.base_dir = os.path.abspath(base_dir)
+        self.idle_timeout = idle_timeout
+        self.postgres_args = postgres_args
+
+    @property
+    def data_dir(self) -> str:
+        return os.path.join(self.base_dir, 'data')
+
+    @property
+    def _state_path(self) -> str:
+        return os.path.join(self.base_dir, self.STATE_FILE)
+
+    @contextlib.contextmanager
+    def _lock(self):
+        os.makedirs(self.base_dir, exist_ok=True)
+        with open(os.path.join(self.base_dir, self.LOCK_FILE), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_state(self) -> dict:
+        try:
+            with open(self._state_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _pg_ctl(self, *args) -> subprocess.CompletedProcess:
+        command = [testing.postgresql.find_program('pg_ctl', ['bin']), '-D', self.data_dir] + list(args)
+        return subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def _is_running(self) -> bool:
+        return os.path.exists(self.data_dir) and self._pg_ctl('status').returncode == 0
+
+    def _last_used(self) -> float:
+        try:
+            return os.path.getmtime(self._state_path)
+        except FileNotFoundError:
+            return 0.0
+
+    def touch(self):
+        """ marks the server as used (postpones the idle shutdown) """
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(self._state_path)
+
+    def url(self, database:str='postgres') -> str:
+        state = self._read_state()
+        if state is None:
+            raise RuntimeError('Server is not running')
+        return 'postgresql://postgres@127.0.0.1:{}/{}'.format(state['port'], database)
+
+    def status(self) -> dict:
+        """
+        :return: state of the running server or None
+        """
+        state = self._read_state()
+        if state is None or not self._is_running():
+            return None
+        return dict(state, url=self.url(), idle_seconds=time.time() - self._last_used())
+
+    def start(self) -> str:
+        """
+        Starts the server unless it is already running
+
+        :return: URL of the server's 'postgres' database
+        """
+        with self._lock():
+            state = self._read_state()
+            if state is not None and self._is_running():
+                self.touch()
+                return self.url()
+
+            if not os.path.exists(os.path.join(self.data_dir, 'PG_VERSION')):
+                LOGGER.info('Initializing warm server cluster: %s', self.data_dir)
+                subprocess.run([testing.postgresql.find_program('initdb', ['bin']), '-D', self.data_dir,
+                                '--lc-messages=C'] + INITDB_ARGS,
+                               check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+            socket_dir = os.path.join(self.base_dir, 'tmp')
+            os.makedirs(socket_dir, exist_ok=True)
+            port = testing.common.database.get_unused_port()
+            options = '-p {} -k {} {}'.format(port, socket_dir, self.postgres_args)
+            result = self._pg_ctl('start', '-w', '-l', os.path.join(self.base_dir, self.LOG_FILE), '-o', options)
+            if result.returncode != 0:
+                raise RuntimeError('Starting the warm server failed: {}'.format(result.stderr.decode().strip()))
+
+            with open(self._state_path, 'w') as f:
+                json.dump({'port': port, 'idle_timeout': self.idle_timeout}, f)
+            LOGGER.info('Started warm server on port %d (idle timeout: %d seconds)', port, self.idle_timeout)
+
+            # the watchdog is detached so that it outlives this process
+            subprocess.Popen([sys.executable, '-m', 'app.pg_server', self.base_dir],
+                             cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                             start_new_session=True)
+            return self.url()
+
+    def _stop(self):
+        if self._is_running():
+            self._pg_ctl('stop', '-w', '-m', 'fast')
+            LOGGER.info('Stopped warm server')
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._state_path)
+
+    def stop(self):
+        with self._lock():
+            self._stop()
+
+    def _count_connections(self) -> int:
+        engine = sa.create_engine(self.url())
+        try:
+            # background processes have no client port (it is -1 for UNIX domain socket connections)
+            return engine.execute(
+                'SELECT count(*) FROM pg_stat_activity WHERE pid <> pg_backend_pid() AND client_port IS NOT NULL'
+            ).scalar()
+        finally:
+            engine.dispose()
+
+    def watch(self):
+        """
+        Stops the server after it was idle for the idle timeout (run by the detached watchdog process)
+        """
+        state = self._read_state()
+        if state is None:
+            return
+        idle_timeout = state['idle_timeout']
+        interval = min(WATCHDOG_INTERVAL, max(idle_timeout / 4, 0.1))
+
+        last_active = time.time()
+        while True:
+            time.sleep(interval)
+            if self._read_state() is None or not self._is_running():
+                return
+            if self._count_connections():
+                last_active = time.time()
+
+            if time.time() - max(last_active, self._last_used()) >= idle_timeout:
+                with self._lock():
+                    # re-check while holding the lock, since start() may have handed out the server meanwhile
+                    if time.time() - self._last_used() >= idle_timeout and not self._count_connections():
+                        LOGGER.info('Warm server idle for %d seconds', idle_timeout)
+                        self._stop()
+                        return
+
+    def _execute(self, *statements):
+        engine = sa.create_engine(self.url(), isolation_level='AUTOCOMMIT')
+        try:
+            with engine.connect() as connection:
+                for statement in statements:
+                    connection.execute(statement)
+        finally:
+            engine.dispose()
+
+    def database_names(self, prefix:str='') -> list:
+        engine = sa.create_engine(self.url())
+        try:
+            rows = engine.execute(sa.text('SELECT datname FROM pg_database WHERE datname LIKE :pattern'),
+                                  pattern=prefix.replace('_', r'\_') + '%')
+            return sorted(row[0] for row in rows)
+        finally:
+            engine.dispose()
+
+    def create_database(self, name:str, template:str=None):
+        """
+        :param name: database name
+        :param template: optional name of a database to copy (which must not have any connections)
+        """
+        statement = 'CREATE DATABASE {}'.format(_quote(name))
+        if template:
+            statement += ' TEMPLATE {}'.format(_quote(template))
+        self._execute(statement)
+
+    def drop_database(self, name:str):
+        # remaining connections (e.g. from a crashed run) would prevent dropping the database
+        self._execute(
+            "SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = '{}'".format(
+                name.replace("'", "''")),
+            'DROP DATABASE IF EXISTS {}'.format(_quote(name))
+        )
+
+    def configure_database(self, name:str, settings:dict) -> list:
+        """
+        Applies settings to all new sessions of a database
+
+        Only settings that can be changed per session are applied, since all databases share the server.
+
+        :param name: database name
+        :param settings: dictionary of Postgres settings
+        :return: names of the settings that were not applied
+        """
+        engine = sa.create_engine(self.url())
+        try:
+            contexts = dict(engine.execute('SELECT name, context FROM pg_settings').fetchall())
+        finally:
+            engine.dispose()
+
+        applied = {k: v for k, v in settings.items() if contexts.get(k) in ('user', 'superuser')}
+        self._execute(*[
+            "ALTER DATABASE {} SET {} = '{}'".format(_quote(name), k, v.replace("'", "''"))
+            for k, v in sorted(applied.items())
+        ])
+        return sorted(set(settings) - set(applied))
+
+    def ensure_template(self, name:str, f_initialize, replaces_prefix:str=None):
+        """
+        Creates and initializes a template database unless it already exists
+
+        Concurrent callers (e.g. pytest-xdist workers) wait until the first one has initialized the template.
+
+        :param name: template database name
+        :param f_initialize: function initializing the new database given its URL
+        :param replaces_prefix: if set, other databases with this name prefix are dropped (outdated templates)
+        """
+        engine = sa.create_engine(self.url(), isolation_level='AUTOCOMMIT')
+        try:
+            with engine.connect() as connection:
+                connection.execute(sa.text('SELECT pg_advisory_lock(:key)'), key=TEMPLATE_LOCK_KEY)
+                try:
+                    existing_names = self.database_names(replaces_prefix or name)
+                    if name in existing_names:
+                        return
+
+                    for outdated_name in existing_names if replaces_prefix else []:
+                        LOGGER.info('Dropping outdated template database %s', outdated_name)
+                        self.drop_database(outdated_name)
+
+                    self.create_database(name)
+                    try:
+                        f_initialize(self.url(name))
+                    except Exception:
+                        self.drop_database(name)
+                        raise
+                finally:
+                    connection.execute(sa.text('SELECT pg_advisory_unlock(:key)'), key=TEMPLATE_LOCK_KEY)
+        finally:
+            engine.dispose()
+
+    @contextlib.contextmanager
+    def temporary_database(self, prefix:str='test', template:str=None) -> str:
+        """
+        Context manager providing a new database that is dropped afterwards
+
+        :param prefix: database name prefix
+        :param template: optional name of a database to copy
+        :return: database URL
+        """
+        self.start()
+        name = make_database_name(prefix, os.getpid(), uuid.uuid4().hex[:8])
+        self.create_database(name, template=template)
+        try:
+            yield self.url(name)
+        finally:
+            self.drop_database(name)
+            self.touch()
+
+
+if __name__ == '__main__':
+    # watchdog process (see WarmServer.start)
+    logging.basicConfig(level=logging.INFO)
+    WarmServer(sys.argv[1]).watch()
@@ -0,0 +1,186 @@
+import logging
+from collections import namedtuple
+
+import sqlalchemy as sa
+import sqlalchemy.orm as sa_orm
+
+
+LOGGER = logging.getLogger(__name__)
+
+# number of pg_stat_statements entries included in a diff
+DEFAULT_TOP_STATEMENTS = 10
+
+# pg_stat_database counters of the current database
+DATABASE_COUNTERS = ['xact_commit', 'blks_hit', 'blks_read', 'temp_files', 'temp_bytes', 'tup_returned',
+                     'tup_fetched', 'tup_inserted', 'tup_updated', 'tup_deleted']
+
+# pending statistics of a backend can only be flushed on demand as of Postgres 15 (before, they were sent to the
+# statistics collector asynchronously, so the counters of a run may lag by up to half a second)
+FORCE_FLUSH_MIN_SERVER_VERSION = (15,)
+
+# the checkpoint counters moved from pg_stat_bgwriter to pg_stat_checkpointer in Postgres 17
+CHECKPOINTER_VIEW_MIN_SERVER_VERSION = (17,)
+
+# pg_stat_statements renamed total_time to total_exec_time and added wal_bytes in Postgres 13
+STATEMENTS_EXEC_TIME_MIN_SERVER_VERSION = (13,)
+
+# transactions committed by a pair of snapshots which fall between their readings: the one that read the counters
+# of the first snapshot and the one that flushes the statistics for the second (see take_snapshot)
+SNAPSHOT_COMMITS = 2
+
+ServerSnapshot = namedtuple('ServerSnapshot', ['wal_lsn', 'database', 'checkpoints', 'statements'])
+ServerSnapshot.__doc__ = """
+Server-side counters at a point in time: WAL insert position (bytes), pg_stat_database and checkpoint counters, and
+pg_stat_statements entries by queryid (None if the extension is not available)
+"""
+
+
+def parse_lsn(lsn:str) -> int:
+    """
+    :param lsn: WAL location (e.g. '16/B374D848')
+    :return: byte position
+    """
+    high, low = lsn.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def _row_dict(connection:sa.engine.Connection, sql:str) -> dict:
+    row = connection.execute(sa.text(sql)).first()
+    return {k: v for k, v in row.items()} if row is not None else {}
+
+
+def _wal_lsn(connection:sa.engine.Connection) -> int:
+    if connection.dialect.server_version_info >= (10,):
+        sql = 'SELECT pg_current_wal_insert_lsn()'
+    else:
+        sql = 'SELECT pg_current_xlog_insert_location()'
+    return parse_lsn(connection.execute(sql).scalar())
+
+
+def _database_counters(connection:sa.engine.Connection) -> dict:
+    return _row_dict(connection, 'SELECT {} FROM pg_stat_database WHERE datname = current_database()'.format(
+        ', '.join(DATABASE_COUNTERS)))
+
+
+def _checkpoint_counters(connection:sa.engine.Connection) -> dict:
+    if connection.dialect.server_version_info >= CHECKPOINTER_VIEW_MIN_SERVER_VERSION:
+        sql = '''
+            SELECT num_timed AS checkpoints_timed, num_requested AS checkpoints_requested,
+                   buffers_written AS checkpoint_buffers_written
+            FROM pg_stat_checkpointer
+        '''
+    else:
+        sql = '''
+            SELECT checkpoints_timed, checkpoints_req AS checkpoints_requested,
+                   buffers_checkpoint AS checkpoint_buffers_written
+            FROM pg_stat_bgwriter
+        '''
+    return _row_dict(connection, sql)
+
+
+def has_pg_stat_statements(connection:sa.engine.Connection) -> bool:
+    """
+    :param connection: SQLAlchemy connection
+    :return: whether pg_stat_statements is installed in the database and loaded by the server
+    """
+    installed = connection.execute(
+        "SELECT count(*) FROM pg_extension WHERE extname = 'pg_stat_statements'"
+    ).scalar()
+    preloaded = connection.execute("SELECT current_setting('shared_preload_libraries')").scalar()
+    return bool(installed) and 'pg_stat_statements' in preloaded
+
+
+def _statement_counters(connection:sa.engine.Connection) -> dict:
+    if connection.dialect.server_version_info >= STATEMENTS_EXEC_TIME_MIN_SERVER_VERSION:
+        extra_columns = 'total_exec_time AS total_ms, CAST(wal_bytes AS bigint) AS wal_bytes'
+    else:
+        extra_columns = 'total_time AS total_ms, NULL AS wal_bytes'
+
+    rows = connection.execute('''
+        SELECT queryid, query, calls, rows, shared_blks_hit, shared_blks_read, temp_blks_written, {}
+        FROM pg_stat_statements
+        WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+    '''.format(extra_columns))
+    return {row['queryid']: {k: v for k, v in row.items() if k != 'queryid'} for row in rows}
+
+
+def take_snapshot(session:sa_orm.Session) -> ServerSnapshot:
+    """
+    Snapshots the server-side counters
+
+    NOTE: this commits the current transaction, so that the statistics of this session are flushed first
+
+    :param session: SQLAlchemy session
+    :return: ServerSnapshot
+    """
+    connection = session.connection()
+    if connection.dialect.server_version_info >= FORCE_FLUSH_MIN_SERVER_VERSION:
+        # the flush happens once the backend is idle outside of a transaction, i.e. before the next statement
+        connection.execute('SELECT pg_stat_force_next_flush()')
+    session.commit()
+
+    connection = session.connection()
+    statements = _statement_counters(connection) if has_pg_stat_statements(connection) else None
+    snapshot = ServerSnapshot(_wal_lsn(connection), _database_counters(connection),
+                              _checkpoint_counters(connection), statements)
+    session.commit()
+    return snapshot
+
+
+def _diff_counters(before:dict, after:dict) -> dict:
+    return {k: after[k] - before.get(k, 0) for k in after if after[k] is not None}
+
+
+def _diff_statements(before:dict, after:dict, top:int) -> list:
+    diffs = []
+    for queryid, counters in after.items():
+        previous = before.get(queryid, {})
+        diff = {
+            k: (v - (previous.get(k) or 0) if isinstance(v, (int, float)) else v)
+            for k, v in counters.items()
+        }
+        if diff['calls'] > 0:
+            diffs.append(diff)
+    diffs.sort(key=lambda d: d['total_ms'], reverse=True)
+    return diffs[:top]
+
+
+def diff(before:ServerSnapshot, after:ServerSnapshot, top:int=DEFAULT_TOP_STATEMENTS) -> dict:
+    """
+    Computes the server-side activity between two snapshots
+
+    The counters are server or database wide, so they include the activity of other sessions (e.g. autovacuum).
+    The commits of the snapshots themselves are subtracted from xact_commit.
+
+    :param before: ServerSnapshot taken before the run
+    :param after: ServerSnapshot taken after the run
+    :param top: number of pg_stat_statements entries to include (by total execution time)
+    :return: JSON serializable dictionary for the run metrics report
+    """
+    statements = None
+    if before.statements is not None and after.statements is not None:
+        statements = _diff_statements(before.statements, after.statements, top)
+
+    database = _diff_counters(before.database, after.database)
+    if 'xact_commit' in database:
+        database['xact_commit'] = max(database['xact_commit'] - SNAPSHOT_COMMITS, 0)
+
+    return {
+        'wal_bytes': after.wal_lsn - before.wal_lsn,
+        'database': database,
+        'checkpoints': _diff_counters(before.checkpoints, after.checkpoints),
+        'statements': statements,
+    }
+
+
+def log_diff(server_diff:dict):
+    """
+    Logs the main server-side counters of a run
+
+    :param server_diff: see diff()
+    """
+    database = server_diff['database']
+    LOGGER.info('Server: %.1f MB WAL, %d buffer hits, %d buffer reads, %d temp bytes, %d tuples inserted, '
+                '%d checkpoints', server_diff['wal_bytes'] / 2 ** 20, database.get('blks_hit', 0),
+                database.get('blks_read', 0), database.get('temp_bytes', 0), database.get('tup_inserted', 0),
+                sum(server_diff['checkpoints'].get(k, 0) for k in ('checkpoints_timed', 'checkpoints_requested')))
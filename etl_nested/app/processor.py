@@ -1,13 +1,28 @@
-def process(extractor, transformer, loader):
+from app import metrics as run_metrics
+
+
+def process(extractor, transformer, loader, metrics:run_metrics.RunMetrics=None):
     """
     Extract-Transform-Load process
-    
+
     :param extractor: partial extractor function
     :param transformer: partial transformer function
     :param loader:  partial loader function
+    :param metrics: optional RunMetrics instance to record per-stage timings and counts
     """
-    submissions_generator = extractor()
+    if metrics is None:
+        submissions_generator = extractor()
+
+        events_generator = transformer(submissions_generator)
+
+        loader(events_generator)
+        return
+
+    with metrics.stage(run_metrics.EXTRACTOR_STAGE):
+        submissions = extractor()
+    submissions_generator = metrics.timed_iter(run_metrics.EXTRACTOR_STAGE, submissions, 'submissions')
 
-    events_generator = transformer(submissions_generator)
+    events_generator = metrics.timed_iter(run_metrics.TRANSFORMER_STAGE, transformer(submissions_generator), 'events')
 
-    loader(events_generator)
+    with metrics.stage(run_metrics.LOADER_STAGE):
+        loader(events_generator)
@@ -0,0 +1,146 @@
+import logging
+import statistics
+import time
+from collections import namedtuple
+
+import sqlalchemy as sa
+import sqlalchemy.orm as sa_orm
+
+from app import models
+from app.etl import indexes
+
+
+LOGGER = logging.getLogger(__name__)
+
+RESPONSE_EVENTS_TABLE = models.ResponseEvent.__table__
+
+AnalystQuery = namedtuple('AnalystQuery', ['name', 'sql'])
+AnalystQuery.__doc__ = """
+Typical analyst query on the response events ('sql' is formatted with the table name and bound to the parameters
+returned by sample_parameters)
+"""
+
+ANALYST_QUERIES = [
+    # answer distribution of one question of a form
+    AnalystQuery('question_answers', """
+        SELECT value, count(*) FROM {table}
+        WHERE form_id = :form_id AND schema_path = :schema_path
+        GROUP BY value
+    """),
+    # submissions per form within a time range
+    AnalystQuery('submissions_in_range', """
+        SELECT form_name, count(DISTINCT submission_id) FROM {table}
+        WHERE submission_created >= :created_from AND submission_created < :created_to
+        GROUP BY form_name
+    """),
+    # latest answer of a user to a question (dashboard)
+    AnalystQuery('user_latest_answer', """
+        SELECT value FROM {table}
+        WHERE user_id = :user_id AND schema_path = :schema_path
+        ORDER BY submission_created DESC
+        LIMIT 1
+    """),
+    # all latest answers of a user (dashboard)
+    AnalystQuery('user_latest_answers', """
+        SELECT DISTINCT ON (schema_path) schema_path, submission_created, value FROM {table}
+        WHERE user_id = :user_id
+        ORDER BY schema_path, submission_created DESC
+    """),
+]
+
+QueryTiming = namedtuple('QueryTiming', ['name', 'rows', 'before_seconds', 'after_seconds'])
+QueryTiming.__doc__ = """
+Median runtime of an analyst query without ('before') and with ('after') the warehouse indexes
+"""
+
+
+def sample_parameters(session:sa_orm.Session) -> dict:
+    """
+    Picks query parameters from the response events: a question answered by a user, and the middle tenth of the
+    submission time range
+
+    :param session: SQLAlchemy session
+    :return: parameters for the analyst queries
+    """
+    table = RESPONSE_EVENTS_TABLE
+    num_events = session.query(sa.func.count()).select_from(table).scalar()
+    if not num_events:
+        raise ValueError('No response events to query, process the scenario first')
+
+    form_id, user_id, schema_path = session.query(table.c.form_id, table.c.user_id, table.c.schema_path) \
+        .order_by(table.c.id).offset(num_events // 2).limit(1).one()
+
+    first, last = session.query(sa.func.min(table.c.submission_created),
+                                sa.func.max(table.c.submission_created)).one()
+    window = (last - first) / 10
+
+    # UUIDs are passed as text, Postgres converts them for the comparison
+    return {
+        'form_id': str(form_id),
+        'user_id': str(user_id),
+        'schema_path': schema_path,
+        'created_from': first + 4 * window,
+        'created_to': first + 5 * window,
+    }
+
+
+def _time_query(session:sa_orm.Session, statement, parameters:dict, repetitions:int) -> tuple:
+    # one unmeasured run to warm the caches
+    num_rows = len(session.execute(statement, parameters).fetchall())
+
+    samples = []
+    for _ in range(repetitions):
+        start_counter = time.perf_counter()
+        session.execute(statement, parameters).fetchall()
+        samples.append(time.perf_counter() - start_counter)
+    return num_rows, statistics.median(samples)
+
+
+def _time_queries(session:sa_orm.Session, parameters:dict, repetitions:int) -> list:
+    return [
+        _time_query(session, sa.text(q.sql.format(table=RESPONSE_EVENTS_TABLE.fullname)), parameters, repetitions)
+        for q in ANALYST_QUERIES
+    ]
+
+
+def run(session:sa_orm.Session, repetitions:int=5) -> list:
+    """
+    Times the analyst queries without and with the warehouse indexes
+
+    The 'before' timings drop the indexes inside a savepoint which is rolled back afterwards.  Both runs use fresh
+    planner statistics.
+
+    :param session: SQLAlchemy session
+    :param repetitions: measured runs per query
+    :return: list of QueryTiming
+    """
+    parameters = sample_parameters(session)
+    table_indexes = indexes.table_indexes(RESPONSE_EVENTS_TABLE)
+
+    savepoint = session.begin_nested()
+    indexes.drop_indexes(session, table_indexes)
+    indexes.analyze(session, RESPONSE_EVENTS_TABLE)
+    before = _time_queries(session, parameters, repetitions)
+    savepoint.rollback()
+
+    indexes.analyze(session, RESPONSE_EVENTS_TABLE)
+    after = _time_queries(session, parameters, repetitions)
+
+    return [
+        QueryTiming(q.name, num_rows, before_seconds, after_seconds)
+        for q, (num_rows, before_seconds), (_, after_seconds) in zip(ANALYST_QUERIES, before, after)
+    ]
+
+
+def log_results(results:list):
+    """
+    Logs a table of the query timings
+
+    :param results: list of QueryTiming
+    """
+    lines = ['{:<24} {:>8} {:>12} {:>12} {:>9}'.format('query', 'rows', 'before (ms)', 'after (ms)', 'speedup')]
+    for r in results:
+        lines.append('{:<24} {:>8d} {:>12.3f} {:>12.3f} {:>8.1f}x'.format(
+            r.name, r.rows, r.before_seconds * 1e3, r.after_seconds * 1e3,
+            r.before_seconds / r.after_seconds if r.after_seconds else float('inf')))
+    LOGGER.info('Analyst query timings\n%s', '\n'.join(lines))
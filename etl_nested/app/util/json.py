@@ -1,6 +1,200 @@
+import importlib
 import json
+import json.decoder
+import json.scanner
+import re
+
+
+# names of the supported JSON decoder modules, fastest first (all but 'json' are optional and not in requirements.txt)
+JSON_DECODERS = ('orjson', 'ujson', 'json')
+
+# picks the fastest installed decoder
+AUTO_DECODER = 'auto'
+
+# tokens of the streaming scanner (see iter_scalars)
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_NUMBER = json.scanner.NUMBER_RE
+_STRING_TAIL = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"')
+_SKIP_CONTAINER = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}]')
+_LITERALS = {'true': True, 'false': False, 'null': None, 'NaN': float('nan'), 'Infinity': float('inf'),
+             '-Infinity': float('-inf')}
+_LITERAL = re.compile(r'true|false|null|NaN|-?Infinity')
 
 
 def load_json_file(pathname:str):
     with open(pathname, 'r') as f:
         return json.load(f)
+
+
+def get_decoder(name:str=AUTO_DECODER):
+    """
+    Returns the loads() function of a JSON decoder module
+
+    :param name: one of JSON_DECODERS or AUTO_DECODER
+    :return: function decoding a JSON document from text
+    """
+    if name == AUTO_DECODER:
+        for decoder_name in JSON_DECODERS:
+            try:
+                return get_decoder(decoder_name)
+            except ValueError:
+                pass
+
+    if name not in JSON_DECODERS:
+        raise ValueError("Unknown JSON decoder '{}'".format(name))
+
+    try:
+        module = importlib.import_module(name)
+    except ImportError:
+        raise ValueError("JSON decoder '{}' is not installed".format(name))
+    return module.loads
+
+
+def _error(message:str, text:str, index:int):
+    return json.JSONDecodeError(message, text, index)
+
+
+def _skip_whitespace(text:str, index:int) -> int:
+    return _WHITESPACE.match(text, index).end()
+
+
+def _scan_scalar(text:str, index:int) -> tuple:
+    """
+    :return: (value, end index) of the string, number or literal starting at index
+    """
+    if text.startswith('"', index):
+        return json.decoder.scanstring(text, index + 1)
+
+    match = _NUMBER.match(text, index)
+    if match:
+        integer, fraction, exponent = match.groups()
+        if fraction or exponent:
+            return float(integer + (fraction or '') + (exponent or '')), match.end()
+        return int(integer), match.end()
+
+    match = _LITERAL.match(text, index)
+    if match:
+        return _LITERALS[match.group()], match.end()
+    raise _error('Expecting value', text, index)
+
+
+def _skip_container(text:str, index:int) -> int:
+    """
+    :return: end index of the array or object starting at index (strings are skipped without being decoded)
+    """
+    # closing brackets of the open arrays and objects
+    expected = []
+    while True:
+        match = _SKIP_CONTAINER.search(text, index)
+        if not match:
+            raise _error('Unterminated array or object', text, index)
+        char = match.group()
+        if char == '[':
+            expected.append(']')
+        elif char == '{':
+            expected.append('}')
+        elif char in ']}':
+            if expected.pop() != char:
+                raise _error('Mismatched ' + char, text, match.start())
+            if not expected:
+                return match.end()
+        index = match.end()
+
+
+def _skip_value(text:str, index:int) -> int:
+    char = text[index:index + 1]
+    if char in ('[', '{'):
+        return _skip_container(text, index)
+    if char == '"':
+        match = _STRING_TAIL.match(text, index + 1)
+        if not match:
+            raise _error('Unterminated string', text, index)
+        return match.end()
+    return _scan_scalar(text, index)[1]
+
+
+def _discard_path(values:dict, path:str):
+    # values of an earlier occurrence of a key, and of the object it may have been
+    prefix = path + '.'
+    for discarded in [p for p in values if p == path or p.startswith(prefix)]:
+        del values[discarded]
+
+
+def _scan_object_scalars(text:str, index:int, prefix:str, leaf_paths, container_paths, values:dict) -> int:
+    """
+    Adds the (path, value) pairs of an object which starts after the '{' at index to values
+
+    :return: end index of the object
+    """
+    index = _skip_whitespace(text, index)
+    if text.startswith('}', index):
+        return index + 1
+
+    keys = set()
+    while True:
+        if not text.startswith('"', index):
+            raise _error('Expecting property name enclosed in double quotes', text, index)
+        key, index = json.decoder.scanstring(text, index + 1)
+        index = _skip_whitespace(text, index)
+        if not text.startswith(':', index):
+            raise _error("Expecting ':' delimiter", text, index)
+        index = _skip_whitespace(text, index + 1)
+
+        path = prefix + key
+        # like json.loads(), the last value of a duplicate key wins
+        if key in keys:
+            _discard_path(values, path)
+        keys.add(key)
+
+        char = text[index:index + 1]
+        if char == '{' and path in container_paths:
+            index = _scan_object_scalars(text, index + 1, path + '.', leaf_paths, container_paths, values)
+        elif char not in ('{', '[') and path in leaf_paths:
+            values[path], index = _scan_scalar(text, index)
+        else:
+            index = _skip_value(text, index)
+
+        index = _skip_whitespace(text, index)
+        char = text[index:index + 1]
+        if char == '}':
+            return index + 1
+        if char != ',':
+            raise _error("Expecting ',' delimiter", text, index)
+        index = _skip_whitespace(text, index + 1)
+
+
+def iter_scalars(text:str, leaf_paths, container_paths):
+    """
+    Extracts the scalar values of selected paths from a JSON document without decoding the rest of it
+
+    The document is scanned token by token.  Values of other paths and arrays are skipped without being built, so
+    memory grows with the number of selected values rather than with the size of the document.  Paths are the
+    dot-separated keys of nested objects, and values are decoded like json.loads() does (including duplicate keys,
+    of which the last value wins).
+
+    NOTE: since a later duplicate key replaces an earlier value, the whole document is scanned and the selected values
+    are collected before the first one is yielded
+
+    :param text: JSON document, an object (any other document has no paths)
+    :param leaf_paths: paths whose scalar values are yielded (e.g. a node path map)
+    :param container_paths: paths of the objects which contain leaf paths (see make_container_paths)
+    :return: generator of (path, value) in document order (of the first occurrence of a duplicate key)
+    """
+    values = {}
+    index = _skip_whitespace(text, 0)
+    if text.startswith('{', index):
+        _scan_object_scalars(text, index + 1, '', leaf_paths, container_paths, values)
+    yield from values.items()
+
+
+def make_container_paths(leaf_paths) -> frozenset:
+    """
+    :param leaf_paths: dot-separated paths
+    :return: paths of all objects containing the leaf paths (e.g. 'a' and 'a.b' for 'a.b.c')
+    """
+    container_paths = set()
+    for path in leaf_paths:
+        components = path.split('.')
+        for i in range(1, len(components)):
+            container_paths.add('.'.join(components[:i]))
+    return frozenset(container_paths)
@@ -0,0 +1,41 @@
+import io
+
+import sqlalchemy as sa
+import sqlalchemy.orm as sa_orm
+
+
+# NULL marker of the COPY text format
+NULL = '\\N'
+
+_TEXT_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def escape_text(text:str) -> str:
+    """
+    Escapes text for the Postgres COPY text format
+
+    :param text: text
+    :return: escaped text
+    """
+    return text.translate(_TEXT_ESCAPES)
+
+
+def copy_from_text(session:sa_orm.Session, table:sa.Table, columns, text:str):
+    """
+    Loads rows in the Postgres COPY text format into a table
+
+    NOTE: COPY runs on the DBAPI cursor, so it is not seen by SQLAlchemy events (statement counts and timings)
+
+    :param session: SQLAlchemy session
+    :param table: SQLAlchemy table
+    :param columns: names of the columns in each line
+    :param text: tab separated lines (including the final newline)
+    """
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            'COPY {}.{} ({}) FROM STDIN'.format(table.schema, table.name, ', '.join(columns)),
+            io.StringIO(text)
+        )
+    finally:
+        cursor.close()
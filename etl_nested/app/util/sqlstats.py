@@ -0,0 +1,177 @@
+import collections
+import random
+import re
+import time
+
+import sqlalchemy.event as sa_event
+
+
+# number of latency samples kept per statement for percentile estimation
+RESERVOIR_SIZE = 1024
+
+_REGEX_WHITESPACE = re.compile(r'\s+')
+_REGEX_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_REGEX_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+_REGEX_PLACEHOLDER = re.compile(r'%\(\w+\)s|%s')
+_REGEX_PLACEHOLDER_LIST = re.compile(r'\?(?:\s*,\s*\?)+')
+
+
+def normalize_statement(statement:str) -> str:
+    """
+    Reduces a SQL statement to a canonical form so that statements differing only by literals,
+    parameter names or the length of an IN-list are accounted together
+
+    :param statement: SQL statement as sent to the DBAPI cursor
+    :return: normalized statement
+    """
+    normalized = _REGEX_WHITESPACE.sub(' ', statement).strip()
+    normalized = _REGEX_STRING_LITERAL.sub('?', normalized)
+    normalized = _REGEX_PLACEHOLDER.sub('?', normalized)
+    normalized = _REGEX_NUMBER_LITERAL.sub('?', normalized)
+    return _REGEX_PLACEHOLDER_LIST.sub('?, ...', normalized)
+
+
+def _count_parameters(parameters, executemany:bool) -> int:
+    if not parameters:
+        return 0
+    if executemany:
+        return sum(len(p) for p in parameters)
+    return len(parameters)
+
+
+class StatementStats:
+    """
+    Aggregate accounting for a single normalized statement
+    """
+    __slots__ = ('statement', 'calls', 'total_seconds', 'rows', 'parameters', '_samples')
+
+    def __init__(self, statement:str):
+        self.statement = statement
+        self.calls = 0
+        self.total_seconds = 0.0
+        self.rows = 0
+        self.parameters = 0
+        self._samples = []
+
+    def add(self, seconds:float, rows:int, parameters:int):
+        self.calls += 1
+        self.total_seconds += seconds
+        self.rows += max(rows, 0)
+        self.parameters += parameters
+
+        # reservoir sampling keeps memory bounded regardless of the number of calls
+        if len(self._samples) < RESERVOIR_SIZE:
+            self._samples.append(seconds)
+        else:
+            i = random.randrange(self.calls)
+            if i < RESERVOIR_SIZE:
+                self._samples[i] = seconds
+
+    @property
+    def p95_seconds(self) -> float:
+        if not self._samples:
+            return 0.0
+        samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+    def as_dict(self) -> dict:
+        return {
+            'statement': self.statement,
+            'calls': self.calls,
+            'total_seconds': self.total_seconds,
+            'p95_seconds': self.p95_seconds,
+            'rows': self.rows,
+            'parameters': self.parameters,
+        }
+
+
+class SQLStatementStats:
+    """
+    Aggregates every statement executed on an engine using SQLAlchemy cursor events
+
+    Unlike SQL logging, the cost per statement is two dictionary lookups and a timer so this can be used under
+    realistic load.  Normalization happens once per distinct raw statement string.
+    """
+    def __init__(self):
+        self.statements = collections.OrderedDict()
+        self._normalized = {}
+        self._start = None
+        self._engines = []
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self._start = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - self._start
+
+        normalized = self._normalized.get(statement)
+        if normalized is None:
+            normalized = self._normalized[statement] = normalize_statement(statement)
+
+        stats = self.statements.get(normalized)
+        if stats is None:
+            stats = self.statements[normalized] = StatementStats(normalized)
+
+        stats.add(elapsed, cursor.rowcount, _count_parameters(parameters, executemany))
+
+    def install(self, engine):
+        """
+        Starts accounting for all statements executed by an engine
+
+        :param engine: SQLAlchemy engine
+        """
+        sa_event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        sa_event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        self._engines.append(engine)
+
+    def uninstall(self):
+        """
+        Stops accounting on all engines
+        """
+        for engine in self._engines:
+            sa_event.remove(engine, 'before_cursor_execute', self._before_cursor_execute)
+            sa_event.remove(engine, 'after_cursor_execute', self._after_cursor_execute)
+        self._engines = []
+
+    @property
+    def total_calls(self) -> int:
+        return sum(s.calls for s in self.statements.values())
+
+    def top(self, n:int=10, key:str='total_seconds') -> list:
+        """
+        :param n: number of statements to return
+        :param key: StatementStats attribute to sort by (e.g. 'total_seconds' or 'calls')
+        :return: list of StatementStats in descending order
+        """
+        return sorted(self.statements.values(), key=lambda s: getattr(s, key), reverse=True)[:n]
+
+    def report(self, n:int=10) -> dict:
+        """
+        :param n: number of statements to include
+        :return: JSON serializable summary
+        """
+        return {
+            'total_calls': self.total_calls,
+            'total_seconds': sum(s.total_seconds for s in self.statements.values()),
+            'distinct_statements': len(self.statements),
+            'top': [s.as_dict() for s in self.top(n)],
+        }
+
+    def format_summary(self, n:int=10, width:int=100) -> str:
+        """
+        Formats a plain text table of the top statements by total time
+
+        :param n: number of statements to include
+        :param width: maximum length of the statement text
+        """
+        lines = [
+            'Top {} of {} distinct statements ({} calls):'.format(
+                min(n, len(self.statements)), len(self.statements), self.total_calls),
+            '{:>8} {:>10} {:>10} {:>10} {:>10}  {}'.format(
+                'calls', 'total(s)', 'p95(ms)', 'rows', 'params', 'statement')
+        ]
+        for s in self.top(n):
+            statement = s.statement if len(s.statement) <= width else s.statement[:width - 3] + '...'
+            lines.append('{:>8} {:>10.3f} {:>10.3f} {:>10} {:>10}  {}'.format(
+                s.calls, s.total_seconds, s.p95_seconds * 1000, s.rows, s.parameters, statement))
+        return '\n'.join(lines)
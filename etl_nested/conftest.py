@@ -7,6 +7,8 @@ from app import constants
 
 def pytest_addoption(parser):
     parser.addoption('--keepdb', action="store_true", default=False, help="Reuse test database")
+    parser.addoption('--pg-server', action="store", default=None, metavar='DIR',
+                     help="Use a temporary database on the warm server in DIR (e.g. .perf_dbs/server)")
 
 
 @pytest.fixture(scope='session')
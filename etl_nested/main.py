@@ -1,5 +1,4 @@
 import argparse
-import contextlib
 import logging
 import os
 import shutil
@@ -7,37 +6,19 @@ import subprocess
 import sys
 import time
 
-import sqlalchemy as sa
 import sqlalchemy.orm as sa_orm
-from app import constants, db as perf_db, models, factories
+from app import bench, constants, cpuprofile, db as perf_db, explain, models, factories, fast_data, \
+    metrics as run_metrics, microbench, pg_server, pgstats, querybench
 from app.logs import setup_logging
 from app.util.json import load_json_file
+from app.util.sqlstats import SQLStatementStats
 
 LOGGER = logging.getLogger(__name__)
 
 
-@contextlib.contextmanager
-def make_perf_session(test_db)-> sa_orm.Session:
-    db = None
-    session = None
-    try:
-        db_url = test_db.url()
-        db = sa.create_engine(db_url)
-        sessionmaker = sa_orm.sessionmaker(db)
-        session = sessionmaker()
-
-        yield session
-
-    finally:
-        if session:
-            session.close()
-        if db:
-            db.dispose()
-
-
-def generate_data(session:sa_orm.Session, scenario_name:dict,
+def generate_data(session:sa_orm.Session, scenario_name:dict, workers:int=None,
                   conf_dir:str= constants.DEFAULT_CONFIG_DIR):
-    config = load_json_file(os.path.join(conf_dir, 'perfdata.conf.json'))
+    config = load_json_file(os.path.join(conf_dir, constants.PERFDATA_CONFIG_FILE))
     scenario = config[scenario_name]
 
     # parse metrics
@@ -54,24 +35,128 @@ def generate_data(session:sa_orm.Session, scenario_name:dict,
 
     # generate the data
     LOGGER.info('Generating data...')
-    factories.make_source_data(session, metrics, schemas)
+    if scenario.get('generator') == 'fast':
+        fast_data.make_source_data_fast(session, metrics, schemas, seed=scenario.get('seed', 0), workers=workers)
+    else:
+        factories.make_source_data(session, metrics, schemas)
 
     session.commit()
 
 
 def process_data(session:sa_orm.Session, config_name:str, use_memory_profiler:bool,
-                 conf_dir:str= constants.DEFAULT_CONFIG_DIR):
+                 metrics:run_metrics.RunMetrics=None,
+                 conf_dir:str= constants.DEFAULT_CONFIG_DIR, explain_plans:bool=False,
+                 cpu_sampler:cpuprofile.StackSampler=None, server_stats:bool=False) -> list:
+    """
+    Runs a processor configuration and commits its results
+
+    :param session: SQLAlchemy session
+    :param config_name: name of the processor configuration
+    :param use_memory_profiler: run the processor with memory_profiler
+    :param metrics: optional RunMetrics instance
+    :param conf_dir: configuration directory
+    :param explain_plans: explain the main statements of the extractor and loader after the run
+    :param cpu_sampler: optional StackSampler which samples the run
+    :param server_stats: add the server-side counters of the run to the metrics (snapshots of the counters commit and
+        query the statistics views before and after the run)
+    :return: list of explain.ExplainedStatement (empty unless explain_plans is set)
+    """
+    metrics = metrics or run_metrics.RunMetrics()
+
     # constructor the processor
     config = load_json_file(os.path.join(conf_dir, constants.PROCESSOR_CONFIG_FILE))
-    processor = factories.make_processor(session, config[config_name], use_memory_profiler=use_memory_profiler)
+    processor = factories.make_processor(session, config[config_name], use_memory_profiler=use_memory_profiler,
+                                         metrics=metrics)
+    if explain_plans and not explain.has_loader_plan(config[config_name]):
+        LOGGER.warning('The %s configuration loads with COPY, which cannot be explained: the plans will not include '
+                       'the insertion of the response events', config_name)
 
     # run the processor
     if use_memory_profiler:
         LOGGER.warning('NOTE: Using memory profiler instruments code and will result in slower runtime')
     LOGGER.info('Processing...')
-    processor()
+    plan_capture = explain.PlanCapture(metrics) if explain_plans else None
+    server_before = pgstats.take_snapshot(session) if server_stats else None
+    with metrics.measure(session.get_bind()):
+        if plan_capture:
+            plan_capture.install(session.get_bind())
+        if cpu_sampler:
+            cpu_sampler.start()
+        try:
+            processor()
+
+            with metrics.stage(run_metrics.COMMIT_STAGE):
+                session.commit()
+        finally:
+            if cpu_sampler:
+                cpu_sampler.stop()
+            if plan_capture:
+                plan_capture.uninstall()
+
+    if server_stats:
+        server_diff = pgstats.diff(server_before, pgstats.take_snapshot(session))
+        pgstats.log_diff(server_diff)
+        metrics.add_section('server', server_diff)
+
+    if not plan_capture:
+        return []
+
+    LOGGER.info('Explaining the captured statements...')
+    explained = explain.explain_captured(session, plan_capture)
+    explain.log_summaries(explained)
+    return explained
+
+
+def generate_template(data_dir:str, scenario_name:str, workers:int=None, sql_stats:SQLStatementStats=None,
+                      pg_profile:str=None):
+    """
+    Generates the template database of a scenario and records its content key once complete
+
+    :param data_dir: root directory for all perf test databases
+    :param scenario_name: scenario name
+    :param workers: worker processes for 'fast' generator scenarios
+    :param sql_stats: optional statement statistics
+    :param pg_profile: Postgres settings profile (default: the scenario's profile)
+    """
+    template_key = perf_db.make_template_key(scenario_name)
+    perf_db_kwargs = {
+        'root_dir': data_dir,
+        'scenario_name': scenario_name,
+        'db_type': perf_db.DatabaseType.template,
+        'pg_profile': pg_profile or perf_db.scenario_pg_profile(scenario_name),
+    }
+    with perf_db.PerfTestDatabase(**perf_db_kwargs) as postgresql:
+        with perf_db.make_perf_session(postgresql, sql_stats=sql_stats) as session:
+            # NOTE: we do not included database connection and initialization in our timing measurements
+            start_counter = time.perf_counter()
+            generate_data(session, scenario_name, workers=workers)
+            end_counter = time.perf_counter()
+            LOGGER.info('Elapsed time (seconds): %s', '{:.03f}'.format(end_counter - start_counter))
 
-    session.commit()
+    perf_db.write_template_key(data_dir, scenario_name, template_key)
+
+
+def make_report_path(data_dir:str, scenario_name:str, config_name:str) -> str:
+    """
+    Returns a unique path for the run metrics report of a processor run
+
+    :param data_dir: root directory for all perf test databases
+    :param scenario_name: scenario name
+    :param config_name: processor configuration name
+    :return: JSON filename
+    """
+    reports_dir = os.path.join(data_dir, perf_db.REPORTS_SUBDIR)
+    os.makedirs(reports_dir, exist_ok=True)
+    timestamp = time.strftime('%Y%m%dT%H%M%S')
+    return os.path.join(reports_dir, '{}__{}__{}.json'.format(scenario_name, config_name, timestamp))
+
+
+def make_plans_path(report_path:str) -> str:
+    """
+    :param report_path: filename of the run metrics report
+    :return: filename of the query plans written next to the report
+    """
+    return '{}.plans.json'.format(os.path.splitext(report_path)[0])
 
 
 def review_data(db_url:str):
@@ -81,10 +166,69 @@ def review_data(db_url:str):
 
 
 def remove_data(data_dir:str):
+    make_server(data_dir).stop()
     LOGGER.info('Removing perf data directory')
     shutil.rmtree(data_dir, ignore_errors=True)
 
 
+def make_server(data_dir:str, idle_timeout:float=pg_server.DEFAULT_IDLE_TIMEOUT) -> pg_server.WarmServer:
+    return pg_server.WarmServer(os.path.join(data_dir, pg_server.SERVER_SUBDIR), idle_timeout=idle_timeout)
+
+
+def run_server_command(args):
+    server = make_server(args.data_dir, idle_timeout=args.idle_timeout * 60)
+    if args.action == 'start':
+        server.start()
+    elif args.action == 'stop':
+        server.stop()
+    elif args.action == 'url':
+        # printed without logging decoration for use in shell commands
+        print(server.start())
+        return
+
+    status = server.status()
+    if status:
+        LOGGER.info('Warm server running at %s (idle for %d of %d seconds)',
+                    status['url'], status['idle_seconds'], status['idle_timeout'])
+    else:
+        LOGGER.info('Warm server not running')
+
+
+def run_benchmarks(args, conf_dir:str=constants.DEFAULT_CONFIG_DIR):
+    scenario_names = args.scenarios or list(load_json_file(os.path.join(conf_dir, constants.PERFDATA_CONFIG_FILE)))
+    config_names = args.configs or list(load_json_file(os.path.join(conf_dir, constants.PROCESSOR_CONFIG_FILE)))
+
+    # build missing or outdated templates on demand
+    for scenario_name in scenario_names:
+        if not perf_db.is_template_current(args.data_dir, scenario_name, perf_db.make_template_key(scenario_name)):
+            LOGGER.info("Generating template for scenario '%s'", scenario_name)
+            generate_template(args.data_dir, scenario_name, pg_profile=args.pg_profile)
+
+    results = bench.run_matrix(args.data_dir, scenario_names, config_names,
+                               repetitions=args.repetitions, warmup=args.warmup, use_server=args.server,
+                               pg_profile=args.pg_profile, conf_dir=conf_dir)
+    bench.write_results(results, args.output or bench.make_results_path(args.data_dir))
+
+    comparisons = None
+    if args.baseline:
+        comparisons = bench.compare(bench.load_results(args.baseline), results,
+                                    alpha=args.alpha, min_change=args.min_change)
+    bench.log_summary(results, comparisons)
+
+    if comparisons and any(c.regression for c in comparisons):
+        raise RuntimeError('Performance regression detected')
+
+
+def run_microbenchmarks(args):
+    shape = None
+    if not args.no_synthetic:
+        shape = microbench.SyntheticShape(args.depth, args.breadth, args.leaves)
+
+    cases = microbench.make_cases(shape, args.schemas, num_submissions=args.submissions, seed=args.seed)
+    results = microbench.run(cases, min_seconds=args.min_seconds, profile_filename=args.profile)
+    microbench.log_results(results)
+
+
 def main(args):
     if args.command == 'clean':
         remove_data(args.data_dir)
@@ -92,32 +236,77 @@ def main(args):
 
     setup_logging(sql_logging=args.sql_logging)
 
+    if args.command == 'bench':
+        run_benchmarks(args)
+        return
+    elif args.command == 'microbench':
+        run_microbenchmarks(args)
+        return
+    elif args.command == 'server':
+        run_server_command(args)
+        return
+
+    sql_stats = SQLStatementStats() if args.sql_stats else None
+
+    template_key = perf_db.make_template_key(args.scenario_name)
+    template_is_current = perf_db.is_template_current(args.data_dir, args.scenario_name, template_key)
+
+    if args.command == 'generate':
+        if template_is_current and not args.force:
+            LOGGER.info("Template for scenario '%s' is up to date (use --force to regenerate)", args.scenario_name)
+        else:
+            generate_template(args.data_dir, args.scenario_name, workers=args.workers, sql_stats=sql_stats,
+                              pg_profile=args.pg_profile)
+            if sql_stats:
+                LOGGER.info('SQL statement statistics\n%s', sql_stats.format_summary(args.sql_stats_top))
+        return
+
+    if not template_is_current and perf_db.read_template_key(args.data_dir, args.scenario_name):
+        LOGGER.warning("Template for scenario '%s' is out of date, please regenerate it", args.scenario_name)
+
+    pg_profile = args.pg_profile or perf_db.scenario_pg_profile(args.scenario_name)
     perf_db_kwargs = {
         'root_dir': args.data_dir,
-        'scenario_name': args.scenario_name
+        'scenario_name': args.scenario_name,
+        'db_type': perf_db.DatabaseType.test_run,
+        'pg_profile': pg_profile,
     }
-    if args.command == 'generate':
-        perf_db_kwargs['db_type'] = perf_db.DatabaseType.template
-    else:
-        perf_db_kwargs['db_type'] = perf_db.DatabaseType.test_run
-
-    if args.command == 'process':
+    # run databases on the warm server are dropped after the run, so psql gets its own copy of the scenario
+    if args.command in ('process', 'querybench') or args.server:
         perf_db_kwargs['copy_from_template'] = True
 
     show_elapsed_time = True
     if args.command == 'psql':
         show_elapsed_time = False
 
-    with perf_db.PerfTestDatabase(**perf_db_kwargs) as postgresql:
-        with make_perf_session(postgresql) as session:
+    metrics = None
+    explained = []
+    cpu_sampler = None
+    if args.command == 'process':
+        metrics = run_metrics.RunMetrics(trace_malloc=args.trace_malloc,
+                                         scenario=args.scenario_name, config=args.config_name, pg_profile=pg_profile)
+        if args.profile_cpu:
+            cpu_sampler = cpuprofile.StackSampler(metrics, interval=args.profile_cpu_interval / 1000)
+
+    if args.server:
+        del perf_db_kwargs['db_type']
+        test_db = perf_db.ServerTestDatabase(make_server(args.data_dir), **perf_db_kwargs)
+    else:
+        test_db = perf_db.PerfTestDatabase(**perf_db_kwargs)
+
+    with test_db as postgresql:
+        with perf_db.make_perf_session(postgresql, sql_stats=sql_stats) as session:
             # start the timer
             # NOTE: we do not included database connection and initialization in our timing measurements
             start_counter = time.perf_counter()
 
-            if args.command == 'generate':
-                generate_data(session, args.scenario_name)
-            elif args.command == 'process':
-                process_data(session, args.config_name, args.profile_mem)
+            if args.command == 'process':
+                explained = process_data(session, args.config_name, args.profile_mem, metrics=metrics,
+                                         explain_plans=args.explain, cpu_sampler=cpu_sampler,
+                                         server_stats=args.server_stats)
+            elif args.command == 'querybench':
+                process_data(session, args.config_name, False)
+                querybench.log_results(querybench.run(session, repetitions=args.repetitions))
             elif args.command == 'psql':
                 review_data(postgresql.url())
 
@@ -126,6 +315,21 @@ def main(args):
             if show_elapsed_time:
                 LOGGER.info('Elapsed time (seconds): %s', '{:.03f}'.format(end_counter - start_counter))
 
+    if sql_stats:
+        LOGGER.info('SQL statement statistics\n%s', sql_stats.format_summary(args.sql_stats_top))
+
+    if metrics:
+        if sql_stats:
+            metrics.add_section('sql', sql_stats.report(args.sql_stats_top))
+        report_path = args.report or make_report_path(args.data_dir, args.scenario_name, args.config_name)
+        if explained:
+            metrics.add_section('plans', explain.report(explained))
+            explain.write_plans(explained, make_plans_path(report_path))
+        if cpu_sampler:
+            filenames = cpu_sampler.write_collapsed(os.path.splitext(report_path)[0])
+            metrics.add_section('cpu_profile', cpu_sampler.report(filenames))
+        metrics.write_report(report_path)
+
 
 if __name__ == '__main__':
     default_root_dir = os.path.join(os.getcwd(), '.perf_dbs')
@@ -133,19 +337,91 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Clover PyCon ETL Workshop')
     parser.add_argument('--debug-sql', help='Enable SQL logging', action='store_true',
                         default=False, dest='sql_logging')
+    parser.add_argument('--sql-stats', help='Aggregate timings of all SQL statements and summarize them at the end',
+                        action='store_true', default=False, dest='sql_stats')
+    parser.add_argument('--sql-stats-top', help='Number of statements to include in the SQL statement summary',
+                        type=int, default=10, dest='sql_stats_top')
     parser.add_argument('--data-dir', help='Root directory for all perf test databases', type=str,
                         default=default_root_dir)
+    parser.add_argument('--pg-profile', help='Postgres settings profile from conf/pgprofiles.conf.json '
+                                             "(default: the scenario's profile)", type=str, default=None,
+                        dest='pg_profile')
+    parser.add_argument('--server', help='Use databases on the warm server instead of starting a server per run',
+                        action='store_true', default=False)
     subparsers = parser.add_subparsers(dest='command', help='sub-command help')
 
     generate_command = subparsers.add_parser('generate', help='Generate data')
+    generate_command.add_argument('--workers', help="Worker processes for 'fast' generator scenarios "
+                                                    '(default: number of CPUs)', type=int, default=None)
+    generate_command.add_argument('--force', help='Regenerate the template even if it is up to date',
+                                  action='store_true', default=False)
     generate_command.add_argument('scenario_name', help='Scenario name', type=str, metavar='scenario')
 
     process_command = subparsers.add_parser('process', help='Process data')
     process_command.add_argument('--debug-mem', help='Show memory profiling for processor', action='store_true',
                                  default=False, dest='profile_mem')
+    process_command.add_argument('--trace-malloc', help='Include the tracemalloc heap peak in the run metrics',
+                                 action='store_true', default=False, dest='trace_malloc')
+    process_command.add_argument('--server-stats', help='Include the server-side counters of the run (WAL, buffers, '
+                                                        'pg_stat_statements) in the run metrics',
+                                 action='store_true', default=False, dest='server_stats')
+    process_command.add_argument('--explain', help='Save EXPLAIN (ANALYZE, BUFFERS) plans of the main extractor '
+                                                   'and loader statements next to the run metrics report',
+                                 action='store_true', default=False)
+    process_command.add_argument('--profile-cpu', help='Sample the CPU stacks of the run and write a collapsed '
+                                                       'stack file per stage next to the run metrics report',
+                                 action='store_true', default=False, dest='profile_cpu')
+    process_command.add_argument('--profile-cpu-interval', help='Milliseconds of CPU time between stack samples',
+                                 type=float, default=cpuprofile.DEFAULT_INTERVAL * 1000, dest='profile_cpu_interval')
+    process_command.add_argument('--report', help='Filename for the JSON run metrics report', type=str,
+                                 default=None)
     process_command.add_argument('scenario_name', help='Scenario name', type=str, metavar='scenario')
     process_command.add_argument('config_name', help='Name for processor configuration', type=str)
 
+    bench_command = subparsers.add_parser('bench', help='Benchmark a matrix of scenarios and processor configurations')
+    bench_command.add_argument('--scenarios', help='Scenario names (default: all)', type=str, nargs='+',
+                               metavar='scenario')
+    bench_command.add_argument('--configs', help='Processor configuration names (default: all)', type=str,
+                               nargs='+', metavar='config_name')
+    bench_command.add_argument('--repetitions', help='Number of measured runs per combination', type=int,
+                               default=5)
+    bench_command.add_argument('--warmup', help='Number of unmeasured runs per combination', type=int, default=1)
+    bench_command.add_argument('--output', help='Filename for JSON results (a CSV file is written alongside)',
+                               type=str, default=None)
+    bench_command.add_argument('--baseline', help='JSON results of a previous benchmark to compare against',
+                               type=str, default=None)
+    bench_command.add_argument('--alpha', help='Significance level for regressions', type=float, default=0.05)
+    bench_command.add_argument('--min-change', help='Minimum relative slowdown reported as a regression',
+                               type=float, default=0.05, dest='min_change')
+
+    microbench_command = subparsers.add_parser('microbench', help='Benchmark the transformer without a database')
+    microbench_command.add_argument('--schemas', help='Schema names from conf/schemas', type=str, nargs='*',
+                                    default=['general', 'health_risk_assessment', 'scip'], metavar='schema')
+    microbench_command.add_argument('--no-synthetic', help='Skip the synthetic schema', action='store_true',
+                                    default=False, dest='no_synthetic')
+    microbench_command.add_argument('--depth', help='Nesting depth of the synthetic schema', type=int, default=3)
+    microbench_command.add_argument('--breadth', help='Child panels per panel of the synthetic schema', type=int,
+                                    default=3)
+    microbench_command.add_argument('--leaves', help='Questions per innermost panel of the synthetic schema',
+                                    type=int, default=5)
+    microbench_command.add_argument('--submissions', help='Submissions per case', type=int, default=10)
+    microbench_command.add_argument('--min-seconds', help='Minimum timing duration per function and case',
+                                    type=float, default=1.0, dest='min_seconds')
+    microbench_command.add_argument('--seed', help='Random seed for fake responses', type=int, default=0)
+    microbench_command.add_argument('--profile', help='Save cProfile stats to this file (see visualize_pstats.sh)',
+                                    type=str, default=None)
+
+    querybench_command = subparsers.add_parser('querybench', help='Process data, then time analyst queries '
+                                                                  'without and with the warehouse indexes')
+    querybench_command.add_argument('--repetitions', help='Number of measured runs per query', type=int, default=5)
+    querybench_command.add_argument('scenario_name', help='Scenario name', type=str, metavar='scenario')
+    querybench_command.add_argument('config_name', help='Name for processor configuration', type=str)
+
+    server_command = subparsers.add_parser('server', help='Manage the warm server shared between runs')
+    server_command.add_argument('--idle-timeout', help='Stop the server after this many idle minutes', type=float,
+                                default=pg_server.DEFAULT_IDLE_TIMEOUT / 60, dest='idle_timeout')
+    server_command.add_argument('action', help='Action', choices=['start', 'stop', 'status', 'url'])
+
     subparsers.add_parser('clean', help='Removes all perf test data')
 
     psql_command = subparsers.add_parser('psql', help='Connect to processed database using psql')
@@ -4,21 +4,48 @@ from collections import namedtuple
 import pytest
 import sqlalchemy as sa
 import sqlalchemy.engine as sa_engine
+import sqlalchemy.event as sa_event
 import sqlalchemy.orm as sa_orm
 import testing.postgresql
 
-from app import models
+from app import models, pg_server
 
 # re-useable test database subdirectory
 KEEPDB_PATH = '.test_db'
 
+# warm server subdirectory used by parallel (pytest-xdist) test runs unless '--pg-server' is specified
+XDIST_SERVER_PATH = '.test_server'
+
+# prefix of the template databases with pre-created model tables on the warm server
+TEMPLATE_DB_PREFIX = 'test_template'
+
 # Test database options
 DatabaseConfig = namedtuple(
     'DatabaseConfig',
-    ['keepdb_active', 'keepdb_path']
+    ['keepdb_active', 'keepdb_path', 'server_path']
 )
 
 
+def _xdist_worker_id(config) -> str:
+    """
+    :return: pytest-xdist worker id (e.g. 'gw0') or None if the tests are not run in parallel
+    """
+    # older pytest-xdist versions call workers 'slaves'
+    for attr, key in (('workerinput', 'workerid'), ('slaveinput', 'slaveid')):
+        worker_input = getattr(config, attr, None)
+        if worker_input:
+            return worker_input[key]
+    return None
+
+
+def _init_template_database(url:str):
+    engine = sa.create_engine(url)
+    try:
+        models.init_database(engine)
+    finally:
+        engine.dispose()
+
+
 @pytest.fixture(scope='session')
 def db_options(request, root_path:str) -> DatabaseConfig:
     """
@@ -27,25 +54,49 @@ def db_options(request, root_path:str) -> DatabaseConfig:
     :param request: pytest fixture request (FixtureRequest)
     """
     keepdb_active = request.config.getoption('--keepdb')
+    server_path = request.config.getoption('--pg-server')
+
+    # parallel workers share a warm server instead of starting one each
+    if not server_path and _xdist_worker_id(request.config):
+        server_path = os.path.join(root_path, XDIST_SERVER_PATH)
+
+    # a database on the warm server is always new, so there is nothing to keep
+    if server_path:
+        keepdb_active = False
 
     if keepdb_active:
         keepdb_path = os.path.join(root_path, KEEPDB_PATH)
     else:
         keepdb_path = None
 
-    return DatabaseConfig(keepdb_active, keepdb_path)
+    return DatabaseConfig(keepdb_active, keepdb_path, server_path)
 
 
 @pytest.fixture(scope='session')
-def db_url(db_options: DatabaseConfig):
+def db_url(request, db_options: DatabaseConfig):
     """
     Postgres conninfo URL for the test database.
     
     This URL is usually a transient database managed by the 'testing.postgres' library.
     If the '--keepdb' option is specified, it will force it to be persistent at a known local path.
+    If the '--pg-server' option is specified or the tests are run in parallel by pytest-xdist, it is a temporary
+    database on the warm server instead (see app.pg_server).  Each session or worker gets its own copy of a cached
+    template database that already contains the model tables.
     
+    :param request: pytest fixture request (FixtureRequest)
     :param db_options: test database options
     """
+    if db_options.server_path:
+        server = pg_server.WarmServer(db_options.server_path)
+        server.start()
+        template_name = pg_server.make_database_name(TEMPLATE_DB_PREFIX, models.ddl_key()[:16])
+        server.ensure_template(template_name, _init_template_database, replaces_prefix=TEMPLATE_DB_PREFIX + '_')
+
+        prefix = pg_server.make_database_name('test', _xdist_worker_id(request.config) or 'main')
+        with server.temporary_database(prefix, template=template_name) as url:
+            yield url
+        return
+
     testdb_kwargs = {}
     if db_options.keepdb_path:
         testdb_kwargs['base_dir'] = db_options.keepdb_path
@@ -65,7 +116,8 @@ def db_engine(db_options:DatabaseConfig, db_url: str):
     db_engine = sa.create_engine(db_url)
 
     # speed up tests by only installing schema if there was no prior database created with --keepdb
-    if not db_options.keepdb_active or os.path.exists(db_options.keepdb_path):
+    # (databases on the warm server are copies of a template with the schema installed)
+    if not db_options.server_path and (not db_options.keepdb_active or os.path.exists(db_options.keepdb_path)):
         models.init_database(db_engine)
 
     yield db_engine
@@ -80,15 +132,30 @@ def session(db_engine: sa_engine.Engine):
     
     :param db_engine: test database connectivity instance 
     """
-    sessionmaker = sa_orm.sessionmaker(db_engine)
+    # the session runs inside an outer transaction that is rolled back regardless of test result, and commits by the
+    # code under test only release a savepoint, so no test ever changes the (shared) database
+    connection = db_engine.connect()
+    transaction = connection.begin()
+    sessionmaker = sa_orm.sessionmaker(bind=connection)
+
+    def restart_savepoint(session, transaction):
+        if transaction.nested and not transaction._parent.nested:
+            session.expire_all()
+            session.begin_nested()
 
-    # session is automatically rolled back regardless of test result
     # if an uncaught exception occurred, ensure it is still propagated to pytest with the original traceback
     session = None
     try:
         session = sessionmaker()
+        session.begin_nested()
+        sa_event.listen(session, 'after_transaction_end', restart_savepoint)
         yield session
     except:
         raise
     finally:
-        session.rollback()
+        if session:
+            sa_event.remove(session, 'after_transaction_end', restart_savepoint)
+            session.rollback()
+            session.close()
+        transaction.rollback()
+        connection.close()
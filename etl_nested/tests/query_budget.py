@@ -0,0 +1,46 @@
+import contextlib
+from collections import namedtuple
+
+from app.util.sqlstats import SQLStatementStats
+
+
+QueryBudget = namedtuple(
+    'QueryBudget',
+    ['fixed', 'per_submission', 'per_event']
+)
+QueryBudget.__doc__ = """
+Upper bound on the number of SQL round-trips for a processor run
+
+    fixed + per_submission * (number of submissions) + per_event * (number of events)
+"""
+
+
+@contextlib.contextmanager
+def count_statements(engine):
+    """
+    Counts all SQL statements executed on an engine within the context
+
+    :param engine: SQLAlchemy engine
+    :return: SQLStatementStats instance
+    """
+    stats = SQLStatementStats()
+    stats.install(engine)
+    try:
+        yield stats
+    finally:
+        stats.uninstall()
+
+
+def assert_query_budget(stats:SQLStatementStats, budget:QueryBudget, num_submissions:int, num_events:int):
+    """
+    Asserts that the number of SQL round-trips is within budget
+
+    :param stats: statement statistics collected while running the processor
+    :param budget: query budget
+    :param num_submissions: number of submissions processed
+    :param num_events: number of response events created
+    """
+    allowed = budget.fixed + budget.per_submission * num_submissions + budget.per_event * num_events
+    assert stats.total_calls <= allowed, \
+        'Executed {} statements for {} submissions and {} events but the budget allows {}\n{}'.format(
+            stats.total_calls, num_submissions, num_events, int(allowed), stats.format_summary())
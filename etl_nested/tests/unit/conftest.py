@@ -5,7 +5,7 @@ from collections import namedtuple
 
 import pytest
 import sqlalchemy.orm as sa_orm
-from app import factories
+from app import constants, factories
 from app.etl import extractors, transformers, loaders
 
 from app.util.json import load_json_file
@@ -62,6 +62,11 @@ def simple_form_schema(data_dir):
     return raw_data.schema
 
 
+@pytest.fixture(scope='session')
+def general_form_schema(data_dir):
+    return load_json_file(os.path.join(data_dir, 'general_schema.json'))
+
+
 @pytest.fixture()
 def simple_form(session, simple_form_schema):
     form = factories.FormFactory(schema=simple_form_schema)
@@ -122,6 +127,8 @@ def loader(session: sa_orm.Session, loader_params):
         ExtractorParams(extractors.naive_load_all_extractor, {'related': 'explicit_join'}),
         ExtractorParams(extractors.chunked_extractor, {'chunk_size': 2, 'related': 'joined_load'}),
         ExtractorParams(extractors.chunked_extractor, {'chunk_size': 10, 'related': 'explicit_join'}),
+        ExtractorParams(extractors.chunked_extractor, {'chunk_size': 10, 'related': 'prefetch'}),
+        ExtractorParams(extractors.chunked_extractor, {'chunk_size': 10, 'related': 'auto'}),
     ],
     ids=[
         'naive_default',
@@ -130,6 +137,8 @@ def loader(session: sa_orm.Session, loader_params):
         'load_all_explicit_join',
         'chunked_2_joined_load',
         'chunked_10_explicit_join',
+        'chunked_10_prefetch',
+        'chunked_10_auto',
     ]
 )
 def extractor(request, session: sa_orm.Session):
@@ -164,3 +173,19 @@ def source_data(request, session: sa_orm.Session, simple_form_schema: dict):
     source_data_metrics = request.param
     factories.make_source_data(session, source_data_metrics, [simple_form_schema])
     return source_data_metrics
+
+
+@pytest.fixture()
+def general_source_data(session: sa_orm.Session, general_form_schema: dict):
+    """
+    Submissions of a few forms with the nested general schema, with several submissions per user
+    """
+    source_data_metrics = factories.SourceDataMetrics(forms=2, users=3, submissions=12)
+    factories.make_source_data(session, source_data_metrics, [general_form_schema])
+    return source_data_metrics
+
+
+@pytest.fixture(scope='module')
+def all_processor_configs(conf_path):
+    processors_conf_path = os.path.join(conf_path, constants.PROCESSOR_CONFIG_FILE)
+    return load_json_file(processors_conf_path)
@@ -1,8 +1,12 @@
 import datetime
+import uuid
 
+import pytest
 import sqlalchemy.orm as sa_orm
 
 from app import models, factories
+from app.etl import extractors
+from tests.query_budget import count_statements
 
 
 def test_simple_submission_response(session: sa_orm.Session,
@@ -45,3 +49,130 @@ def test_load_submission_range(source_data, extractor):
     assert len(submission_ids) == source_data.submissions
     assert len(form_ids) == source_data.forms
     assert len(user_ids) == source_data.users
+
+
+def test_passthrough_extractor(session: sa_orm.Session, source_data):
+    submissions = {s.id: s for s in session.query(models.Submission)}
+
+    records = list(extractors.passthrough_extractor(session, chunk_size=3))
+    assert len(records) == source_data.submissions
+
+    for record in records:
+        assert isinstance(record, extractors.SubmissionRecord)
+        submission = submissions[uuid.UUID(record.id)]
+        assert record.form_id == str(submission.form_id)
+        assert record.form_name == submission.form.name
+        assert record.user_id == str(submission.user_id)
+        assert record.user_full_name == submission.user.full_name
+        assert isinstance(record.date_created, str)
+        assert record.responses == submission.responses
+
+
+@pytest.mark.parametrize('decode_workers', [0, 2])
+def test_chunked_extractor_json_decoder(session: sa_orm.Session, source_data, decode_workers):
+    expected = {s.id: s.responses for s in session.query(models.Submission)}
+    session.expunge_all()
+
+    submissions = list(extractors.chunked_extractor(session, related='explicit_join', chunk_size=3,
+                                                    json_decoder='auto', decode_workers=decode_workers))
+    assert {s.id: s.responses for s in submissions} == expected
+    assert not session.dirty
+
+
+@pytest.mark.parametrize('decode_workers', [0, 2])
+def test_passthrough_extractor_json_decoder(session: sa_orm.Session, source_data, decode_workers):
+    expected = list(extractors.passthrough_extractor(session, chunk_size=3))
+
+    records = list(extractors.passthrough_extractor(session, chunk_size=3, json_decoder='json',
+                                                    decode_workers=decode_workers))
+    assert records == expected
+
+
+def test_dimension_cache():
+    loaded = []
+
+    def _load(ids):
+        loaded.append(ids)
+        return [(i, i.upper()) for i in ids]
+
+    cache = extractors.DimensionCache(_load, max_size=2)
+    assert cache.resolve(['a', 'b', 'a']) == ['A', 'B', 'A']
+    assert cache.resolve(['b', 'c']) == ['B', 'C']
+    # 'a' was the least recently used value
+    assert cache.resolve(['a', 'c']) == ['A', 'C']
+    assert loaded == [['a', 'b'], ['c'], ['a']]
+
+    # a batch with more ids than the cache holds is still resolved completely
+    assert cache.resolve(['d', 'e', 'f']) == ['D', 'E', 'F']
+    assert cache.num_loads == 4
+    assert cache.num_misses == 7
+
+
+@pytest.mark.parametrize('cache_size', [1, 1000])
+def test_dimension_cache_extractor(session: sa_orm.Session, source_data, cache_size):
+    expected = sorted(extractors.passthrough_extractor(session, chunk_size=3))
+
+    records = list(extractors.dimension_cache_extractor(session, chunk_size=3, cache_size=cache_size))
+    assert all(isinstance(r, extractors.SubmissionRecord) for r in records)
+    assert sorted(records) == expected
+
+
+@pytest.mark.parametrize('estimates, expected', [
+    (extractors.CardinalityEstimates(submissions=2400, users=20), extractors.RelatedLoadType.prefetch),
+    (extractors.CardinalityEstimates(submissions=None, users=20), extractors.RelatedLoadType.prefetch),
+    (extractors.CardinalityEstimates(submissions=2400, users=2000), extractors.RelatedLoadType.explicit_join),
+    (extractors.CardinalityEstimates(submissions=10 ** 8, users=10 ** 6), extractors.RelatedLoadType.explicit_join),
+], ids=[
+    'few_users',
+    'unknown_submissions',
+    'mostly_single_submissions',
+    'too_many_users',
+])
+def test_choose_related_load_type(estimates, expected):
+    assert extractors.choose_related_load_type(estimates) == expected
+
+
+def test_estimate_cardinalities(session: sa_orm.Session, source_data):
+    # without statistics, only the users are counted
+    estimates = extractors.estimate_cardinalities(session)
+    assert estimates.users == source_data.users
+
+    session.execute('ANALYZE {}'.format(models.Submission.__table__.fullname))
+    estimates = extractors.estimate_cardinalities(session)
+    # an empty table has no statistics
+    assert estimates.submissions == (source_data.submissions or None)
+    assert estimates.users == len({s.user_id for s in session.query(models.Submission)})
+
+
+def test_prefetch_without_lazy_load_queries(session: sa_orm.Session, source_data, db_engine):
+    session.expunge_all()
+    submissions = list(extractors.chunked_extractor(session, related='prefetch', chunk_size=10))
+
+    with count_statements(db_engine) as stats:
+        related = [(s.user.full_name, s.form.name) for s in submissions]
+    assert stats.total_calls == 0
+    assert len(related) == source_data.submissions
+
+
+def test_prefetch_only_submitters(session: sa_orm.Session, source_data, user):
+    # the user fixture has no submissions
+    list(extractors.chunked_extractor(session, related='prefetch', chunk_size=10))
+
+    users, forms = session.info.get(extractors.PREFETCHED_KEY, ([], []))
+    submitter_ids = {user_id for user_id, in session.query(models.Submission.user_id)}
+    assert {u.id for u in users} == submitter_ids
+    assert user.id not in submitter_ids
+
+
+@pytest.mark.usefixtures('mock_logger')
+def test_auto_prefetch_limit(session: sa_orm.Session, simple_form_schema, monkeypatch):
+    metrics = factories.SourceDataMetrics(forms=1, users=3, submissions=6)
+    factories.make_source_data(session, metrics, [simple_form_schema])
+    # the estimates call for a prefetch, but there are more users than the limit
+    monkeypatch.setattr(extractors, 'choose_related_load_type', lambda estimates: extractors.RelatedLoadType.prefetch)
+    monkeypatch.setattr(extractors, 'PREFETCH_MAX_USERS', 2)
+    session.expunge_all()
+
+    submissions = list(extractors.chunked_extractor(session, related='auto', chunk_size=10))
+    assert extractors.PREFETCHED_KEY not in session.info
+    assert len(submissions) == metrics.submissions
@@ -0,0 +1,53 @@
+import pytest
+import sqlalchemy.orm as sa_orm
+
+from app import models, factories
+from app.etl import indexes
+
+RESPONSE_EVENTS_TABLE = models.ResponseEvent.__table__
+
+
+def _index_names(session: sa_orm.Session) -> set:
+    return {
+        name for name, in session.execute(
+            'SELECT indexname FROM pg_indexes WHERE schemaname = :schema AND tablename = :table',
+            {'schema': RESPONSE_EVENTS_TABLE.schema, 'table': RESPONSE_EVENTS_TABLE.name}
+        )
+    }
+
+
+def test_warehouse_indexes_declared(session: sa_orm.Session):
+    expected = {index.name for index in models.WAREHOUSE_INDEXES}
+    assert {index.name for index in indexes.table_indexes(RESPONSE_EVENTS_TABLE)} == expected
+    assert expected <= _index_names(session)
+
+
+def test_deferred_indexes(session: sa_orm.Session):
+    declared = {index.name for index in indexes.table_indexes(RESPONSE_EVENTS_TABLE)}
+    all_indexes = _index_names(session)
+
+    with indexes.deferred_indexes(session, RESPONSE_EVENTS_TABLE, parallel_workers=2):
+        # only the primary key is left during the load
+        assert _index_names(session) == all_indexes - declared
+        session.add_all(factories.ResponseEventFactory.build_batch(10))
+
+    assert _index_names(session) == all_indexes
+    assert session.query(models.ResponseEvent).count() == 10
+
+    # the planner statistics were updated
+    num_tuples = session.execute('SELECT reltuples FROM pg_class WHERE oid = CAST(:table AS regclass)',
+                                 {'table': RESPONSE_EVENTS_TABLE.fullname}).scalar()
+    assert num_tuples == 10
+
+
+def test_deferred_indexes_failed_load(session: sa_orm.Session):
+    names = {index.name for index in indexes.table_indexes(RESPONSE_EVENTS_TABLE)}
+    savepoint = session.begin_nested()
+    with pytest.raises(RuntimeError):
+        with indexes.deferred_indexes(session, RESPONSE_EVENTS_TABLE):
+            raise RuntimeError('load failed')
+
+    # the indexes are not rebuilt, the rollback restores them
+    assert not names & _index_names(session)
+    savepoint.rollback()
+    assert names <= _index_names(session)
@@ -1,11 +1,14 @@
+import base64
 import logging
+import operator
+import os
 
 import pytest
 import sqlalchemy.inspection as sa_inspection
 import sqlalchemy.orm as sa_orm
 
 from app import models, factories
-from app.etl.loaders import chunked_bulk_insert_mappings
+from app.etl.loaders import chunked_bulk_insert_mappings, chunked_copy_loader
 
 
 @pytest.fixture(scope='module')
@@ -91,3 +94,59 @@ def test_bulk_insert_mappings(session: sa_orm.Session, comparable_properties, nu
     assert summary_record.msg == 'Inserted %d response events into database'
     assert summary_record.args
     assert summary_record.args[0] == num_events
+
+
+@pytest.mark.parametrize('num_events', [
+    0,
+    1,
+    10,
+    100
+])
+@pytest.mark.parametrize('to_dict', [False, True], ids=['objects', 'dicts'])
+def test_chunked_copy_loader(session: sa_orm.Session, comparable_properties, num_events, to_dict, mock_logger):
+    expected_events = factories.ResponseEventFactory.build_batch(num_events)
+    if expected_events:
+        # characters with a special meaning in the COPY text format
+        expected_events[0].value = 'tab\there, newline\nthere, backslash \\N'
+        expected_events[0].tag = 'tagged'
+    if to_dict:
+        expected_events = [
+            {
+                c.name: getattr(e, c.name)
+                for c in e.__table__.columns if c.name != 'id'
+            } for e in expected_events
+        ]
+    chunked_copy_loader(session, expected_events, chunk_size=7)
+
+    # the primary keys are generated by the server, so the events are matched by their submission
+    get = operator.itemgetter if to_dict else operator.attrgetter
+    expected_events = sorted(expected_events, key=get('submission_id'))
+    inserted_events = session.query(models.ResponseEvent).order_by('submission_id').all()
+    assert len(inserted_events) == num_events
+
+    for expected_event, actual_event in zip(expected_events, inserted_events):
+        for k in comparable_properties:
+            assert getattr(actual_event, k) == get(k)(expected_event)
+
+    assert len(mock_logger.messages) == 1
+    assert mock_logger.messages[0].args[0] == num_events
+
+
+def _long_value() -> str:
+    # ~10 kB of random text: too large for a B-tree index entry, even after compression
+    return base64.b64encode(os.urandom(7500)).decode('ascii')
+
+
+@pytest.mark.usefixtures('mock_logger')
+def test_loader_long_value(session: sa_orm.Session, loader):
+    event = factories.ResponseEventFactory.build(value=_long_value())
+    loader([event])
+    session.flush()
+    assert session.query(models.ResponseEvent.value).scalar() == event.value
+
+
+@pytest.mark.usefixtures('mock_logger')
+def test_chunked_copy_loader_long_value(session: sa_orm.Session):
+    event = factories.ResponseEventFactory.build(value=_long_value())
+    chunked_copy_loader(session, [event], chunk_size=10)
+    assert session.query(models.ResponseEvent.value).scalar() == event.value
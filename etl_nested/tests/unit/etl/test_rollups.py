@@ -0,0 +1,90 @@
+import base64
+import datetime
+import os
+import uuid
+
+import pytest
+import sqlalchemy.orm as sa_orm
+
+from app import factories, metrics as run_metrics, models
+from app.etl import loaders, rollups
+from app.util.timestamps import UTC_TZ
+
+
+def _rollup_rows(session: sa_orm.Session) -> tuple:
+    daily_counts = session.query(models.AnswerDailyCount).order_by(
+        models.AnswerDailyCount.form_id, models.AnswerDailyCount.schema_path, models.AnswerDailyCount.value,
+        models.AnswerDailyCount.day)
+    latest_answers = session.query(models.LatestAnswer).order_by(
+        models.LatestAnswer.user_id, models.LatestAnswer.schema_path)
+    return (
+        [(r.form_id, r.schema_path, r.value, r.day, r.num_answers) for r in daily_counts],
+        [(r.user_id, r.schema_path, r.submission_id, r.value) for r in latest_answers],
+    )
+
+
+@pytest.mark.usefixtures('mock_logger', 'general_source_data')
+def test_incremental_rollups_match_rebuild(session: sa_orm.Session, all_processor_configs):
+    config = all_processor_configs['chunked-copy-rollups']
+
+    metrics = run_metrics.RunMetrics()
+    factories.make_processor(session, config, metrics=metrics)()
+    incremental = _rollup_rows(session)
+    assert incremental[0] and incremental[1]
+    assert run_metrics.ROLLUPS_STAGE in metrics.stage_seconds
+
+    rollups.rebuild(session)
+    assert _rollup_rows(session) == incremental
+
+    # processing the submissions again counts their answers twice, like the response events
+    factories.make_processor(session, config)()
+    daily_counts = incremental[0]
+    incremental = _rollup_rows(session)
+    assert [r[4] for r in incremental[0]] == [2 * r[4] for r in daily_counts]
+    rollups.rebuild(session)
+    assert _rollup_rows(session) == incremental
+
+
+def _event(user_id, submission_created, value):
+    return factories.ResponseEventFactory.build(user_id=user_id, schema_path='main.age', value=value,
+                                                submission_created=submission_created)
+
+
+@pytest.mark.usefixtures('mock_logger')
+@pytest.mark.parametrize('chunk_size', [1, 10])
+def test_latest_answer_wins(session: sa_orm.Session, chunk_size):
+    user_id = uuid.uuid4()
+    day = datetime.datetime(2017, 5, 1, 23, 30, tzinfo=UTC_TZ)
+    events = [
+        _event(user_id, day, '2'),
+        _event(user_id, day + datetime.timedelta(days=1), '3'),
+        _event(user_id, day - datetime.timedelta(days=1), '1'),
+    ]
+    loader = loaders.chunked_bulk_save_objects_loader
+    loaders.rollups_loader(session, lambda e: loader(session, e, chunk_size=10), events, chunk_size=chunk_size)
+
+    assert [(r.value, r.submission_id) for r in session.query(models.LatestAnswer)] == [('3', events[1].submission_id)]
+
+    # days are UTC days of the submission
+    assert sorted((r.day, r.num_answers) for r in session.query(models.AnswerDailyCount)) == [
+        (datetime.date(2017, 4, 30), 1),
+        (datetime.date(2017, 5, 1), 1),
+        (datetime.date(2017, 5, 2), 1),
+    ]
+
+
+@pytest.mark.usefixtures('mock_logger')
+def test_rollups_long_answer(session: sa_orm.Session):
+    user_id = uuid.uuid4()
+    # ~10 kB of random text: too large for a B-tree index entry, even after compression
+    value = base64.b64encode(os.urandom(7500)).decode('ascii')
+    events = [_event(user_id, datetime.datetime(2017, 5, 1, tzinfo=UTC_TZ), value) for _ in range(2)]
+    events[1].form_id = events[0].form_id
+    loader = loaders.chunked_bulk_save_objects_loader
+    loaders.rollups_loader(session, lambda e: loader(session, e, chunk_size=10), events)
+
+    assert [(r.value, r.num_answers) for r in session.query(models.AnswerDailyCount)] == [(value, 2)]
+    assert [r.value for r in session.query(models.LatestAnswer)] == [value]
+
+    rollups.rebuild(session)
+    assert [(r.value, r.num_answers) for r in session.query(models.AnswerDailyCount)] == [(value, 2)]
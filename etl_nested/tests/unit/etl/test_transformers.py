@@ -1,10 +1,12 @@
 import copy
+import datetime
+import decimal
 import logging
 import random
 import types
 
 import pytest
-from app import models, factories
+from app import constants, models, factories
 from app.etl import transformers
 from app.util.timestamps import utc_now
 from freezegun import freeze_time
@@ -111,6 +113,27 @@ def _verify_logged_metrics(mock_logger, expected_submissions_processed):
     assert summary_record.args[0] == expected_submissions_processed
 
 
+@pytest.mark.parametrize('answer_type, value, expected', [
+    (constants.AnswerType.number, '27', decimal.Decimal(27)),
+    (constants.AnswerType.number, '4.5', decimal.Decimal('4.5')),
+    (constants.AnswerType.number, 'not a number', None),
+    (constants.AnswerType.boolean, 'true', True),
+    (constants.AnswerType.boolean, 'false', False),
+    (constants.AnswerType.date, '2017-01-15', datetime.date(2017, 1, 15)),
+    (constants.AnswerType.date, 'yesterday', None),
+    (constants.AnswerType.text, 'hello', None),
+])
+def test_parse_typed_value(answer_type, value, expected):
+    assert transformers.parse_typed_value(answer_type, value) == expected
+
+
+def _verify_typed_values(answer_type, value, columns:dict):
+    typed_column = transformers.TYPED_VALUE_COLUMNS.get(answer_type)
+    for column in transformers.TYPED_VALUE_COLUMNS.values():
+        expected = transformers.parse_typed_value(answer_type, value) if column == typed_column else None
+        assert columns[column] == expected
+
+
 def test_json_transform_to_model(session, raw_data, transformer, mock_logger):
     timestamp_submission = utc_now()
     with freeze_time(timestamp_submission):
@@ -144,6 +167,8 @@ def test_json_transform_to_model(session, raw_data, transformer, mock_logger):
 
         assert actual_event.processed_on == timestamp_transformation
 
+        _verify_typed_values(actual_event.answer_type, actual_event.value, actual_event.__dict__)
+
     # convert results to a dictionary of only the data we care about
     sorted_actual_events = sorted(
         ({
@@ -192,6 +217,8 @@ def test_json_transform_to_dict(session, raw_data, transformer):
 
         assert actual_event['processed_on'] == timestamp_transformation
 
+        _verify_typed_values(constants.AnswerType[actual_event['answer_type']], actual_event['value'], actual_event)
+
     sorted_actual_events = sorted(
         ({
             'schema_path': e['schema_path'],
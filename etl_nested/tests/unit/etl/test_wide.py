@@ -0,0 +1,123 @@
+import copy
+import datetime
+import decimal
+import functools
+import os
+import uuid
+
+import pytest
+import sqlalchemy as sa
+import sqlalchemy.orm as sa_orm
+
+from app import factories, models
+from app.etl import loaders, transformers, wide
+from app.util.json import load_json_file
+
+
+@pytest.mark.parametrize('name, reserved, expected', [
+    ('main.age', (), 'main_age'),
+    ('Main Section__Age-1', (), 'main_section__age_1'),
+    ('user_id', ('user_id',), 'user_id_' + wide.hashlib.sha1(b'user_id').hexdigest()[:8]),
+    ('x' * 100, (), 'x' * 54 + '_' + wide.hashlib.sha1(b'x' * 100).hexdigest()[:8]),
+])
+def test_make_identifier(name, reserved, expected):
+    assert wide.make_identifier(name, reserved) == expected
+    assert len(wide.make_identifier(name, reserved)) <= wide.MAX_IDENTIFIER_LEN
+
+
+def test_make_table_name():
+    form_id = uuid.UUID('12345678-1234-5678-1234-567812345678')
+    assert wide.make_table_name(form_id, 'General Form') == 'form_general_form_12345678'
+    assert len(wide.make_table_name(form_id, 'x' * 100)) == wide.MAX_IDENTIFIER_LEN
+    # passthrough response events carry the form id as text
+    assert wide.make_table_name(str(form_id), 'General Form') == 'form_general_form_12345678'
+
+
+def _general_submission(session, form, user, responses):
+    submission = factories.SubmissionFactory(form=form, user=user, responses=responses)
+    session.add(submission)
+    session.flush()
+    return submission
+
+
+@pytest.fixture
+def general_form(session, data_dir):
+    form = factories.FormFactory(schema=load_json_file(os.path.join(data_dir, 'general_schema.json')))
+    session.add(form)
+    session.flush()
+    return form
+
+
+def _process(session, to_dict, chunk_size=2):
+    loader = functools.partial(loaders.chunked_bulk_insert_mappings if to_dict else loaders.naive_loader, session,
+                               **({'chunk_size': 10} if to_dict else {}))
+    events = transformers.transform_submissions(session, session.query(models.Submission), to_dict=to_dict)
+    loaders.wide_tables_loader(session, loader, events, chunk_size=chunk_size)
+
+
+def _wide_rows(session, form):
+    node_map = transformers.make_node_path_map(form.schema)
+    table = wide.make_wide_table(sa.MetaData(), form.id, form.name, node_map).table
+    return table, session.execute(table.select().order_by(table.c.submission_created)).fetchall()
+
+
+@pytest.mark.usefixtures('mock_logger')
+@pytest.mark.parametrize('to_dict', [False, True], ids=['objects', 'dicts'])
+def test_wide_tables_loader(session: sa_orm.Session, general_form, user, to_dict):
+    responses = [
+        {'main': {'age': 27, 'new_member': True, 'signed_on': '2017-01-15', 'first_name': 'Ada'}},
+        {'main': {'age': 4.5, 'new_member': False}},
+        {'main': {'city': 'Newark', 'unknown_question': 'ignored'}},
+    ]
+    submissions = [_general_submission(session, general_form, user, r) for r in responses]
+
+    _process(session, to_dict)
+
+    table, rows = _wide_rows(session, general_form)
+    assert [row.submission_id for row in rows] == [s.id for s in submissions]
+    assert all(row.user_id == user.id and row.user_full_name == user.full_name for row in rows)
+    assert [(row.main__age, row.main__new_member, row.main__signed_on, row.main__first_name, row.main__city)
+            for row in rows] == [
+        (decimal.Decimal(27), True, datetime.date(2017, 1, 15), 'Ada', None),
+        (decimal.Decimal('4.5'), False, None, None, None),
+        (None, None, None, None, 'Newark'),
+    ]
+
+    # reprocessing replaces the rows
+    _process(session, to_dict)
+    assert len(_wide_rows(session, general_form)[1]) == len(responses)
+
+
+@pytest.mark.usefixtures('mock_logger')
+def test_wide_table_new_schema_path(session: sa_orm.Session, general_form, user):
+    _general_submission(session, general_form, user, {'main': {'age': 27}})
+    _process(session, True)
+
+    # a question added to the form schema becomes a new column
+    schema = dict(general_form.schema)
+    schema['children'] = schema['children'] + [{
+        'slug': 'extra', 'nodeType': 'section',
+        'children': [{'slug': 'score', 'nodeType': 'question', 'answerType': 'number'}]
+    }]
+    general_form.schema = schema
+    session.flush()
+    _general_submission(session, general_form, user, {'extra': {'score': 3}})
+    _process(session, True)
+
+    table, rows = _wide_rows(session, general_form)
+    assert [(row.main__age, row.extra__score) for row in rows] == [(27, None), (None, 3)]
+
+
+@pytest.mark.usefixtures('mock_logger')
+def test_wide_tables_passthrough(session: sa_orm.Session, all_processor_configs, general_source_data):
+    config = copy.deepcopy(all_processor_configs['passthrough-copy'])
+    config['loader']['wide_tables'] = True
+    factories.make_processor(session, config)()
+
+    num_rows = 0
+    for form in session.query(models.Form):
+        table, rows = _wide_rows(session, form)
+        submission_ids = session.query(models.Submission.id).filter(models.Submission.form_id == form.id)
+        assert {row.submission_id for row in rows} == {submission_id for submission_id, in submission_ids}
+        num_rows += len(rows)
+    assert num_rows == general_source_data.submissions
@@ -0,0 +1,73 @@
+import csv
+import os
+
+import pytest
+
+from app import bench
+
+
+def _results(config, samples, pg_profile='default'):
+    return [
+        {'scenario': 'small', 'config': config, 'pg_profile': pg_profile, 'repetition': i, 'wall_seconds': s,
+         'statements': 10, 'events_per_second': 100.0}
+        for i, s in enumerate(samples)
+    ]
+
+
+@pytest.mark.parametrize('baseline, candidate, expected_p_value', [
+    ([1.0, 1.1, 0.9], [2.0, 2.1, 1.9], 1 / 20),
+    ([1.0, 1.1, 0.9, 1.0, 1.05], [2.0, 2.1, 1.9, 2.0, 2.05], 1 / 252),
+    ([2.0, 2.1, 1.9], [1.0, 1.1, 0.9], 1.0),
+])
+def test_permutation_test(baseline, candidate, expected_p_value):
+    assert bench.permutation_test(baseline, candidate) == pytest.approx(expected_p_value)
+
+
+def test_permutation_test_sampled():
+    baseline = [1.0 + 0.01 * i for i in range(20)]
+    candidate = [1.5 + 0.01 * i for i in range(20)]
+    assert bench.permutation_test(baseline, candidate) < 0.001
+
+
+def test_compare():
+    baseline = _results('fast', [1.0, 1.1, 0.9, 1.0, 1.05]) + \
+        _results('slow', [1.0, 1.1, 0.9, 1.0, 1.05]) + \
+        _results('noise', [1.0, 1.1, 0.9, 1.0, 1.05])
+    results = _results('fast', [0.5, 0.55, 0.45, 0.5, 0.5]) + \
+        _results('slow', [2.0, 2.1, 1.9, 2.0, 2.05]) + \
+        _results('noise', [1.0, 1.09, 0.91, 1.01, 1.04]) + \
+        _results('new', [1.0])
+
+    comparisons = {c.key.config: c for c in bench.compare(baseline, results)}
+
+    # configurations missing from the baseline are not compared
+    assert set(comparisons) == {'fast', 'slow', 'noise'}
+    assert not comparisons['fast'].regression
+    assert comparisons['slow'].regression
+    assert comparisons['slow'].relative_change == pytest.approx(1.0, rel=0.01)
+    assert not comparisons['noise'].regression
+
+
+def test_compare_profiles():
+    baseline = _results('fast', [1.0, 1.1, 0.9, 1.0, 1.05])
+    for r in baseline:
+        # written before profiles were recorded
+        del r['pg_profile']
+    results = _results('fast', [2.0, 2.1, 1.9, 2.0, 2.05], pg_profile='production-like') + \
+        _results('fast', [1.0, 1.1, 0.9, 1.0, 1.05])
+
+    # runs with different profiles are not compared
+    comparisons = bench.compare(baseline, results)
+    assert [(c.key.pg_profile, c.regression) for c in comparisons] == [('default', False)]
+
+
+def test_write_results(tmpdir):
+    results = _results('fast', [1.0, 2.0])
+    pathname = os.path.join(str(tmpdir), 'results.json')
+
+    bench.write_results(results, pathname)
+
+    assert bench.load_results(pathname) == results
+    with open(os.path.join(str(tmpdir), 'results.csv')) as f:
+        rows = list(csv.DictReader(f))
+    assert [float(r['wall_seconds']) for r in rows] == [1.0, 2.0]
@@ -0,0 +1,43 @@
+import time
+
+from app import cpuprofile, metrics as run_metrics
+
+
+def _spin(seconds:float):
+    end = time.process_time() + seconds
+    while time.process_time() < end:
+        pass
+
+
+def test_stack_sampler(tmpdir):
+    metrics = run_metrics.RunMetrics()
+    sampler = cpuprofile.StackSampler(metrics, interval=0.001)
+    with sampler:
+        with metrics.stage(run_metrics.TRANSFORMER_STAGE):
+            _spin(0.1)
+        _spin(0.05)
+
+    counts = sampler.sample_counts()
+    assert counts[run_metrics.TRANSFORMER_STAGE] > 0
+    assert counts[cpuprofile.NO_STAGE] > 0
+    # innermost frames come last, with paths relative to the project root
+    assert any(stack.endswith('_spin (tests/unit/test_cpuprofile.py:{})'.format(_spin.__code__.co_firstlineno))
+               for stack in sampler.samples[run_metrics.TRANSFORMER_STAGE])
+
+    filenames = sampler.write_collapsed(str(tmpdir.join('run')))
+    assert set(filenames) == set(counts)
+    with open(filenames[run_metrics.TRANSFORMER_STAGE]) as f:
+        lines = f.read().splitlines()
+    assert sum(int(line.rsplit(' ', 1)[1]) for line in lines) == counts[run_metrics.TRANSFORMER_STAGE]
+
+    assert sampler.report(filenames)['samples'] == counts
+
+
+def test_stack_sampler_stopped():
+    sampler = cpuprofile.StackSampler(interval=0.001)
+    with sampler:
+        _spin(0.02)
+    num_samples = sum(sampler.sample_counts().values())
+
+    _spin(0.02)
+    assert sum(sampler.sample_counts().values()) == num_samples
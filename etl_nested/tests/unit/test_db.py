@@ -0,0 +1,133 @@
+import json
+import os
+import shutil
+import sys
+
+import pytest
+
+from app import constants, db as perf_db
+from app.util.json import load_json_file
+
+
+@pytest.fixture
+def tmp_conf_dir(tmpdir, conf_path):
+    conf_dir = os.path.join(str(tmpdir), 'conf')
+    shutil.copytree(conf_path, conf_dir)
+    return conf_dir
+
+
+def _update_json(pathname, f_update):
+    with open(pathname) as f:
+        data = json.load(f)
+    f_update(data)
+    with open(pathname, 'w') as f:
+        json.dump(data, f)
+
+
+def test_template_key(tmp_conf_dir):
+    perfdata_path = os.path.join(tmp_conf_dir, constants.PERFDATA_CONFIG_FILE)
+    original_key = perf_db.make_template_key('small', tmp_conf_dir)
+
+    # stable for the same content
+    assert perf_db.make_template_key('small', tmp_conf_dir) == original_key
+
+    # other scenarios are irrelevant
+    _update_json(perfdata_path, lambda d: d['medium']['metrics'].update(users=3))
+    assert perf_db.make_template_key('small', tmp_conf_dir) == original_key
+
+    # schema file contents are relevant
+    _update_json(os.path.join(tmp_conf_dir, 'schemas', 'general.json'), lambda d: d.update(name='changed'))
+    schema_key = perf_db.make_template_key('small', tmp_conf_dir)
+    assert schema_key != original_key
+
+    # the default generator is not seeded
+    _update_json(perfdata_path, lambda d: d['small'].update(seed=1))
+    assert perf_db.make_template_key('small', tmp_conf_dir) == schema_key
+
+    # the generator and the seed of the fast generator are relevant
+    _update_json(perfdata_path, lambda d: d['small'].update(generator='fast'))
+    fast_key = perf_db.make_template_key('small', tmp_conf_dir)
+    assert fast_key != schema_key
+
+    _update_json(perfdata_path, lambda d: d['small'].update(seed=2))
+    seed_key = perf_db.make_template_key('small', tmp_conf_dir)
+    assert seed_key != fast_key
+
+    # the Postgres settings profile is not
+    _update_json(perfdata_path, lambda d: d['small'].update(pg_profile='bulk-load'))
+    assert perf_db.make_template_key('small', tmp_conf_dir) == seed_key
+
+
+def test_template_key_file(tmpdir):
+    root_dir = str(tmpdir)
+    os.makedirs(os.path.join(root_dir, perf_db.PerfTestDatabase.TEMPLATES_SUBDIR, 'small'))
+
+    assert perf_db.read_template_key(root_dir, 'small') is None
+    assert not perf_db.is_template_current(root_dir, 'small', 'abc')
+
+    perf_db.write_template_key(root_dir, 'small', 'abc')
+    assert perf_db.read_template_key(root_dir, 'small') == 'abc'
+    assert perf_db.is_template_current(root_dir, 'small', 'abc')
+    assert not perf_db.is_template_current(root_dir, 'small', 'def')
+
+
+def test_pg_profiles(conf_path, monkeypatch):
+    monkeypatch.setattr(perf_db, 'postgres_server_version', lambda: 90600)
+
+    # every scenario's profile exists and settings that the server does not support are skipped
+    for scenario_name in load_json_file(os.path.join(conf_path, constants.PERFDATA_CONFIG_FILE)):
+        perf_db.load_pg_profile(perf_db.scenario_pg_profile(scenario_name, conf_path), conf_path)
+    settings = perf_db.load_pg_profile('bulk-load', conf_path)
+    assert settings['max_parallel_workers_per_gather'] == '4'
+    assert 'max_parallel_maintenance_workers' not in settings
+
+    assert perf_db.make_postgres_args({'work_mem': '64MB', 'fsync': 'off'}) == \
+        perf_db.BASE_POSTGRES_ARGS + ' -c fsync=off -c work_mem=64MB'
+
+
+def _make_data_dir(root_dir):
+    data_dir = os.path.join(root_dir, 'data')
+    os.makedirs(os.path.join(data_dir, 'base'))
+    with open(os.path.join(data_dir, 'PG_VERSION'), 'w') as f:
+        f.write('9.6\n')
+    with open(os.path.join(data_dir, 'base', '1234'), 'wb') as f:
+        f.write(os.urandom(1024))
+    return data_dir
+
+
+def _read_tree(root_dir):
+    contents = {}
+    for dirpath, _, filenames in os.walk(root_dir):
+        for filename in filenames:
+            pathname = os.path.join(dirpath, filename)
+            with open(pathname, 'rb') as f:
+                contents[os.path.relpath(pathname, root_dir)] = f.read()
+    return contents
+
+
+@pytest.mark.parametrize('method', [perf_db.CloneMethod.auto, perf_db.CloneMethod.copy])
+def test_clone_data_directory(tmpdir, method):
+    source = _make_data_dir(str(tmpdir))
+    dest = os.path.join(str(tmpdir), 'clone')
+
+    used_method = perf_db.clone_data_directory(source, dest, method)
+
+    assert used_method in (perf_db.CloneMethod.reflink, perf_db.CloneMethod.copy)
+    if method == perf_db.CloneMethod.copy:
+        assert used_method == perf_db.CloneMethod.copy
+    assert _read_tree(dest) == _read_tree(source)
+
+
+def test_clone_data_directory_fallback(tmpdir, monkeypatch):
+    source = _make_data_dir(str(tmpdir))
+    monkeypatch.setattr(perf_db, '_reflink_unsupported_devices', set())
+    monkeypatch.setattr(perf_db, 'REFLINK_COMMANDS', {sys.platform: ['false']})
+
+    with pytest.raises(OSError):
+        perf_db.clone_data_directory(source, os.path.join(str(tmpdir), 'clone1'), perf_db.CloneMethod.reflink)
+
+    # falls back to a plain copy and remembers that the file system does not support reflinks
+    dest = os.path.join(str(tmpdir), 'clone2')
+    assert perf_db.clone_data_directory(source, dest) == perf_db.CloneMethod.copy
+    assert _read_tree(dest) == _read_tree(source)
+    assert os.stat(source).st_dev in perf_db._reflink_unsupported_devices
@@ -0,0 +1,83 @@
+import pytest
+import sqlalchemy.engine as sa_engine
+import sqlalchemy.orm as sa_orm
+
+from app import explain, factories, metrics as run_metrics, models
+from app.util.json import load_json_file
+
+
+SAMPLE_PLAN = [{
+    'Plan': {
+        'Node Type': 'Hash Join',
+        'Plan Rows': 100,
+        'Actual Rows': 400,
+        'Actual Loops': 1,
+        'Shared Hit Blocks': 10,
+        'Shared Read Blocks': 5,
+        'Plans': [
+            {'Node Type': 'Seq Scan', 'Relation Name': 'form_responses', 'Plan Rows': 400, 'Actual Rows': 400,
+             'Actual Loops': 1, 'Shared Hit Blocks': 8, 'Shared Read Blocks': 5},
+            {'Node Type': 'Index Scan', 'Relation Name': 'users', 'Index Name': 'users_pkey', 'Plan Rows': 1,
+             'Actual Rows': 1, 'Actual Loops': 3, 'Shared Hit Blocks': 2, 'Shared Read Blocks': 0},
+        ],
+    },
+    'Planning Time': 0.5,
+    'Execution Time': 12.5,
+}]
+
+
+def test_summarize_plan():
+    summary = explain.summarize_plan(SAMPLE_PLAN)
+
+    assert summary['planning_ms'] == 0.5
+    assert summary['execution_ms'] == 12.5
+    assert summary['shared_hit_blocks'] == 10
+    assert summary['shared_read_blocks'] == 5
+    assert summary['max_row_misestimate'] == 4.0
+    assert [(n['node_type'], n['relation'], n['estimated_rows'], n['actual_rows']) for n in summary['nodes']] == [
+        ('Hash Join', None, 100, 400),
+        ('Seq Scan', 'form_responses', 400, 400),
+        ('Index Scan', 'users', 1, 3),
+    ]
+
+
+@pytest.mark.usefixtures('mock_logger', 'general_source_data')
+@pytest.mark.parametrize('config_name, expected_stages', [
+    ('chunked-mappings', ['extractor', 'loader']),
+    # COPY is not seen by SQLAlchemy
+    ('passthrough-copy', ['extractor']),
+])
+def test_explain_captured(session: sa_orm.Session, db_engine: sa_engine.Engine, all_processor_configs, tmpdir,
+                          config_name, expected_stages):
+
+    metrics = run_metrics.RunMetrics()
+    plan_capture = explain.PlanCapture(metrics)
+    processor = factories.make_processor(session, all_processor_configs[config_name], metrics=metrics)
+    with metrics.measure(db_engine):
+        plan_capture.install(db_engine)
+        try:
+            processor()
+        finally:
+            plan_capture.uninstall()
+    num_events = session.query(models.ResponseEvent).count()
+
+    explained = explain.explain_captured(session, plan_capture)
+    assert [e.captured.stage for e in explained] == expected_stages
+    assert explained[0].summary['nodes'][-1]['actual_rows'] > 0
+    assert all(e.summary['execution_ms'] is not None for e in explained)
+
+    # the explained loader statement was rolled back
+    assert session.query(models.ResponseEvent).count() == num_events
+
+    summaries = explain.report(explained)
+    assert [s['stage'] for s in summaries] == expected_stages
+
+    pathname = str(tmpdir.join('plans.json'))
+    explain.write_plans(explained, pathname)
+    assert [p['stage'] for p in load_json_file(pathname)] == expected_stages
+
+
+def test_has_loader_plan(all_processor_configs):
+    assert explain.has_loader_plan(all_processor_configs['chunked-mappings'])
+    for config_name in ('chunked-copy', 'passthrough-copy', 'dimension-cache-copy'):
+        assert not explain.has_loader_plan(all_processor_configs[config_name])
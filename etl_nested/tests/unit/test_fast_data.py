@@ -0,0 +1,74 @@
+import json
+import os
+import random
+
+import pytest
+import sqlalchemy.orm as sa_orm
+
+from app import constants, fast_data, models, factories
+from app.etl import transformers
+from app.util.json import load_json_file
+
+
+def _leaf_paths(node:dict, path:tuple=()):
+    for k, v in node.items():
+        if isinstance(v, dict):
+            yield from _leaf_paths(v, path + (k,))
+        else:
+            yield '.'.join(path + (k,)), v
+
+
+@pytest.mark.parametrize('fixture_name', ['empty', 'simple', 'general', 'nested'])
+def test_render_response(data_dir, fixture_name):
+    schema = load_json_file(os.path.join(data_dir, '{}_schema.json'.format(fixture_name)))
+    node_map = transformers.make_node_path_map(schema)
+    template = fast_data.compile_response_template(node_map)
+    pools = fast_data.make_value_pools(pool_size=10)
+
+    text = fast_data.render_response(template, pools, random.Random(0))
+    assert text == fast_data.render_response(template, pools, random.Random(0))
+
+    # undo the COPY escaping to get the JSON text that is stored in the database
+    responses = json.loads(text.replace('\\\\', '\\'))
+    leaves = dict(_leaf_paths(responses))
+    assert set(leaves) == set(node_map)
+    for path, value in leaves.items():
+        expected_type = {
+            constants.AnswerType.number: int,
+            constants.AnswerType.text: str,
+            constants.AnswerType.boolean: bool,
+            constants.AnswerType.date: str,
+        }[node_map[path].answer_type]
+        assert type(value) == expected_type
+
+
+@pytest.mark.usefixtures('mock_logger')
+@pytest.mark.parametrize('metrics', [
+    factories.SourceDataMetrics(forms=0, users=0, submissions=0),
+    factories.SourceDataMetrics(forms=1, users=1, submissions=1),
+    factories.SourceDataMetrics(forms=2, users=3, submissions=25),
+])
+def test_make_source_data_fast(session: sa_orm.Session, simple_form_schema, metrics):
+    fast_data.make_source_data_fast(session, metrics, [simple_form_schema], workers=2, chunk_size=10)
+
+    assert session.query(models.Form).count() == metrics.forms
+    assert session.query(models.User).count() == metrics.users
+
+    submissions = session.query(models.Submission).all()
+    assert len(submissions) == metrics.submissions
+    assert len({s.id for s in submissions}) == metrics.submissions
+
+    # every submission answers the single question of the simple form
+    events = list(transformers.transform_submissions(session, submissions))
+    assert len(events) == metrics.submissions
+    assert all(isinstance(s.responses['basic_info']['bmi'], int) for s in submissions)
+
+
+@pytest.mark.parametrize('metrics', [
+    factories.SourceDataMetrics(forms=1, users=0, submissions=1),
+    factories.SourceDataMetrics(forms=0, users=1, submissions=1),
+])
+def test_make_source_data_fast_invalid(session: sa_orm.Session, simple_form_schema, metrics):
+    with pytest.raises(ValueError):
+        fast_data.make_source_data_fast(session, metrics, [simple_form_schema], workers=1)
+    assert session.query(models.Form).count() == 0
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+import sqlalchemy.orm as sa_orm
+
+from app import metrics as run_metrics, models, processor
+
+
+@pytest.mark.parametrize('seconds, expected_bucket', [
+    (0.0, '<=1us'),
+    (0.000001, '<=2us'),
+    (0.000003, '<=4us'),
+    (0.001, '<=1024us'),
+])
+def test_histogram_buckets(seconds, expected_bucket):
+    histogram = run_metrics.Histogram()
+    histogram.add(seconds)
+
+    result = histogram.as_dict()
+    assert result['count'] == 1
+    assert result['max_seconds'] == seconds
+    assert result['buckets'] == {expected_bucket: 1}
+
+
+def test_nested_stages_are_exclusive():
+    metrics = run_metrics.RunMetrics()
+
+    def _inner():
+        with metrics.stage('inner'):
+            yield 1
+            yield 2
+
+    items = list(metrics.timed_iter('outer', _inner(), 'items'))
+    assert items == [1, 2]
+    assert metrics.counts['items'] == 2
+    assert set(metrics.stage_seconds) == {'inner', 'outer'}
+    assert metrics.current_stage is None
+
+
+@pytest.mark.usefixtures('mock_logger')
+@pytest.mark.parametrize('trace_malloc', [False, True])
+def test_processor_report(session: sa_orm.Session, extractor, transformer, loader, source_data, trace_malloc):
+    metrics = run_metrics.RunMetrics(trace_malloc=trace_malloc, scenario='test')
+
+    with metrics.measure(session.get_bind()):
+        processor.process(extractor, transformer, loader, metrics=metrics)
+        session.flush()
+
+    report = metrics.report()
+
+    # report must be serializable as is
+    assert json.loads(json.dumps(report)) == report
+
+    assert report['scenario'] == 'test'
+    assert report['counts'].get('submissions', 0) == source_data.submissions
+    assert report['counts'].get('events', 0) == session.query(models.ResponseEvent).count()
+    assert report['wall_seconds'] > 0
+    assert report['memory']['max_rss_bytes'] > 0
+    assert (report['memory']['tracemalloc_peak_bytes'] is not None) == trace_malloc
+
+    # the extractor always needs at least one round-trip to the database
+    assert report['stages']['extractor']['batch_latency']['count'] >= 1
+    assert set(report['stages']) >= {'extractor', 'transformer', 'loader'}
@@ -0,0 +1,48 @@
+import os
+import pstats
+import random
+
+import pytest
+
+from app import microbench
+from app.etl import transformers
+
+
+@pytest.mark.parametrize('shape, expected_num_leaves', [
+    (microbench.SyntheticShape(depth=0, breadth=3, leaves=4), 4),
+    (microbench.SyntheticShape(depth=1, breadth=3, leaves=4), 12),
+    (microbench.SyntheticShape(depth=3, breadth=2, leaves=5), 40),
+])
+def test_synthetic_schema(shape, expected_num_leaves):
+    schema = microbench.make_synthetic_schema(shape)
+    node_map = transformers.make_node_path_map(schema)
+
+    assert len(node_map) == expected_num_leaves
+    assert all(len(path.split('.')) == shape.depth + 1 for path in node_map)
+
+
+def test_run(tmpdir):
+    cases = microbench.make_cases(microbench.SyntheticShape(depth=1, breadth=2, leaves=2), ['general'],
+                                  num_submissions=2)
+    assert [c.name for c in cases] == ['synthetic(depth=1,breadth=2,leaves=2)', 'general']
+
+    profile_filename = os.path.join(str(tmpdir), 'microbench.stats')
+    results = microbench.run(cases, min_seconds=0.01, profile_filename=profile_filename)
+
+    assert len(results) == len(cases) * len(microbench.BENCHMARK_FUNCTIONS)
+    synthetic_results = [r for r in results if r.case == cases[0].name]
+    assert all(r.events == 8 for r in synthetic_results)
+    assert all(r.ns_per_event > 0 for r in results)
+    # the results of the pass are allocated during the pass and still referenced after it
+    assert all(r.allocated_bytes_per_event >= r.retained_bytes_per_event > 0 for r in results)
+    assert pstats.Stats(profile_filename).total_calls > 0
+
+
+def test_make_cases_random_state():
+    state = random.getstate()
+    cases = microbench.make_cases(microbench.SyntheticShape(depth=1, breadth=2, leaves=4), num_submissions=3, seed=1)
+    assert random.getstate() == state
+
+    # the fake responses only depend on the seed
+    again = microbench.make_cases(microbench.SyntheticShape(depth=1, breadth=2, leaves=4), num_submissions=3, seed=1)
+    assert [s.responses for s in cases[0].submissions] == [s.responses for s in again[0].submissions]
@@ -80,3 +80,13 @@ def test_submission_answer_type(session, simple_form, user, variant_answer):
     assert serialized_event
     assert serialized_event.answer_type == variant_answer['answer_type']
     assert serialized_event.value == variant_answer['value']
+
+
+def test_session_isolation(session, db_engine, user):
+    # commits by the code under test are rolled back along with the rest of the test
+    session.commit()
+    assert session.query(models.User).count() == 1
+
+    users_table = models.User.__table__
+    count_query = 'SELECT count(*) FROM {}.{}'.format(users_table.schema, users_table.name)
+    assert db_engine.execute(count_query).scalar() == 0
@@ -0,0 +1,77 @@
+import os
+import time
+
+import pytest
+import sqlalchemy as sa
+
+from app import pg_server
+
+
+@pytest.fixture
+def server(tmpdir):
+    # short socket path (see PerfTestDatabase.MAX_DATA_DIR_PATH_LEN)
+    server = pg_server.WarmServer(os.path.join(str(tmpdir), 'srv'), idle_timeout=60)
+    yield server
+    server.stop()
+
+
+def _execute(url:str, statement:str):
+    engine = sa.create_engine(url)
+    try:
+        result = engine.execute(statement)
+        return result.scalar() if result.returns_rows else None
+    finally:
+        engine.dispose()
+
+
+@pytest.mark.parametrize('components, expected', [
+    (('run', 'small'), 'run_small'),
+    (('template', 'large-fast', 'ABC'), 'template_large_fast_abc'),
+    (('x' * 100,), 'x' * 63),
+])
+def test_make_database_name(components, expected):
+    assert pg_server.make_database_name(*components) == expected
+
+
+def test_start_stop(server):
+    assert server.status() is None
+
+    url = server.start()
+    assert _execute(url, 'SELECT 1') == 1
+
+    # a second start (e.g. by another invocation) reuses the running server
+    assert pg_server.WarmServer(server.base_dir).start() == url
+    assert server.status()['url'] == url
+
+    server.stop()
+    assert server.status() is None
+
+
+def test_temporary_database(server):
+    server.start()
+    server.create_database('tpl')
+    _execute(server.url('tpl'), 'CREATE TABLE t AS SELECT 42 AS x')
+
+    with server.temporary_database('test', template='tpl') as url1, server.temporary_database('test') as url2:
+        assert url1 != url2
+        assert _execute(url1, 'SELECT x FROM t') == 42
+        assert _execute(url2, "SELECT to_regclass('t') IS NULL")
+
+        names = server.database_names('test_')
+        assert len(names) == 2
+
+    assert server.database_names('test_') == []
+
+
+def test_idle_shutdown(tmpdir):
+    server = pg_server.WarmServer(os.path.join(str(tmpdir), 'srv'), idle_timeout=1)
+    try:
+        server.start()
+
+        # the watchdog stops the server once it was idle for the timeout
+        deadline = time.time() + 20
+        while server.status() is not None and time.time() < deadline:
+            time.sleep(0.5)
+        assert server.status() is None
+    finally:
+        server.stop()
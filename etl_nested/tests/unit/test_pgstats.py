@@ -0,0 +1,59 @@
+import sqlalchemy.orm as sa_orm
+
+from app import factories, pgstats
+
+
+def test_parse_lsn():
+    assert pgstats.parse_lsn('0/0') == 0
+    assert pgstats.parse_lsn('16/B374D848') == (0x16 << 32) + 0xB374D848
+
+
+def test_take_snapshot(session: sa_orm.Session, simple_form_schema):
+    before = pgstats.take_snapshot(session)
+    factories.make_source_data(session, factories.SourceDataMetrics(forms=1, users=2, submissions=10),
+                               [simple_form_schema])
+    after = pgstats.take_snapshot(session)
+
+    server_diff = pgstats.diff(before, after)
+    assert server_diff['wal_bytes'] > 0
+    assert set(server_diff['database']) == set(pgstats.DATABASE_COUNTERS)
+    assert set(server_diff['checkpoints']) == {'checkpoints_timed', 'checkpoints_requested',
+                                               'checkpoint_buffers_written'}
+    assert all(v >= 0 for v in server_diff['database'].values())
+    if not pgstats.has_pg_stat_statements(session.connection()):
+        assert server_diff['statements'] is None
+
+
+def _statement(query, calls, total_ms):
+    return {'query': query, 'calls': calls, 'rows': calls, 'shared_blks_hit': 0, 'shared_blks_read': 0,
+            'temp_blks_written': 0, 'total_ms': total_ms, 'wal_bytes': None}
+
+
+def test_diff_statements():
+    before = pgstats.ServerSnapshot(100, {'blks_hit': 5}, {}, {
+        1: _statement('SELECT 1', 10, 5.0),
+        2: _statement('SELECT 2', 1, 1.0),
+    })
+    after = pgstats.ServerSnapshot(150, {'blks_hit': 8}, {}, {
+        1: _statement('SELECT 1', 12, 6.0),
+        2: _statement('SELECT 2', 1, 1.0),
+        3: _statement('INSERT 3', 4, 20.0),
+    })
+
+    server_diff = pgstats.diff(before, after, top=5)
+    assert server_diff['wal_bytes'] == 50
+    assert server_diff['database'] == {'blks_hit': 3}
+    # statements which were not called in between are left out
+    assert [(s['query'], s['calls'], s['total_ms']) for s in server_diff['statements']] == [
+        ('INSERT 3', 4, 20.0),
+        ('SELECT 1', 2, 1.0),
+    ]
+    assert server_diff['statements'][0]['wal_bytes'] is None
+
+
+def test_diff_snapshot_commits():
+    before = pgstats.ServerSnapshot(0, {'xact_commit': 10, 'blks_hit': 5}, {}, None)
+    after = pgstats.ServerSnapshot(0, {'xact_commit': 15, 'blks_hit': 8}, {}, None)
+
+    # the commits of the snapshots themselves are not part of the run
+    assert pgstats.diff(before, after)['database'] == {'xact_commit': 5 - pgstats.SNAPSHOT_COMMITS, 'blks_hit': 3}
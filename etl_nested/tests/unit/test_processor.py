@@ -1,17 +1,9 @@
 import functools
-import os
 
 import pytest
 import sqlalchemy.orm as sa_orm
-from app import constants, models, processor, factories
+from app import models, processor, factories
 from app.etl import transformers, loaders
-from app.util.json import load_json_file
-
-
-@pytest.fixture(scope='module')
-def all_processor_configs(conf_path):
-    processors_conf_path = os.path.join(conf_path, constants.PROCESSOR_CONFIG_FILE)
-    return load_json_file(processors_conf_path)
 
 
 # TODO extend to retrieve keys dynamically from all_processor_configs fixture
@@ -77,3 +69,19 @@ def test_make_processor(session: sa_orm.Session, processor_config,
 
     actual_num_events = session.query(models.ResponseEvent).count()
     assert actual_num_events == 1
+
+
+def _response_event_rows(session: sa_orm.Session) -> list:
+    columns = [c for c in models.ResponseEvent.__table__.columns if c.name not in ('id', 'processed_on')]
+    return sorted(tuple(row) for row in session.query(*columns))
+
+
+@pytest.mark.usefixtures('mock_logger', 'general_source_data')
+@pytest.mark.parametrize('config_name', ['passthrough-copy', 'passthrough-copy-streaming'])
+def test_passthrough_matches_default(session: sa_orm.Session, all_processor_configs, config_name):
+    factories.make_processor(session, all_processor_configs['chunked-copy'])()
+    expected_rows = _response_event_rows(session)
+    session.query(models.ResponseEvent).delete()
+
+    factories.make_processor(session, all_processor_configs[config_name])()
+    assert _response_event_rows(session) == expected_rows
@@ -0,0 +1,82 @@
+import os
+
+import pytest
+import sqlalchemy.engine as sa_engine
+import sqlalchemy.orm as sa_orm
+
+from app import constants, models, factories
+from app.util.json import load_json_file
+from tests.query_budget import QueryBudget, assert_query_budget, count_statements
+
+
+def _load_processor_configs():
+    # NOTE: pytest fixtures are not available while collecting parameters so the config is loaded directly
+    return load_json_file(os.path.join(constants.DEFAULT_CONFIG_DIR, constants.PROCESSOR_CONFIG_FILE))
+
+
+# The fixed part covers the extractor query and the per-form statements (node path map and Form lazy loads).
+# The budgets of the naive configurations are intentionally large: they document what each strategy costs.
+BUDGETS = {
+    # lazy loads for every new user + one INSERT per event
+    'naive-single': QueryBudget(fixed=10, per_submission=1, per_event=1),
+    # one INSERT per event (the ORM needs RETURNING for server generated primary keys)
+    'naive-all': QueryBudget(fixed=10, per_submission=0, per_event=1),
+    # one flush per event
+    'load-single-flush-single': QueryBudget(fixed=10, per_submission=0, per_event=1),
+    # one executemany per chunk of 5 events (chunks are split further when only some events have a tag)
+    'chunked-objects-small': QueryBudget(fixed=14, per_submission=0, per_event=0.2),
+    # lazy loads for every new user, but batched inserts
+    'chunked-objects-no-join': QueryBudget(fixed=10, per_submission=1, per_event=0),
+    'chunked-objects-with-join': QueryBudget(fixed=10, per_submission=0, per_event=0),
+    'chunked-mappings': QueryBudget(fixed=10, per_submission=0, per_event=0),
+    # table statistics, then the users and forms are prefetched (or joined)
+    'chunked-mappings-auto': QueryBudget(fixed=15, per_submission=0, per_event=0),
+    # dropping and rebuilding the indexes, then ANALYZE
+    'chunked-mappings-deferred-indexes': QueryBudget(fixed=20, per_submission=0, per_event=0),
+    # per form: node path map, table check and CREATE TABLE, then one upsert per chunk of rows
+    'chunked-mappings-wide-tables': QueryBudget(fixed=22, per_submission=0, per_event=0),
+    # NOTE: COPY statements run on the DBAPI cursor and are not counted
+    'chunked-copy': QueryBudget(fixed=10, per_submission=0, per_event=0),
+    # one upsert per rollup and chunk of events
+    'chunked-copy-rollups': QueryBudget(fixed=12, per_submission=0, per_event=0),
+    # the extractor joins the forms and users, so only the node path maps are loaded separately
+    'passthrough-copy': QueryBudget(fixed=5, per_submission=0, per_event=0),
+    'passthrough-copy-raw-json': QueryBudget(fixed=5, per_submission=0, per_event=0),
+    'passthrough-copy-streaming': QueryBudget(fixed=5, per_submission=0, per_event=0),
+    # the users and forms are loaded once per chunk of submissions with missing ones
+    'dimension-cache-copy': QueryBudget(fixed=7, per_submission=0, per_event=0),
+}
+
+
+def test_all_configs_have_budgets():
+    assert set(_load_processor_configs()) == set(BUDGETS)
+
+
+@pytest.mark.usefixtures('mock_logger')
+@pytest.mark.parametrize('config_name', sorted(_load_processor_configs()))
+@pytest.mark.parametrize('metrics', [
+    factories.SourceDataMetrics(forms=1, users=1, submissions=1),
+    factories.SourceDataMetrics(forms=2, users=3, submissions=12),
+    factories.SourceDataMetrics(forms=3, users=12, submissions=12),
+], ids=[
+    'single_submission',
+    'few_users',
+    'many_users',
+])
+def test_processor_query_budget(session: sa_orm.Session, db_engine: sa_engine.Engine, data_dir,
+                                config_name, metrics):
+    schema = load_json_file(os.path.join(data_dir, 'general_schema.json'))
+    factories.make_source_data(session, metrics, [schema])
+
+    # start with an empty identity map so that related objects are not loaded for free
+    session.expunge_all()
+
+    test_processor = factories.make_processor(session, _load_processor_configs()[config_name])
+    with count_statements(db_engine) as stats:
+        test_processor()
+        session.flush()
+
+    num_events = session.query(models.ResponseEvent).count()
+    assert num_events > 0
+
+    assert_query_budget(stats, BUDGETS[config_name], metrics.submissions, num_events)
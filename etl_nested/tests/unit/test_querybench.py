@@ -0,0 +1,27 @@
+import pytest
+import sqlalchemy.orm as sa_orm
+
+from app import factories, models, querybench
+from app.etl import indexes
+
+
+@pytest.mark.usefixtures('mock_logger', 'general_source_data')
+def test_querybench(session: sa_orm.Session, all_processor_configs):
+    factories.make_processor(session, all_processor_configs['chunked-mappings-deferred-indexes'])()
+
+    results = querybench.run(session, repetitions=1)
+
+    assert [r.name for r in results] == [q.name for q in querybench.ANALYST_QUERIES]
+    assert all(r.rows > 0 for r in results if r.name != 'submissions_in_range')
+    assert all(r.before_seconds > 0 and r.after_seconds > 0 for r in results)
+
+    # the indexes dropped for the 'before' timings are back
+    inspector_names = {
+        name for name, in session.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'response_events'")
+    }
+    assert {index.name for index in indexes.table_indexes(models.ResponseEvent.__table__)} <= inspector_names
+
+
+def test_querybench_empty(session: sa_orm.Session):
+    with pytest.raises(ValueError):
+        querybench.run(session)
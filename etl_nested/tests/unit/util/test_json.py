@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+from app.util import json as json_util
+
+
+def test_get_decoder_json():
+    assert json_util.get_decoder('json') is json.loads
+
+
+def test_get_decoder_auto():
+    decode = json_util.get_decoder(json_util.AUTO_DECODER)
+    assert decode('{"a": [1, "b", true, null]}') == {'a': [1, 'b', True, None]}
+
+
+def test_get_decoder_unknown():
+    with pytest.raises(ValueError):
+        json_util.get_decoder('simplejson')
+
+
+STREAMED_DOCUMENT = {
+    'main': {
+        'age': 42,
+        'height': 1.85,
+        'smoker': False,
+        'name': 'O\'Brien "Bob" é\\',
+        'notes': None,
+        'extra': {'skipped': ['}', {'a': '"'}], 'deeper': {'x': 1}},
+        'list': [1, 2, 3],
+    },
+    'unknown': {'age': 7},
+    'date': '2017-01-15',
+}
+
+
+@pytest.mark.parametrize('indent', [None, 2])
+def test_iter_scalars(indent):
+    leaf_paths = {'main.age', 'main.height', 'main.smoker', 'main.name', 'main.notes', 'main.list', 'date',
+                  'main.missing.value'}
+    text = json.dumps(STREAMED_DOCUMENT, indent=indent)
+
+    actual = list(json_util.iter_scalars(text, leaf_paths, json_util.make_container_paths(leaf_paths)))
+    assert actual == [
+        ('main.age', 42),
+        ('main.height', 1.85),
+        ('main.smoker', False),
+        ('main.name', STREAMED_DOCUMENT['main']['name']),
+        ('main.notes', None),
+        ('date', '2017-01-15'),
+    ]
+
+
+@pytest.mark.parametrize('text', ['{}', 'null', '[{"a": 1}]'])
+def test_iter_scalars_no_paths(text):
+    assert list(json_util.iter_scalars(text, {'a'}, frozenset())) == []
+
+
+@pytest.mark.parametrize('text', ['{"a": 1', '{"a" 1}', '{"a": tru}', '{"b": [1, 2}', '{"b": [1, 2}, "a": 1}',
+                                  '{"b": {"c": 1]], "a": 1}'])
+def test_iter_scalars_invalid(text):
+    with pytest.raises(ValueError):
+        list(json_util.iter_scalars(text, {'a'}, frozenset()))
+
+
+# like json.loads(), the last value of a duplicate key wins
+@pytest.mark.parametrize('text, expected', [
+    ('{"a": 1, "a": 2}', [('a', 2)]),
+    ('{"a": {"b": 1, "c": 2}, "a": {"c": 3}}', [('a.c', 3)]),
+    ('{"a": {"b": 1}, "a": 2}', [('a', 2)]),
+    ('{"a": 1, "a": {"b": [1], "b": 2}}', [('a.b', 2)]),
+    ('{"a": {"b": 1, "b": {"x": 1}}}', []),
+])
+def test_iter_scalars_duplicate_keys(text, expected):
+    leaf_paths = {'a', 'a.b', 'a.c'}
+    actual = list(json_util.iter_scalars(text, leaf_paths, json_util.make_container_paths(leaf_paths)))
+    assert actual == expected
+
+
+def test_make_container_paths():
+    assert json_util.make_container_paths(['a.b.c', 'a.d', 'e']) == {'a', 'a.b'}
@@ -0,0 +1,61 @@
+import pytest
+import sqlalchemy.engine as sa_engine
+import sqlalchemy.orm as sa_orm
+
+from app import models, factories
+from app.util import sqlstats
+
+
+@pytest.mark.parametrize('statement, expected', [
+    (
+        'SELECT a\n    FROM b   WHERE c = %(c_1)s',
+        'SELECT a FROM b WHERE c = ?'
+    ),
+    (
+        "SELECT a FROM b WHERE c IN (%(c_1)s, %(c_2)s, %(c_3)s) AND d = 'x' LIMIT 10",
+        'SELECT a FROM b WHERE c IN (?, ...) AND d = ? LIMIT ?'
+    ),
+    (
+        'SELECT anon_1.param_1 FROM users2 AS anon_1',
+        'SELECT anon_1.param_1 FROM users2 AS anon_1'
+    ),
+], ids=[
+    'whitespace_and_parameters',
+    'in_list_and_literals',
+    'identifiers_with_digits',
+])
+def test_normalize_statement(statement, expected):
+    assert sqlstats.normalize_statement(statement) == expected
+
+
+def test_statement_accounting(session: sa_orm.Session, db_engine: sa_engine.Engine):
+    stats = sqlstats.SQLStatementStats()
+    stats.install(db_engine)
+    try:
+        users = factories.UserFactory.build_batch(3)
+        session.add_all(users)
+        session.flush()
+
+        for user in users:
+            session.expire(user)
+            assert user.full_name
+    finally:
+        stats.uninstall()
+
+    assert stats.total_calls >= 4
+
+    # the three lazy refreshes of the expired users are accounted as a single statement
+    refreshes = [s for s in stats.statements.values()
+                 if s.statement.startswith('SELECT') and models.User.__tablename__ in s.statement]
+    assert len(refreshes) == 1
+    assert refreshes[0].calls == 3
+    assert refreshes[0].rows == 3
+    assert refreshes[0].parameters == 3
+    assert refreshes[0].p95_seconds > 0
+
+    report = stats.report(n=1)
+    assert report['total_calls'] == stats.total_calls
+    assert len(report['top']) == 1
+
+    summary = stats.format_summary(n=2)
+    assert summary.startswith('Top 2 of')